@@ -0,0 +1,134 @@
+""" Benchmark of the datacube image renderers
+
+Renders synthetic NDVI and RGB time series (no datacube needed) with
+    pyplot:  the former xarray .plot(col='time') + plt.savefig path
+    figure:  backend.db.render (per-request Figure + Agg canvas)
+    mosaic:  render.mosaic, the NumPy + Pillow encoder of RGB composites
+and prints the median latency and the peak RSS of a process doing only that.
+The other renderers are also run from several threads at once, which the
+pyplot path cannot do safely.
+
+Usage:
+    python scripts/bench_render.py [--times 12] [--size 400] [--repeat 5] [--threads 4]
+"""
+import argparse
+import io
+import json
+import resource
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+
+def dataset(times, size, rgb):
+    import numpy as np
+    import pandas as pd
+    import xarray
+    rng = np.random.default_rng(0)
+    coords = {'time': pd.date_range('2018-01-01', periods=times, freq='10D'),
+              'latitude': np.linspace(52.6, 52.5, size),
+              'longitude': np.linspace(-4.0, -3.9, size)}
+    if rgb:
+        values = rng.random((times, size, size, 3))
+        values[:, :10] = np.nan
+        coords['color'] = ['red', 'green', 'blue']
+        return xarray.DataArray(values, coords=coords,
+                                dims=['time', 'latitude', 'longitude', 'color'])
+    values = rng.uniform(-1, 1, (times, size, size))
+    values[:, :10] = np.nan
+    return xarray.DataArray(values, coords=coords, dims=['time', 'latitude', 'longitude'],
+                            name='ndvi')
+
+
+def render_pyplot(da, rgb):
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    if rgb:
+        da.plot.imshow(x='longitude', y='latitude', col='time', col_wrap=5)
+    else:
+        da.plot(col='time', col_wrap=3, cmap='RdYlGn')
+    fp = io.BytesIO()
+    plt.savefig(fp, dpi=150, format='jpg')
+    plt.gcf().clear()
+    plt.close('all')
+    return fp.tell()
+
+
+def render_figure(da, rgb):
+    from backend.db import render
+    if rgb:
+        fig = render.facets(da, x='longitude', y='latitude', col='time', col_wrap=5,
+                            rgb='color')
+    else:
+        fig = render.facets(da, x='longitude', y='latitude', col='time', col_wrap=3,
+                            cmap='RdYlGn')
+    return render.save(fig, io.BytesIO(), fmt='jpg', dpi=150)
+
+
+def render_mosaic(da, rgb):
+    from backend.db import render
+    panels = ((str(t)[:10], render.scale_rgb([da.values[i, :, :, c] for c in range(3)], 1.0))
+              for i, t in enumerate(da.time.values))
+    return render.mosaic(panels, da.sizes['time'], io.BytesIO(), col_wrap=5)[0]
+
+
+def child(args):
+    """ Run one renderer and print its measurements as JSON """
+    da = dataset(args.times, args.size, args.rgb)
+    fn = {'pyplot': render_pyplot, 'figure': render_figure,
+          'mosaic': render_mosaic}[args.renderer]
+    fn(da, args.rgb)  # imports and font cache
+    latencies = []
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        fn(da, args.rgb)
+        latencies.append(time.perf_counter() - start)
+    res = {"median_s": statistics.median(latencies),
+           "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0}
+    if args.renderer != 'pyplot' and args.threads > 1:
+        start = time.perf_counter()
+        threads = [threading.Thread(target=fn, args=(da, args.rgb))
+                   for _ in range(args.threads)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        res["threads_s"] = time.perf_counter() - start
+    print(json.dumps(res))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--times', type=int, default=12, help='time slices')
+    parser.add_argument('--size', type=int, default=400, help='pixels per side')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--threads', type=int, default=4,
+                        help='concurrent renders of the thread-safe renderers')
+    parser.add_argument('--renderer', help=argparse.SUPPRESS)
+    parser.add_argument('--rgb', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.renderer:
+        return child(args)
+
+    print("{:>6} {:>8} {:>10} {:>12} {}".format(
+        'data', 'renderer', 'median s', 'peak RSS MB', '{} threads s'.format(args.threads)))
+    for rgb in (False, True):
+        for renderer in ('pyplot', 'figure', 'mosaic') if rgb else ('pyplot', 'figure'):
+            cmd = [sys.executable, __file__, '--renderer', renderer,
+                   '--times', str(args.times), '--size', str(args.size),
+                   '--repeat', str(args.repeat), '--threads', str(args.threads)]
+            if rgb:
+                cmd.append('--rgb')
+            out = subprocess.run(cmd, check=True, stdout=subprocess.PIPE,
+                                 universal_newlines=True).stdout
+            res = json.loads(out.strip().splitlines()[-1])
+            print("{:>6} {:>8} {:>10.3f} {:>12.1f} {}".format(
+                'rgb' if rgb else 'ndvi', renderer, res["median_s"], res["peak_rss_mb"],
+                '{:.3f}'.format(res["threads_s"]) if "threads_s" in res else '-'))
+
+
+if __name__ == "__main__":
+    main()
@@ -24,6 +24,8 @@
 # DAMAGE.
 
 ## Execute this at .backends/data/ to create extents.db
+## NOTE: superseded by `backend-ingest landsat', which streams the list without
+## unpacking it to disk and computes epoch/geom during the import
 # Download index from amazon
 wget http://landsat-pds.s3.amazonaws.com/c1/L8/scene_list.gz
 gzip -d scene_list.gz
@@ -38,6 +40,8 @@ sqlite3 extents.db "UPDATE landsat_extent SET epoch = strftime('%s',datetime(acq
 spatialite extents.db "SELECT AddGeometryColumn('landsat_extent','geom',4326,'POLYGON','XY')"
 # generate polygon extents from min/max lon/lat columns
 spatialite extents.db "UPDATE landsat_extent SET geom = GeomFromText('POLYGON(('||min_lon||' '||min_lat||','||max_lon||' '||min_lat||','||max_lon||' '||max_lat||','||min_lon||' '||max_lat||','||min_lon||' '||min_lat||'))',4326);"
+# build the R*Tree spatial index used by coverage lookups (or run `backend-migrate')
+spatialite extents.db "SELECT CreateSpatialIndex('landsat_extent','geom')"
 
 # To test the above -- fetch all landsat coverages at a sample point:
 # select * from landsat_extent where within(GeomFromText('POINT(-3.35 55.95)'),geom);
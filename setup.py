@@ -17,6 +17,10 @@ setup(
     entry_points={
         'console_scripts': [
             'backend = backend.server:runserver',
+            'backend-migrate = backend.db.migrate:main',
+            'backend-ingest = backend.db.ingest:main',
+            'backend-seed-tiles = backend.db.tiles:main',
+            'backend-ndvi-store = backend.db.ndvi_store:main',
         ]
     }
 )
@@ -0,0 +1,91 @@
+"""In-memory least-recently-used cache with expiring entries"""
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache(object):
+    """Thread-safe LRU cache bounded by entry count and (optionally) bytes.
+    Entries older than `ttl` seconds are treated as missing.
+
+    The cache can be tied to a `generation` (any comparable value describing
+    the source data e.g. a file mtime): validate() drops every entry as soon
+    as the generation changes.
+
+    >>> c = TTLCache(maxsize=2, ttl=60)
+    >>> c.put('a', 1); c.put('b', 2); c.put('c', 3)
+    >>> c.get('a') is None, c.get('c')
+    (True, 3)
+    >>> c.stats()['hits'], c.stats()['misses']
+    (1, 1)
+    """
+
+    def __init__(self, maxsize=1024, ttl=300, maxbytes=0):
+        """
+        :param int maxsize: maximum number of entries
+        :param float ttl: seconds an entry stays valid (0: forever)
+        :param int maxbytes: maximum total size of entries as reported to
+                             put() (0: unbounded)
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.maxbytes = maxbytes
+        self.generation = None
+        self.hits = 0
+        self.misses = 0
+        self._bytes = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """ Return the value of key (and mark it as recently used) or default """
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and self.ttl and entry[1] < time.time():
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, size=0):
+        """ Store value under key evicting least recently used entries to fit
+        :param int size: (approximate) size of value in bytes
+        """
+        if self.maxsize <= 0 or (self.maxbytes and size > self.maxbytes):
+            return
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            self._data[key] = (value, time.time() + self.ttl, size)
+            self._bytes += size
+            while len(self._data) > self.maxsize or \
+                    (self.maxbytes and self._bytes > self.maxbytes):
+                self._remove(next(iter(self._data)))
+
+    def validate(self, generation):
+        """ Clear the cache if generation differs from the one it was filled with """
+        if generation != self.generation:
+            with self._lock:
+                if generation != self.generation:
+                    self._data.clear()
+                    self._bytes = 0
+                    self.generation = generation
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def stats(self):
+        """ Counters as a dictionary (e.g. to return as JSON) """
+        with self._lock:
+            return {"entries": len(self._data), "bytes": self._bytes,
+                    "hits": self.hits, "misses": self.misses}
+
+    def _remove(self, key):
+        self._bytes -= self._data.pop(key)[2]
@@ -18,12 +18,20 @@ config.add_section('path')
 config.set('path', 'home', home)
 
 
-def get(section, key):
-    return config.get(section, key)
+def get(section, key, **kwargs):
+    return config.get(section, key, **kwargs)
 
 
-def getboolean(section, key):
-    return config.getboolean(section, key)
+def getboolean(section, key, **kwargs):
+    return config.getboolean(section, key, **kwargs)
+
+
+def getint(section, key, **kwargs):
+    return config.getint(section, key, **kwargs)
+
+
+def getfloat(section, key, **kwargs):
+    return config.getfloat(section, key, **kwargs)
 
 
 # init config
@@ -1 +1,3 @@
-__all__ = ["landsat", "sentinel", "spatialite"]
+__all__ = ["landsat", "sentinel", "spatialite", "coverage", "extent_index", "migrate",
+           "ingest", "datacubes", "tiles", "reductions", "planner", "statistics", "zonal",
+           "ndvi_store"]
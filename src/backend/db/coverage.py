@@ -0,0 +1,324 @@
+""" Coverage lookups shared by the landsat and sentinel extent tables
+
+An extent table is described by a dictionary (see landsat.EXTENT):
+    table:    name of the table
+    geometry: name of its spatialite POLYGON column
+    columns:  SQL select list returned for every match
+    fields:   names of the columns in the JSON responses
+    valid:    SQL condition that filters out erroneous entries
+
+Results are ordered by `epoch DESC, ROWID DESC`. Pages of a limited search
+are chained with a keyset cursor ("<epoch>_<rowid>" of the last row) so a
+page never costs more than its own rows, unlike OFFSET.
+"""
+from backend.db import spatialite, extent_index
+from backend import config, helper, logtool
+from backend.cache import TTLCache
+
+log = logtool.getLogger("db", "coverage")
+
+# search results of both tables, dropped whenever geodb changes
+CACHE = TTLCache(maxsize=config.getint("coverage", "cache_size", fallback=10000),
+                 ttl=config.getfloat("coverage", "cache_ttl", fallback=600),
+                 maxbytes=config.getint("coverage", "cache_bytes", fallback=67108864))
+# coordinates are rounded to this many decimals so that nearby requests share
+# cache entries (5 decimals ~ 1m)
+CACHE_DECIMALS = config.getint("coverage", "cache_decimals", fallback=5)
+# rows read from the database per query (page) by iter_search
+STREAM_CHUNK = config.getint("coverage", "stream_chunk", fallback=1000)
+
+# pre-filter through the R*Tree built by CreateSpatialIndex (see db.migrate)
+# and only run the exact spatial test on its candidates
+POINT_RTREE = """ROWID IN (SELECT pkid FROM idx_{table}_{geometry}
+                            WHERE xmin <= ? AND xmax >= ? AND ymin <= ? AND ymax >= ?)"""
+AREA_RTREE = """ROWID IN (SELECT pkid FROM idx_{table}_{geometry}
+                            WHERE xmin <= MbrMaxX(GeomFromText(?,4326)) AND
+                                  xmax >= MbrMinX(GeomFromText(?,4326)) AND
+                                  ymin <= MbrMaxY(GeomFromText(?,4326)) AND
+                                  ymax >= MbrMinY(GeomFromText(?,4326)))"""
+
+SEARCH_SQL = """
+            SELECT {columns}
+            FROM {table}
+            WHERE {conditions}
+            ORDER BY epoch DESC, ROWID DESC
+            {limit};
+            """
+
+# one statement for a whole batch of points: the points are a VALUES table
+# joined against the extent table
+INDEXED_BATCH_SQL = """
+            WITH pts(pt_idx, pt_lon, pt_lat) AS (VALUES {values})
+            SELECT pt_idx, {columns}
+            FROM pts JOIN {table}
+                 ON {table}.ROWID IN (SELECT pkid FROM idx_{table}_{geometry}
+                                      WHERE xmin <= pt_lon AND xmax >= pt_lon AND
+                                            ymin <= pt_lat AND ymax >= pt_lat)
+            WHERE within(MakePoint(pt_lon, pt_lat, 4326),{geometry}) AND
+                  {valid}
+            ORDER BY pt_idx, epoch DESC, {table}.ROWID DESC;
+            """
+
+# still a single pass over the table for databases without a spatial index
+SCAN_BATCH_SQL = """
+            WITH pts(pt_idx, pt_lon, pt_lat) AS (VALUES {values})
+            SELECT pt_idx, {columns}
+            FROM pts JOIN {table}
+                 ON within(MakePoint(pt_lon, pt_lat, 4326),{geometry})
+            WHERE {valid}
+            ORDER BY pt_idx, epoch DESC, {table}.ROWID DESC;
+            """
+
+
+def find(extent, lon, lat):
+    """ Find all valid entries of an extent table that contain lon, lat
+        Args:
+            extent: extent table description
+            lon: Longitude
+            lat: Latitude
+        Returns:
+            extent['columns'] of all matching rows, newest first
+    """
+    return search(extent, lon, lat)[0]
+
+
+def search(extent, lon=None, lat=None, area=None, time_begin=None, time_end=None,
+           max_cloud=None, limit=None, cursor=None):
+    """ Find the valid entries of an extent table that contain a point or
+        intersect an area, newest first
+        Args:
+            extent: extent table description
+            lon: Longitude
+            lat: Latitude
+            area (optional): WKT geometry (EPSG:4326) used instead of lon, lat
+            time_begin (optional): first acquisition date as YYYY-MM-DD
+            time_end (optional): last acquisition date as YYYY-MM-DD
+            max_cloud (optional): maximum cloudCover
+            limit (optional): maximum number of rows, all of them if None
+            cursor (optional): cursor of the page to return
+        Returns:
+            (rows, cursor): extent['columns'] of the matching rows and the
+            cursor of the next page (None for the last page)
+        Raises:
+            ValueError: invalid date or cursor
+    """
+    res = iter_search(extent, lon, lat, area, time_begin, time_end, max_cloud, limit, cursor,
+                      size=None)
+    rows = [row for chunk in res for row in chunk]
+    return rows, res.cursor
+
+
+def iter_search(extent, lon=None, lat=None, area=None, time_begin=None, time_end=None,
+                max_cloud=None, limit=None, cursor=None, size=STREAM_CHUNK):
+    """ Same as search() but read the rows lazily, `size` rows at a time, e.g.
+        to stream them to the client. Every page is a query of its own that
+        continues after the last row of the previous one (like the cursor),
+        so a pooled connection is only held while a page is read and not
+        while a slow client reads the response. The first page is read
+        before returning, so that its errors are raised here.
+        Returns:
+            A Rows object: iterate it for lists of rows, its `cursor` is set
+            once it has been exhausted
+        Raises:
+            ValueError: invalid date or cursor
+    """
+    if area is None:
+        try:
+            lon, lat = float(lon), float(lat)
+        except ValueError:
+            # GeomFromText() of a bogus point matches nothing either
+            return Rows(iter(()))
+    where, args = filters(time_begin, time_end, max_cloud, cursor)
+    columns = extent['columns']
+    fetch = None
+    if limit is not None:
+        # keep the sort key of every row to build the next cursor from
+        columns += ', epoch, ROWID'
+        fetch = limit + 1
+
+    if area is None and extent_index.enabled():
+        index = extent_index.get(extent)
+        rows = index.select(index.query(lon, lat), columns, where, args, fetch)
+        step = size or max(len(rows), 1)
+        return Rows(iter([rows[i:i + step] for i in range(0, len(rows), step)]), limit)
+
+    # all statements must run on the same snapshot
+    pool = spatialite.current_pool()
+    indexed = spatialite.has_spatial_index(extent['table'], extent['geometry'], pool)
+    conditions, params = [], []
+    if area is None:
+        if indexed:
+            conditions.append(POINT_RTREE)
+            params += [lon, lon, lat, lat]
+        # spatialite predicates return -1 (true for WHERE) for a NULL geometry
+        conditions.append("within(GeomFromText(?,4326),{geometry}) = 1")
+        params.append('POINT({} {})'.format(lon, lat))
+    else:
+        if indexed:
+            conditions.append(AREA_RTREE)
+            params += [area] * 4
+        conditions.append("Intersects({geometry},GeomFromText(?,4326)) = 1")
+        params.append(area)
+    conditions.append(extent['valid'])
+
+    def page(where, args, remaining):
+        count = min([n for n in (size, remaining) if n] or [0])
+        sql = SEARCH_SQL.format(
+            # the sort key of every row, to continue after the last one
+            columns=extent['columns'] + ', epoch, ROWID', table=extent['table'],
+            conditions=' AND\n                  '.join(conditions + where).format(**extent),
+            limit='LIMIT {:d}'.format(count) if count else '')
+        return spatialite.execute(sql, params + args, pool=pool), count
+
+    def pages(rows, count, remaining):
+        while rows:
+            # Rows cuts the sort key off limited searches itself
+            yield rows if limit is not None else [row[:-2] for row in rows]
+            if remaining is not None:
+                remaining -= len(rows)
+            if not count or len(rows) < count or remaining == 0:
+                return
+            after = '{}_{}'.format(int(rows[-1][-2]), int(rows[-1][-1]))
+            rows, count = page(*filters(time_begin, time_end, max_cloud, after), remaining)
+
+    rows, count = page(where, args, fetch)
+    return Rows(pages(rows, count, fetch), limit)
+
+
+class Rows(object):
+    """Result of iter_search(): iterates over lists of rows. The trailing
+    `epoch, ROWID` of a limited search are cut off and turned into the cursor
+    of the next page.
+    """
+
+    def __init__(self, chunks, limit=None):
+        self.chunks = chunks
+        self.limit = limit
+        self.cursor = None
+
+    def __iter__(self):
+        count, last = 0, None
+        try:
+            for chunk in self.chunks:
+                if self.limit is None:
+                    yield chunk
+                    continue
+                if count + len(chunk) > self.limit:
+                    # the extra row only tells that there is a next page
+                    chunk = chunk[:self.limit - count]
+                    if chunk:
+                        last = chunk[-1]
+                        yield [row[:-2] for row in chunk]
+                    self.cursor = '{}_{}'.format(int(last[-2]), int(last[-1]))
+                    return
+                count += len(chunk)
+                last = chunk[-1]
+                yield [row[:-2] for row in chunk]
+        finally:
+            # stops reading the pages of an unfinished search
+            close = getattr(self.chunks, 'close', None)
+            if close is not None:
+                close()
+
+
+def cached_search(extent, convert, **filters):
+    """ search() through CACHE
+        Args:
+            extent: extent table description
+            convert: function applied to each row before it is cached e.g.
+                     landsat.to_dict
+            filters: keyword arguments of search
+        Returns:
+            (converted rows, cursor) as search(). The rows are shared with the
+            cache and must not be modified.
+    """
+    if CACHE.maxsize <= 0:
+        res, cursor = search(extent, **filters)
+        return [convert(row) for row in res], cursor
+    key = dict(filters)
+    if filters.get('area') is None:
+        # only the key is rounded, the search runs on the exact point
+        try:
+            key['lon'] = round(float(filters['lon']), CACHE_DECIMALS)
+            key['lat'] = round(float(filters['lat']), CACHE_DECIMALS)
+        except (TypeError, ValueError):
+            # not cached, search() reports the invalid point
+            res, cursor = search(extent, **filters)
+            return [convert(row) for row in res], cursor
+    # generation of the snapshot being served: geodb may already point to the
+    # next one, which only goes live with spatialite.swap()
+    CACHE.validate(spatialite.generation(spatialite.current_pool().path))
+    key = (extent['table'],) + tuple(sorted(key.items()))
+    found = CACHE.get(key)
+    if found is None:
+        res, cursor = search(extent, **filters)
+        found = ([convert(row) for row in res], cursor)
+        CACHE.put(key, found, len(repr(res)))
+    return found
+
+
+def valid_area(wkt):
+    """ True if wkt is a geometry spatialite can read, i.e. usable as the
+        area of search()
+    """
+    return bool(spatialite.execute("SELECT GeomFromText(?,4326) IS NOT NULL;", (wkt,))[0][0])
+
+
+def filters(time_begin=None, time_end=None, max_cloud=None, cursor=None):
+    """ SQL conditions and their arguments for the non-spatial search filters
+        (see search)
+        Returns:
+            (list of SQL conditions, list of arguments)
+    """
+    where, args = [], []
+    if time_begin is not None:
+        where.append("epoch >= ?")
+        args.append(helper.date2epoch(time_begin))
+    if time_end is not None:
+        # time_end is inclusive
+        where.append("epoch < ?")
+        args.append(helper.date2epoch(time_end) + 86400)
+    if max_cloud is not None:
+        # cloudCover is TEXT when imported with `sqlite3 .import', the search
+        # index is on this exact expression (see migrate.create_search_index)
+        where.append("CAST(cloudCover AS REAL) <= ?")
+        args.append(float(max_cloud))
+    if cursor is not None:
+        epoch, rowid = [int(v) for v in cursor.split('_')]
+        where.append("(epoch < ? OR (epoch = ? AND ROWID < ?))")
+        args += [epoch, epoch, rowid]
+    return where, args
+
+
+def find_many(extent, points):
+    """ find() for many points at once
+        Args:
+            extent: extent table description
+            points: list of (lon, lat) pairs of floats
+        Returns:
+            Dictionary of index in points -> rows as returned by find()
+    """
+    found = {i: [] for i in range(len(points))}
+    if not points:
+        return found
+    if extent_index.enabled():
+        index = extent_index.get(extent)
+        rowids = [index.query(lon, lat) for lon, lat in points]
+        # fetch every matched row once even if it contains several points
+        unique = sorted({int(r) for ids in rowids for r in ids})
+        rows = {row[0]: row[1:] for row in
+                index.select(unique, extent['columns'], with_rowid=True)}
+        for i, ids in enumerate(rowids):
+            # rows replaced since the index was built are gone
+            found[i] = [rows[int(r)] for r in ids if int(r) in rows]
+        return found
+    pool = spatialite.current_pool()
+    if spatialite.has_spatial_index(extent['table'], extent['geometry'], pool):
+        sql = INDEXED_BATCH_SQL
+    else:
+        sql = SCAN_BATCH_SQL
+    values = ','.join(['(?,?,?)'] * len(points))
+    args = [v for i, (lon, lat) in enumerate(points) for v in (i, lon, lat)]
+    for row in spatialite.execute(sql.format(values=values, **extent), args, pool=pool):
+        found[row[0]].append(row[1:])
+    return found
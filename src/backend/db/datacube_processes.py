@@ -25,8 +25,12 @@
 
 """ Datacube processing functions
 """
-from backend import logtool
-from backend.helper import isdate
+import os
+
+from backend import config, logtool, workers
+from backend.db import datacubes, ndvi_store, planner, reductions, render, statistics, zonal
+from backend.diskcache import DiskCache
+from backend.helper import isdate, linestring
 
 log = logtool.getLogger("db", "datacube_precesses")
 # Make this configurable once the user can dymanically generate one's own datasets
@@ -52,43 +56,172 @@ L1C = {
 
 DATASET = L2A
 
-def execute(params, fp=None):
+# 10m product used by ndvi_transect
+TRANSECT_PRODUCT = 'safe_10m'
+
+# native resolutions (degrees) loaded from granule products and by
+# ndvi_transect, coarsened by fit() when a request is too large
+GRANULE_RESOLUTION = 0.000135
+TRANSECT_RESOLUTION = 0.00027
+
+# rendered plots keyed by cache_key(), see rest.GeoRest.datacube_selection
+PLOTS = DiskCache(os.path.join(config.get("path", "data_dir"), "plots"),
+                  maxbytes=config.getint("datacube", "plot_cache_bytes", fallback=536870912),
+                  maxage=config.getfloat("datacube", "plot_cache_age", fallback=86400))
+
+# bands of the RGB composites, in R, G, B order
+RGB_MEASUREMENTS = {
+    'time_series': ['B04_10m', 'B03_10m', 'B02_10m'],
+    'colour_infrared': ['B08_10m', 'B04_10m', 'B03_10m'],
+    'colour_urban': ['B12_20m', 'B11_20m', 'B04_20m'],
+}
+
+# bands ndvi() is computed from
+NDVI_MEASUREMENTS = ['B04_20m', 'B8A_20m', 'SCL_20m']
+
+# rectangle types that may be requested together, see bundle
+BUNDLE_TYPES = ('time_series', 'colour_infrared', 'colour_urban', 'ndvi_time_series',
+                'ndvi_std_dev')
+
+# largest mosaic width in pixels a request may ask for
+MAX_IMAGE_SIZE = 8192
+
+# request parameters that don't change the result
+IGNORED_PARAMS = ('_', 'callback')
+
+
+def warm():
+    """ Import the plotting libraries and connect to the datacube of DATASET
+    ahead of the first request
+    """
+    import matplotlib.backends.backend_agg
+    import datacube.storage.masking
+    assert matplotlib.backends.backend_agg and datacube.storage.masking  # Silence unused import
+    datacubes.warm(DATASET['env'], [DATASET['product'], TRANSECT_PRODUCT])
+
+
+def cache_key(params):
+    """ Key of the result of execute(params) in PLOTS. Parameters are
+    normalised so that equivalent requests share an entry: numbers are compared
+    as floats (to 1e-6 degrees) and dates as YYYY-MM-DD. DATASET is part of the
+    key as the same selection renders differently on another dataset.
+    :param Dictionary params: request parameters
+    :return str: hexadecimal key
+
+    >>> cache_key({'xmin': '1'}) == cache_key({'xmin': '1.0000001'})
+    True
+    >>> cache_key({'time_end': '2018-2-1'}) == cache_key({'time_end': '2018-02-01'})
+    True
+    """
+    normal = {}
+    for k, v in params.items():
+        if k in IGNORED_PARAMS:
+            continue
+        v = v.strip()
+        try:
+            v = round(float(v), 6)
+        except ValueError:
+            if isdate(v):
+                v = '{:04d}-{:02d}-{:02d}'.format(*[int(p) for p in v.split('-')])
+        normal[k] = v
+    return DiskCache.key(normal, DATASET)
+
+
+def run(params, fp, progress_file=None):
+    """execute() in a worker process of backend.workers so that loading and
+    plotting don't hold up the request threads
+    :param Dictionary params: request parameters
+    :param file object fp: named file the plot is written to
+    :param str progress_file: optional path where the load progress is
+                              recorded (see progress_writer)
+    :return: as execute()
+    :raises workers.Busy: when all workers are busy and the queue is full
+    """
+    pool = workers.get_pool(initializer=warm)
+    if pool is None:
+        return execute_file(params, fp.name, progress_file)
+    try:
+        return pool.submit(execute_file, params, fp.name, progress_file)
+    except workers.JobTimeout:
+        return error("Processing took longer than {}s, please select a smaller area"
+                     " or time range".format(pool.timeout))
+    except workers.JobFailed as err:
+        return error("Processing failed: {}".format(err))
+
+
+def execute_file(params, path, progress_file=None):
+    """execute() writing to the file at path (job function of run)"""
+    progress = progress_writer(progress_file) if progress_file else None
+    with open(path, 'wb') as fp:
+        return execute(params, fp, progress)
+
+
+def progress_writer(path, interval=1.0):
+    """Return a progress callback for datacubes.load that records the number of
+    datasets loaded so far in the JSON file at path, at most every `interval`
+    seconds (and always for the last dataset)
+    """
+    import json
+    import time
+    last = [0]
+
+    def progress(loaded, total):
+        now = time.time()
+        if now - last[0] < interval and loaded != total:
+            return
+        last[0] = now
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({"loaded": loaded, "total": total}, f)
+        os.replace(tmp, path)
+    return progress
+
+
+def execute(params, fp=None, progress=None):
     """Handles REST parameters and dispatches the right function
     :param Dictionary params: request parameters
     :param file object params: optional file object to save plots are other bulky files
+    :param progress: optional function(loaded, total) called while datasets load
     :return: raw HTTP response (json or image/*)
     """
     if not ('selection' in params) or not ('type' in params):
-        return error("Both selection [line|rectangle] and type"
+        return error("Both selection [line|rectangle|zones] and type"
                      " [ndvi_transect|ndvi_time_series|time_series|...] need to be defined.")
     if params['selection'] == 'line':
-        res = line(params, fp)
-    if params['selection'] == 'rectangle':
-        res = rectangle(params, fp)
-    return res
+        return line(params, fp, progress)
+    elif params['selection'] == 'rectangle':
+        return rectangle(params, fp, progress)
+    elif params['selection'] == 'zones':
+        return zones(params, fp, progress)
+    else:
+        return error("Unknown selection {}, supported: line, rectangle, zones"
+                     .format(params['selection']))
 
 
-def line(params, fp=None):
+def line(params, fp=None, progress=None):
     """Handles line-based algorithms e.g. ndvi_transect and dispatches
     the right function.
-    :param Dictionary params: dictionary with xmin,xmax,ymin,ymax,type
+    :param Dictionary params: dictionary with type and either line (a WKT or
+                              GeoJSON LINESTRING in EPSG:4326) or the segment
+                              xmin,xmax,ymin,ymax
     :param file object params: optional file object to save plots are other bulky files
+    :param progress: optional load progress callback (see execute)
     :return: raw HTTP response (json or image/*)
-
-    NOTE: line can potentially be any multipoint LINESTRING but we
-    start with xmin,xmax,ymin,ymax
     """
     from datacube.utils import geometry
 
-    if not ('xmin' in params) or not ('xmax' in params) \
+    if 'line' in params:
+        try:
+            coords = linestring(params['line'])
+        except ValueError as err:
+            return error("Invalid line: {}".format(err))
+    elif not ('xmin' in params) or not ('xmax' in params) \
        or not ('ymin' in params) or not ('ymax' in params):
-            return error("Line requires xmin,xmax,ymin,ymax")
-    xmin = float(params["xmin"])
-    xmax = float(params["xmax"])
-    ymin = float(params["ymin"])
-    ymax = float(params["ymax"])
-    # NOTE: you can use a line with multiple points here
-    line = geometry.line([(xmin, ymin), (xmax, ymax)], 'EPSG:4326')
+            return error("Line requires a LINESTRING line or xmin,xmax,ymin,ymax")
+    else:
+        coords = [(float(params["xmin"]), float(params["ymin"])),
+                  (float(params["xmax"]), float(params["ymax"]))]
+    line = geometry.line(coords, 'EPSG:4326')
     if(line.type != 'LineString'):
         return error("ndvi_transect: line not LINESTRING")
 
@@ -99,19 +232,60 @@ def line(params, fp=None):
         if (not isdate(params['time_begin'])) or (not isdate(params['time_end'])):
             return error("Invalid time specified")
         query['time'] = (params['time_begin'], params['time_end'])
+    # handed on to datacubes.load by the processing functions
+    query['progress'] = progress
     if params['type'] == 'ndvi_transect':
         if not fp:
             return error("ndvi_transet needs a pre-allocated file")
-        return ndvi_transect(query, fp)
+        fmt, err = output_format(params)
+        if err:
+            return error(err)
+        return ndvi_transect(query, fp, fmt)
     else:
         return error("Supported line-processing types: ndvi_transect")
 
 
-def rectangle(params, fp=None):
+def zones(params, fp=None, progress=None):
+    """Handles zone-based algorithms i.e. ndvi_zonal
+    :param Dictionary params: request parameters with zones, a GeoJSON
+                              FeatureCollection of polygons in EPSG:4326
+    :param file object params: file object the result is written to
+    :param progress: optional load progress callback (see execute)
+    :return: raw HTTP response (json)
+    """
+    if 'zones' not in params:
+        return error("Zones require a GeoJSON FeatureCollection zones")
+    try:
+        features = zonal.parse(params['zones'])
+    except (ValueError, TypeError, AttributeError) as err:
+        return error("Invalid zones: {}".format(err))
+    xmin, ymin, xmax, ymax = zonal.bounds(features)
+    query = {
+        'x': (xmin, xmax),
+        'y': (ymin, ymax)
+        }
+    if ('time_begin' in params) and ('time_end' in params):
+        if (not isdate(params['time_begin'])) or (not isdate(params['time_end'])):
+            return error("Invalid time specified")
+        query['time'] = (params['time_begin'], params['time_end'])
+    query['progress'] = progress
+    if not fp:
+        return error("A pre-allocated file is currently mandatory for all operations")
+    if params['type'] == 'ndvi_zonal':
+        fmt = params.get('format', 'json')
+        if fmt not in statistics.FORMATS:
+            return error("format must be one of {}".format(", ".join(sorted(statistics.FORMATS))))
+        return ndvi_zonal(query, features, fp, fmt)
+    else:
+        return error("Supported zone-processing types: ndvi_zonal")
+
+
+def rectangle(params, fp=None, progress=None):
     """Handles rectangle-based algorithms e.g. ndvi_time_series and dispatches
     the right function.
     :param Dictionary params: request parameters
     :param file object params: optional file object to save plots are other bulky files
+    :param progress: optional load progress callback (see execute)
     :return: raw HTTP response (json or image/*)
     """
     if not ('xmin' in params) or not ('xmax' in params) \
@@ -129,23 +303,26 @@ def rectangle(params, fp=None):
         if (not isdate(params['time_begin'])) or (not isdate(params['time_end'])):
             return error("Invalid time specified")
         query['time'] = (params['time_begin'], params['time_end'])
+    # handed on to datacubes.load by the processing functions
+    query['progress'] = progress
     
     if not fp:
         return error("A pre-allocated file is currently mandatory for all operations")
 
-    if params['type'] == 'ndvi_time_series':
-        return ndvi_time_series(query, fp, std_dev=False)
-    elif params['type'] == 'ndvi_std_dev':
-        return ndvi_time_series(query, fp, std_dev=True)
-    elif params['type'] == 'time_series':
-        query["measurements"] = ['B04_10m', 'B03_10m', 'B02_10m']
-        return time_series(query, fp)
-    elif params['type'] == 'colour_infrared':
-        query["measurements"] = ['B08_10m', 'B04_10m', 'B03_10m']
-        return time_series(query, fp)
-    elif params['type'] == 'colour_urban':
-        query["measurements"] = ['B12_20m', 'B11_20m', 'B04_20m']
-        return time_series(query, fp)
+    if ',' in params['type']:
+        return bundle(query, params['type'].split(','), fp, params)
+    if params['type'] in ('ndvi_time_series', 'ndvi_std_dev'):
+        fmt, err = output_format(params)
+        if err:
+            return error(err)
+        return ndvi_time_series(query, fp, std_dev=params['type'] == 'ndvi_std_dev', fmt=fmt,
+                                monthly=params.get('composite') == 'monthly')
+    elif params['type'] in ('time_series', 'colour_infrared', 'colour_urban'):
+        options, err = image_options(params)
+        if err:
+            return error(err)
+        query["measurements"] = RGB_MEASUREMENTS[params['type']]
+        return time_series(query, fp, **options)
     #elif params['type'] == 'swir':
     #    query["measurements"] = ['B12_20m', 'B8A_20m', 'B04_20m']
     #    return time_series(query, fp)
@@ -167,45 +344,214 @@ def rectangle(params, fp=None):
     else:
         return error("Please use a supported rectangle-processing type e.g. ndvi_time_series, colour_infrared etc.")
 
-def time_series(query, fp):
+def bundle(query, types, fp, params):
+    """Several rectangle types from a single load of the union of their bands,
+    returned as a ZIP archive of one file per type (<type>.<format>) and a
+    manifest.json: {"error": 0, "plan": ..., "outputs": [{"type", "file",
+    "mimetype", "size"} or {"type", "error": 1, "msg"}, ...]}
+    :param dict query: x (or longitude), y (or latitude), time
+    :param list types: BUNDLE_TYPES
+    :param File fp: file pointer to save the archive to
+    :param Dictionary params: request parameters, format applies to the types
+                              that support it, the others are jpg
+    :return: raw HTTP response (json or application/zip)
+    """
+    import io
+    import json
+    import zipfile
+
+    types = [t.strip() for t in types]
+    unknown = [t for t in types if t not in BUNDLE_TYPES]
+    if unknown or len(set(types)) != len(types):
+        return error("type must be distinct values of {}".format(", ".join(BUNDLE_TYPES)))
+    fmt = params.get('format', 'jpg')
+    options, err = image_options(dict(params, format=fmt if fmt in render.IMAGE_FORMATS else 'jpg'))
+    if err:
+        return error(err)
+    if fmt not in statistics.FORMATS:
+        fmt = 'jpg'
+    measurements = []
+    for t in types:
+        measurements.extend(m for m in RGB_MEASUREMENTS.get(t, NDVI_MEASUREMENTS)
+                            if m not in measurements)
+
+    estimate = None
+    if 'granule' in DATASET['product']:
+        query['output_crs'] = 'EPSG:4326'
+        estimate, err = fit(query, DATASET['product'], measurements, GRANULE_RESOLUTION)
+        if err:
+            return dict(error(err), plan=estimate)
+    # grouped by solar day like the NDVI types, so every type has the same dates
+    data = datacubes.load(DATASET['env'], product=DATASET['product'], measurements=measurements,
+                          group_by='solar_day', **query)
+    if (len(data.data_vars) == 0):
+        return error("Didn't find any index/ingested data in selected area at {}".format(DATASET))
+    y, x = data.crs.dimensions
+    values = None
+    outputs = []
+    with zipfile.ZipFile(fp, 'w') as archive:
+        for t in types:
+            out = io.BytesIO()
+            if t in RGB_MEASUREMENTS:
+                res = rgb_mosaic(data, RGB_MEASUREMENTS[t], out, **options)
+                name = '{}.{}'.format(t, options['fmt'])
+            else:
+                if values is None:
+                    values = ndvi(data)
+                std_dev = t == 'ndvi_std_dev'
+                if not std_dev and params.get('composite') == 'monthly':
+                    res = ndvi_result(values.resample(time='1MS').mean(), x, y, out, fmt=fmt)
+                else:
+                    res = ndvi_result(values, x, y, out, std_dev=std_dev, fmt=fmt)
+                name = '{}.{}'.format(t, fmt)
+            if res['error'] != 0:
+                outputs.append({'type': t, 'error': 1, 'msg': res['msg']})
+                continue
+            # images are compressed already
+            compression = zipfile.ZIP_STORED if res['mimetype'].startswith('image/') \
+                else zipfile.ZIP_DEFLATED
+            archive.writestr(name, out.getvalue(), compress_type=compression)
+            outputs.append({'type': t, 'file': name, 'mimetype': res['mimetype'],
+                            'size': res['size']})
+        archive.writestr('manifest.json', json.dumps({'error': 0, 'plan': estimate,
+                                                      'outputs': outputs}),
+                         compress_type=zipfile.ZIP_DEFLATED)
+    return {'error': 0, 'mimetype': 'application/zip', 'size': fp.tell(), 'plan': estimate}
+
+
+def image_options(params):
+    """Parse the output options of the mosaic renderer (see time_series)
+    :param Dictionary params: request parameters
+    :return: (keyword arguments of time_series, None) or (None, error message)
+
+    >>> image_options({'size': '800', 'format': 'png'})
+    ({'width': 800, 'quality': 85, 'fmt': 'png'}, None)
+    >>> image_options({'quality': '0'})[1]
+    'quality must be an integer between 1 and 100'
+    """
+    options = {'width': None, 'quality': 85, 'fmt': params.get('format', 'jpg')}
+    if options['fmt'] not in render.IMAGE_FORMATS:
+        return None, "format must be one of {}".format(", ".join(sorted(render.IMAGE_FORMATS)))
+    try:
+        if 'size' in params:
+            options['width'] = int(params['size'])
+            if not 64 <= options['width'] <= MAX_IMAGE_SIZE:
+                raise ValueError()
+    except ValueError:
+        return None, "size must be an integer between 64 and {}".format(MAX_IMAGE_SIZE)
+    try:
+        options['quality'] = int(params.get('quality', 85))
+        if not 1 <= options['quality'] <= 100:
+            raise ValueError()
+    except ValueError:
+        return None, "quality must be an integer between 1 and 100"
+    return options, None
+
+
+def output_format(params):
+    """Parse the format of the NDVI analyses: their plot (jpg) or their numbers
+    (one of statistics.FORMATS)
+    :param Dictionary params: request parameters
+    :return: (format, None) or (None, error message)
+
+    >>> output_format({})
+    ('jpg', None)
+    >>> output_format({'format': 'csv'})
+    ('csv', None)
+    >>> output_format({'format': 'png'})[1]
+    'format must be one of csv, jpg, json'
+    """
+    fmt = params.get('format', 'jpg')
+    formats = ['jpg'] + list(statistics.FORMATS)
+    if fmt not in formats:
+        return None, "format must be one of {}".format(", ".join(sorted(formats)))
+    return fmt, None
+
+
+def table(columns, rows, fp, fmt, estimate=None):
+    """Write the rows of a numeric result (see statistics.write) to fp
+    :return: raw HTTP response (json)
+    """
+    size, mimetype = statistics.write(columns, rows, fp, fmt)
+    return {'error': 0, 'mimetype': mimetype, 'size': size, 'plan': estimate}
+
+
+def fit(query, product, measurements, resolution, per_slice=False):
+    """Find the datasets of query and estimate its load (see planner.plan).
+    The resolution of query is set to the one planned to fit the memory budget
+    and the datasets found are added to it, so that dc.load doesn't search the
+    index again.
+    :param dict query: dc.load query in EPSG:4326
+    :param str product: product loaded
+    :param list measurements: bands loaded
+    :param float resolution: native resolution in degrees
+    :param bool per_slice: data is processed one time slice at a time
+    :return: (estimate, error message or None) as planner.plan, the error of
+             a selection without data is returned before anything is loaded
+    """
+    found = planner.datasets(DATASET['env'], product, query)
+    if not found:
+        # nothing would be loaded, at the native resolution
+        return ({"datasets": 0, "time_steps": 0, "resolution": resolution, "scale": 1.0,
+                 "pixels": planner.pixels(query, resolution), "bytes": 0},
+                "Didn't find any index/ingested data in selected area at {}".format(DATASET))
+    estimate, err = planner.plan(DATASET['env'], product, query, len(measurements), resolution,
+                                 per_slice=per_slice, found=found)
+    query['resolution'] = (-estimate['resolution'], estimate['resolution'])
+    query['datasets'] = found
+    return estimate, err
+
+
+def time_series(query, fp, width=None, quality=85, fmt='jpg'):
     """Returns muliple images with R,G,B values mapped to measurements parameter
     :param dict query: x (or longitude), y (or latitude), time
     :param file object params: optional file object to save plots are other bulky files
+    :param int width: width of the mosaic in pixels, native resolution if None
+    :param int quality: JPEG/WebP quality
+    :param str fmt: jpg, png or webp
     :return: raw HTTP response (json or image/*)
     """
-    # keep those imports here to avoid breaking the rest of the file when these
-    # libraries do not exist
-    import matplotlib
-    # pyplot will dry to plot on an X11 Display without this:
-    matplotlib.use('Agg')
-    import matplotlib.pyplot as plt
-    import datacube
-    from datacube.storage.masking import mask_invalid_data
-    
-
+    estimate = None
     if 'granule' in DATASET['product']:
-        query['resolution'] = (-0.000135, 0.000135)
         query['output_crs'] = 'EPSG:4326'
+        estimate, err = fit(query, DATASET['product'], query['measurements'], GRANULE_RESOLUTION)
+        if err:
+            return dict(error(err), plan=estimate)
     
-    dc = datacube.Datacube(env=DATASET['env'], app="ndvi_time_series")
+    data = datacubes.load(DATASET['env'], product=DATASET['product'], **query)
+    if (len(data.data_vars) == 0):
+        return error("Didn't find any index/ingested data in selected area at {}".format(DATASET))
+    return rgb_mosaic(data, query['measurements'], fp, width=width, quality=quality, fmt=fmt,
+                      estimate=estimate)
+
+
+def rgb_mosaic(data, measurements, fp, width=None, quality=85, fmt='jpg', estimate=None):
+    """Render the R,G,B composite of measurements of every time slice of data
+    into one mosaic (see render.mosaic)
+    :param xarray.Dataset data: result of dc.load, may hold other bands too
+    :param list measurements: R, G and B band names
+    :param File fp: file pointer to save the image to
+    :param int width, quality, str fmt: as time_series
+    :param dict estimate: plan of the load (see fit)
+    :return: raw HTTP response (json or image/*)
+    """
+    # keep those imports here to avoid breaking the rest of the file when these
+    # libraries do not exist
+    from datacube.storage.masking import mask_invalid_data
 
-    data = dc.load(DATASET['product'], **query)
-    data = mask_invalid_data(data)
-    rgb = data.to_array(dim='color')
+    y, x = data.crs.dimensions
+    data = mask_invalid_data(data[measurements])
+    bands = [data[m].transpose('time', y, x) for m in measurements]
     fake_saturation = 4000
-    rgb = rgb.transpose(*(rgb.dims[1:]+rgb.dims[:1]))  # make 'color' the last dimension
-    rgb = rgb.where((rgb <= fake_saturation).all(dim='color'))  # mask out pixels where any band is 'saturated'
-    rgb /= fake_saturation  # scale to [0, 1] range for imshow
+    # one time slice at a time: pixels where any band is 'saturated' are blanked
+    panels = ((str(t)[:10], render.scale_rgb([b.values[i] for b in bands], fake_saturation))
+              for i, t in enumerate(data.time.values))
     try:
-        rgb.plot.imshow(x=data.crs.dimensions[1], y=data.crs.dimensions[0],col='time', col_wrap=5)
+        size, mimetype = render.mosaic(panels, data.sizes['time'], fp, col_wrap=5,
+                                       width=width, quality=quality, fmt=fmt)
     except Exception as err:
         return error("Plotting failed: {}".format(err))
-    ############################
-    # save to supplied file object:
-    plt.savefig(fp, dpi=150, format='jpg')
-    plt.gcf().clear()  # clear figure instead of combining new images with old
-    size = fp.tell()
-    return {'error': 0, 'mimetype': 'image/jpg', 'size': size}
+    return {'error': 0, 'mimetype': mimetype, 'size': size, 'plan': estimate}
 
 
 def l2a_scene_classifier(query, fp):
@@ -214,84 +560,66 @@ def l2a_scene_classifier(query, fp):
     :param file object params: optional file object to save plots are other bulky files
     :return: raw HTTP response (json or image/*)
     """
-    # keep those imports here to avoid breaking the rest of the file when these
-    # libraries do not exist
-    import matplotlib
-    # pyplot will dry to plot on an X11 Display without this:
-    matplotlib.use('Agg')
-    import matplotlib.pyplot as plt
-    import datacube
-    from datacube.storage.masking import mask_invalid_data
-    
-
+    estimate = None
     if 'granule' in DATASET['product']:
-        query['resolution'] = (-0.000135, 0.000135)
         query['output_crs'] = 'EPSG:4326'
+        estimate, err = fit(query, DATASET['product'], ['SCL_20m'], GRANULE_RESOLUTION)
+        if err:
+            return dict(error(err), plan=estimate)
     
-    dc = datacube.Datacube(env=DATASET['env'], app="S2_scene_classifier")
-
-    data = dc.load(DATASET['product'], measurements=['SCL_20m'], **query)
+    data = datacubes.load(DATASET['env'], product=DATASET['product'], measurements=['SCL_20m'],
+                          **query)
     scl = data.SCL_20m
     colors=["xkcd:charcoal", "#3498db", "xkcd:green", "xkcd:white", "xkcd:dark green", "xkcd:white", "xkcd:deep blue", "xkcd:dark brown","xkcd:white","xkcd:white"]
     
     try:
-        scl.plot(col='time', col_wrap=3, levels=[0,1,2,3,4,5,6,7,8,9,10], colors = colors)
+        fig = render.classes(scl, x=data.crs.dimensions[1], y=data.crs.dimensions[0],
+                             levels=[0,1,2,3,4,5,6,7,8,9,10], colors=colors, col='time', col_wrap=3)
     except Exception as err:
         return error("Plotting failed: {}".format(err))
     ############################
     # save to supplied file object:
-    plt.savefig(fp, dpi=150, format='jpg')
-    plt.gcf().clear()  # clear figure instead of combining new images with old
-    size = fp.tell()
-    return {'error': 0, 'mimetype': 'image/jpg', 'size': size}
+    size = render.save(fig, fp, fmt='jpg', dpi=150)
+    return {'error': 0, 'mimetype': 'image/jpg', 'size': size, 'plan': estimate}
 
 
-def ndvi_transect(query, fp):
-    """Return ndvi_transect as image
+def ndvi_transect(query, fp, fmt='jpg'):
+    """Return ndvi_transect as image, or its profile as numbers
     :param dict query: x (or longitude), y (or latitude), time
     :param File fp: file pointer to save resulting plot
+    :param str fmt: jpg for the plot, or json/csv for the NDVI of every date
+                    and sample (see statistics.profile)
     :return: raw HTTP response (json on success or image on error)
-
-    NOTE: line can potentially be any multipoint LINESTRING but we
-    start with xmin,xmax,ymin,ymax
     """
     # keep those imports here to avoid breaking the rest of the file when these
     # libraries do not exist
-    import matplotlib
-    # pyplot will dry to plot on an X11 Display without this:
-    matplotlib.use('Agg')
-    import matplotlib.pyplot as plt
-    import numpy as np
     import xarray
-    import datacube
 
     line = query['geopolygon']
     
-    query.update({
-        'resolution': (-0.00027, 0.00027), # ADJUST THIS FOR QUALITY (in WPS84 degrees) -- can run out of memory ;)
-        'output_crs': 'EPSG:4326'
-    })
+    query['output_crs'] = 'EPSG:4326'
+    estimate, err = fit(query, TRANSECT_PRODUCT, ['B04_10m', 'B08_10m'], TRANSECT_RESOLUTION)
+    if err:
+        return dict(error(err), plan=estimate)
     
-    dc = datacube.Datacube(env=DATASET['env'], app='ndvi-transect')
-    nired = dc.load(product='safe_10m', measurements=['B04_10m', 'B08_10m'],
-                    group_by='solar_day', **query)
+    nired = datacubes.load(DATASET['env'], product=TRANSECT_PRODUCT,
+                           measurements=['B04_10m', 'B08_10m'], group_by='solar_day', **query)
     # Return error message if we find no data instead of crashing
     if (len(nired.data_vars) == 0):
-        error("Didn't find any index/ingested data in selected area at {}".format(DATASET))
+        return error("Didn't find any index/ingested data in selected area at {}".format(DATASET))
     #### interpolation -- calculate all values along the line according to resolution
     try:
         resolution = abs(nired.affine.a)
         line = line.to_crs(nired.crs)
-        dist = np.arange(0, line.length, resolution)
-        points = [line.interpolate(d).coords[0] for d in dist]
-        indexers = {
-            nired.crs.dimensions[0]: [p[1] for p in points],
-            nired.crs.dimensions[1]: [p[0] for p in points]
-        }
-        trans = nired.sel_points(xarray.DataArray(dist, name='distance', dims=['distance']),
-                                 method='nearest',
-                                 tolerance=None,
-                                 **indexers)
+        dist, xs, ys = transect_points(line.coords, resolution)
+        if len(dist) == 0:
+            return error("ndvi_transect: line has no length")
+        # nearest pixel of every sample in one vectorised selection
+        y, x = nired.crs.dimensions
+        trans = nired.sel({y: xarray.DataArray(ys, dims=['distance']),
+                           x: xarray.DataArray(xs, dims=['distance'])},
+                          method='nearest')
+        trans = trans.assign_coords(distance=dist)
         ####
         nir = trans.B08_10m.where(trans.B08_10m != trans.B08_10m.attrs['nodata'])
         red = trans.B04_10m.where(trans.B04_10m != trans.B04_10m.attrs['nodata'])
@@ -302,61 +630,197 @@ def ndvi_transect(query, fp):
         #ndvi_cloud_free = ndvi.where(good_data).dropna('time', how='all')
         #ndvi_cloud_free.plot()
         #ndvi.plot()
+        if fmt in statistics.FORMATS:
+            columns, rows = statistics.profile(ndvi.rename('ndvi'), x=x, y=y)
+            return table(columns, rows, fp, fmt, estimate)
         # reverse Y,X and use custom cmap:
-        ndvi.plot(x='distance', y='time', cmap='RdYlGn')
+        fig = render.transect(ndvi, x='distance', y='time', cmap='RdYlGn')
     except Exception as err:
         return error("Plotting failed: {}".format(err))
     ############################
     # save to supplied file object:
-    plt.savefig(fp, dpi=150, format='jpg')
-    plt.gcf().clear()  # clear figure instead of combining new images with old
-    size = fp.tell()
-    return {'error': 0, 'mimetype': 'image/jpg', 'size': size}
+    size = render.save(fig, fp, fmt='jpg', dpi=150)
+    return {'error': 0, 'mimetype': 'image/jpg', 'size': size, 'plan': estimate}
+
+
+def transect_points(coords, step):
+    """Points every `step` along a polyline, interpolated along all segments at
+    once with NumPy
+    :param list coords: vertices [(x, y), ...]
+    :param float step: distance between samples, in units of coords
+    :return: (distance, xs, ys) arrays, distance from the first vertex
+
+    >>> d, xs, ys = transect_points([(0, 0), (2, 0), (2, 0), (2, 1)], 0.5)
+    >>> d.tolist()
+    [0.0, 0.5, 1.0, 1.5, 2.0, 2.5]
+    >>> list(zip(xs.tolist(), ys.tolist()))[3:]
+    [(1.5, 0.0), (2.0, 0.0), (2.0, 0.5)]
+    """
+    import numpy as np
+
+    vertices = np.asarray(coords, dtype=float)[:, :2]
+    lengths = np.hypot(*np.diff(vertices, axis=0).T)
+    # repeated vertices would make the distances along the line non-increasing
+    vertices = vertices[np.concatenate([[True], lengths > 0])]
+    along = np.concatenate([[0.0], np.cumsum(lengths[lengths > 0])])
+    dist = np.arange(0, along[-1], step)
+    return dist, np.interp(dist, along, vertices[:, 0]), np.interp(dist, along, vertices[:, 1])
 
 
-def ndvi_time_series(query, fp, std_dev=False):
+def ndvi(nired):
+    """NDVI of data loaded with NDVI_MEASUREMENTS, NaN where either band has no
+    data or the scene classification flags the pixel as cloud or snow
+    :param xarray.Dataset nired: result of dc.load
+    :return xarray.DataArray: NDVI with the dimensions of nired
+    """
+    from datacube.storage import masking
+
+    nir = nired.B8A_20m.where(nired.B8A_20m != nired.B8A_20m.attrs['nodata'])
+    red = nired.B04_20m.where(nired.B04_20m != nired.B04_20m.attrs['nodata'])
+    cloud = masking.make_mask(nired.SCL_20m, sca="snow")
+    return ((nir - red) / (nir + red)).where(~cloud)
+
+
+def ndvi_stats(query):
+    """Per pixel NDVI count/mean/std/min/max over the period of query, loading
+    one time slice at a time (see reductions.over_time) so that memory does
+    not grow with the length of the period
+    :param dict query: as ndvi_time_series, its "progress" callback is called
+                       once per time slice
+    :return xarray.Dataset: reductions.STATISTICS, or None if there is no data
+    """
+    query = dict(query)
+    progress = query.pop('progress', None)
+    nired = datacubes.load(DATASET['env'], product=DATASET['product'], measurements=NDVI_MEASUREMENTS,
+                           group_by='solar_day', dask_chunks={'time': 1}, **query)
+    if len(nired.data_vars) == 0:
+        return None
+    return reductions.over_time(nired, ndvi, progress)
+
+
+def ndvi_time_series(query, fp, std_dev=False, fmt='jpg', monthly=False):
     """Return ndvi time series as a big image of smaller images
     :param dict query: x (or longitude), y (or latitude), time
     :param File fp: file pointer to save resulting plot
-    :param std_dev Bool: If True then plot ndvi std deviation over period
+    :param std_dev Bool: If True then plot ndvi std deviation over period,
+                         computed by ndvi_stats unless [datacube] chunked is off
+    :param str fmt: jpg for the plot, or json/csv for the statistics of every
+                    acquisition (statistics.per_time) or, with std_dev, of the
+                    per pixel statistics of the period (statistics.over_period)
+    :param bool monthly: monthly mean composites instead of the acquisitions
     :return: raw HTTP response (json on success or image on error)
+
+    Areas precomputed by backend-ndvi-store are read from ndvi_store instead
+    of loading and masking the bands.
     """
-    # keep those imports here to avoid breaking the rest of the file when these
-    # libraries do not exist
-    import matplotlib
-    # pyplot will dry to plot on an X11 Display without this:
-    matplotlib.use('Agg')
-    import matplotlib.pyplot as plt
-    import datacube
-    
+    chunked = std_dev and config.getboolean("datacube", "chunked", fallback=True)
+    stored = estimate = None
     if 'granule' in DATASET['product']:
-        query['resolution'] = (-0.000135, 0.000135)
+        stored, estimate = ndvi_store.read(query, DATASET, monthly=monthly and not std_dev)
+    if stored is None and 'granule' in DATASET['product']:
         query['output_crs'] = 'EPSG:4326'
+        estimate, err = fit(query, DATASET['product'], NDVI_MEASUREMENTS, GRANULE_RESOLUTION,
+                            per_slice=chunked)
+        if err:
+            return dict(error(err), plan=estimate)
     
-    dc = datacube.Datacube(env=DATASET['env'], app="ndvi_time_series")
-    nired = dc.load(product=DATASET['product'], measurements=['B04_20m', 'B8A_20m', 'SCL_20m'], group_by='solar_day', **query)
-    nir = nired.B8A_20m.where(nired.B8A_20m != nired.B8A_20m.attrs['nodata'])
-    red = nired.B04_20m.where(nired.B04_20m != nired.B04_20m.attrs['nodata'])
-    ndvi = ((nir - red) / (nir + red))
-
-    # Return error message if we find no data instead of crashing
-    if (len(nired.data_vars) == 0):
-        error("Didn't find any index/ingested data in selected area at {}".format(DATASET))
+    if chunked:
+        if stored is not None:
+            stats = reductions.over_time(stored, lambda da: da)
+        else:
+            stats = ndvi_stats(query)
+        if stats is None:
+            return error("Didn't find any index/ingested data in selected area at {}".format(DATASET))
+        if fmt in statistics.FORMATS:
+            columns, rows = statistics.over_period(stats)
+            return table(columns, rows, fp, fmt, estimate)
+        try:
+            std = stats['std'].rename('ndvi std')
+            fig = render.single(std, x=std.dims[1], y=std.dims[0])
+        except Exception as err:
+            return error("Plotting failed: {}".format(err))
+        size = render.save(fig, fp, fmt='jpg', dpi=150)
+        return {'error': 0, 'mimetype': 'image/jpg', 'size': size, 'plan': estimate}
+
+    if stored is not None:
+        values = stored
+        y, x = 'latitude', 'longitude'
+    else:
+        nired = datacubes.load(DATASET['env'], product=DATASET['product'], measurements=NDVI_MEASUREMENTS, group_by='solar_day', **query)
+
+        # Return error message if we find no data instead of crashing
+        if (len(nired.data_vars) == 0):
+            return error("Didn't find any index/ingested data in selected area at {}".format(DATASET))
+        values = ndvi(nired)
+        if monthly and not std_dev:
+            values = values.resample(time='1MS').mean()
+        y, x = nired.crs.dimensions
+    return ndvi_result(values, x, y, fp, std_dev=std_dev, fmt=fmt, estimate=estimate)
+
+
+def ndvi_result(values, x, y, fp, std_dev=False, fmt='jpg', estimate=None):
+    """Plot (or summarise, see ndvi_time_series) the NDVI of every time slice
+    :param xarray.DataArray values: NDVI (time, y, x), NaN where invalid
+    :param str x, y: names of the spatial dimensions of values
+    :param File fp: file pointer to save the result to
+    :param bool std_dev, str fmt: as ndvi_time_series
+    :param dict estimate: plan of the load (see fit)
+    :return: raw HTTP response (json or image/*)
+    """
+    if fmt in statistics.FORMATS:
+        try:
+            if std_dev:
+                columns, rows = statistics.over_period(reductions.over_time(values, lambda da: da))
+            else:
+                # every acquisition, the cloudy ones with a valid_fraction of 0
+                columns, rows = statistics.per_time(values)
+        except Exception as err:
+            return error("Computing statistics failed: {}".format(err))
+        return table(columns, rows, fp, fmt, estimate)
     try:
-        cloud = datacube.storage.masking.make_mask(nired.SCL_20m, sca="snow")
-        ndvi_cloud_free = ndvi.where(~cloud).dropna('time', how='all')
+        ndvi_cloud_free = values.dropna('time', how='all')
         if ( std_dev ):
-            ndvi_cloud_free.std(dim='time').plot()
+            fig = render.single(ndvi_cloud_free.std(dim='time'), x=x, y=y)
         else:
-            ndvi_cloud_free.plot(col='time', col_wrap=3, cmap='RdYlGn')
+            fig = render.facets(ndvi_cloud_free, x=x, y=y, col='time', col_wrap=3, cmap='RdYlGn')
     except Exception as err:
         return error("Plotting failed: {}".format(err))
     ############################
     # save to supplied file object:
-    plt.savefig(fp, dpi=150, format='jpg')
-    plt.gcf().clear()  # clear figure instead of combining new images with old
-    size = fp.tell()
-    return {'error': 0, 'mimetype': 'image/jpg', 'size': size}
+    size = render.save(fig, fp, fmt='jpg', dpi=150)
+    return {'error': 0, 'mimetype': 'image/jpg', 'size': size, 'plan': estimate}
+
+
+def ndvi_zonal(query, features, fp, fmt='json'):
+    """Per zone and date NDVI statistics of many polygons from a single load of
+    their common extent (see zonal)
+    :param dict query: x, y (the extent of all zones), time
+    :param list features: zones of zonal.parse
+    :param File fp: file pointer to save the result to
+    :param str fmt: json or csv
+    :return: raw HTTP response (json)
+    """
+    estimate = None
+    if 'granule' in DATASET['product']:
+        query['output_crs'] = 'EPSG:4326'
+        estimate, err = fit(query, DATASET['product'], NDVI_MEASUREMENTS, GRANULE_RESOLUTION)
+        if err:
+            return dict(error(err), plan=estimate)
+
+    nired = datacubes.load(DATASET['env'], product=DATASET['product'], measurements=NDVI_MEASUREMENTS, group_by='solar_day', **query)
+    if (len(nired.data_vars) == 0):
+        return error("Didn't find any index/ingested data in selected area at {}".format(DATASET))
+    try:
+        y, x = nired.crs.dimensions
+        values = ndvi(nired).transpose('time', y, x)
+        crs = None if 'output_crs' in query else nired.crs
+        label = zonal.labels(features, values.shape[1:], nired.affine, crs)
+        res = zonal.stats(values.values, label, len(features))
+        dates = [str(t)[:10] for t in values.time.values]
+        columns, rows = zonal.rows(features, dates, res)
+    except Exception as err:
+        return error("Computing zonal statistics failed: {}".format(err))
+    return table(columns, rows, fp, fmt, estimate)
 
 
 def error(message):
@@ -0,0 +1,140 @@
+""" Process-wide datacube.Datacube handles
+
+Opening a Datacube connects to its index database and loads the product
+metadata, which used to happen on every datacube request. Handles are now
+created once per env and shared by all requests. A handle that has not been
+used for `health_interval` seconds is checked before it is handed out and
+replaced if its index connection went away.
+
+NOTE: depends on datacube, which is imported on first use
+"""
+import inspect
+import threading
+import time
+
+from backend import config, logtool
+
+log = logtool.getLogger("db", "datacubes")
+
+# env -> [Datacube, time of the last successful use]
+_handles = {}
+_lock = threading.Lock()
+
+
+def get(env=None):
+    """ Return the shared Datacube of env, connecting on first use
+        Args:
+            env: datacube config environment, None for the default one
+        Returns:
+            datacube.Datacube
+    """
+    entry = _handles.get(env)
+    if entry is not None:
+        interval = config.getfloat("datacube", "health_interval", fallback=60)
+        if time.time() - entry[1] < interval or healthy(entry[0]):
+            entry[1] = time.time()
+            return entry[0]
+        log.warning("Datacube index of env {} is not responding, reconnecting".format(env))
+        discard(env, entry[0])
+    with _lock:
+        entry = _handles.get(env)
+        if entry is None:
+            entry = [connect(env), time.time()]
+            _handles[env] = entry
+    return entry[0]
+
+
+def connect(env=None):
+    """ Open a new Datacube on env """
+    import datacube
+    log.info("Connecting to datacube env {}".format(env))
+    return datacube.Datacube(env=env, app="backend")
+
+
+def healthy(dc):
+    """ True if the index database of dc answers """
+    try:
+        # product lookups are cached by datacube, dataset lookups are not
+        dc.index.datasets.has('00000000-0000-0000-0000-000000000000')
+        return True
+    except Exception as err:
+        log.debug("Datacube health check failed: {}".format(err))
+        return False
+
+
+def discard(env, dc=None):
+    """ Forget (and close) the handle of env so the next get() reconnects.
+        If dc is given, only discard it if it still is the handle of env.
+    """
+    with _lock:
+        entry = _handles.get(env)
+        if entry is None or (dc is not None and entry[0] is not dc):
+            return
+        del _handles[env]
+    try:
+        entry[0].close()
+    except Exception:
+        pass
+
+
+def load(env, progress=None, **query):
+    """ dc.load() on the shared handle of env, reconnecting once if the index
+        connection was lost since the last request
+        Args:
+            env: datacube config environment
+            progress (optional): function(loaded, total) called as datasets are
+                                 loaded. Only datacube versions with a
+                                 `progress_cbk` report intermediate progress,
+                                 older ones just report completion.
+            query: keyword arguments of datacube.Datacube.load
+    """
+    from sqlalchemy.exc import DBAPIError
+
+    dc = get(env)
+    if progress is not None and 'progress_cbk' in inspect.signature(dc.load).parameters:
+        query['progress_cbk'] = progress
+    try:
+        data = dc.load(**query)
+    except DBAPIError as err:
+        log.warning("Datacube load failed ({}), reconnecting".format(err))
+        discard(env, dc)
+        data = get(env).load(**query)
+    if progress is not None and 'progress_cbk' not in query:
+        loaded = data.sizes.get('time', 0) if data is not None else 0
+        progress(loaded, loaded)
+    return data
+
+
+def find_datasets(env, **query):
+    """ dc.find_datasets() on the shared handle of env (only reads the index),
+        reconnecting once like load()
+        Args:
+            env: datacube config environment
+            query: product and search terms e.g. time, x, y, geopolygon
+        Returns:
+            list of datacube.model.Dataset
+    """
+    from sqlalchemy.exc import DBAPIError
+
+    try:
+        return get(env).find_datasets(**query)
+    except DBAPIError as err:
+        log.warning("Datacube search failed ({}), reconnecting".format(err))
+        discard(env)
+        return get(env).find_datasets(**query)
+
+
+def warm(env, products):
+    """ Connect to env and load the metadata of products so that the first
+        request costs the same as the following ones
+        Args:
+            env: datacube config environment
+            products: list of product names
+    """
+    dc = get(env)
+    for product in products:
+        if dc.index.products.get_by_name(product) is None:
+            log.warning("Datacube env {} has no product {}".format(env, product))
+    # measurements of all products, as used by dc.load
+    dc.list_measurements()
+    log.info("Warmed datacube env {}: {}".format(env, ", ".join(products)))
@@ -0,0 +1,221 @@
+""" In-process spatial index for point coverage lookups on the extent tables
+
+The valid bounding boxes of a table are loaded once from the spatialite
+database into NumPy arrays and bucketed into a uniform lon/lat grid (CSR
+layout: `starts` holds, for every cell, a slice into `members`). A point
+lookup only tests the boxes of the single cell that contains it. Boxes are
+kept in `epoch DESC` order so results come out already sorted, and the
+full rows are then fetched from spatialite by rowid.
+
+NOTE: depends on numpy. Enable with `index = memory` under [coverage] in
+backend.ini
+"""
+import math
+import threading
+
+from backend import config, logtool
+from backend.db import spatialite
+
+log = logtool.getLogger("db", "extent_index")
+
+# rowids fetched per "WHERE rowid IN (...)" statement
+SELECT_CHUNK = 10000
+
+# loaded indexes keyed by (snapshot, table name), see spatialite.Pool
+_indexes = {}
+# keys of the indexes being rebuilt in the background
+_reloading = set()
+# snapshot seen by the last get(), older indexes are dropped once it changes
+_live = None
+_lock = threading.Lock()
+
+
+def enabled():
+    """ True if coverage lookups should be answered by the in-memory index """
+    return config.get("coverage", "index", fallback="sql") == "memory"
+
+
+def get(extent):
+    """ Return the index of extent (see landsat.EXTENT) for the live snapshot,
+        loading it on first use. When the database has changed since the index
+        was loaded (e.g. after an incremental import) a new index is built in
+        the background while the current one keeps answering.
+        Args:
+            extent: extent table description
+        Returns:
+            A loaded ExtentIndex
+    """
+    global _live
+    pool = spatialite.current_pool()
+    if pool.snapshot != _live:
+        with _lock:
+            for key in [k for k in _indexes if k[0] != pool.snapshot]:
+                del _indexes[key]
+            _live = pool.snapshot
+    key = (pool.snapshot, extent['table'])
+    index = _indexes.get(key)
+    if index is None:
+        with _lock:
+            index = _indexes.get(key)
+            if index is None:
+                index = _load(extent, pool)
+                _indexes[key] = index
+    elif index.generation != spatialite.generation(pool.path):
+        with _lock:
+            if key in _reloading:
+                return index
+            _reloading.add(key)
+        threading.Thread(target=_reload, args=(key, index), daemon=True).start()
+    return index
+
+
+def _load(extent, pool):
+    index = ExtentIndex(extent, pool, config.getfloat("coverage", "index_cell", fallback=1.0))
+    index.load()
+    return index
+
+
+def _reload(key, old):
+    try:
+        _indexes[key] = _load(old.extent, old.pool)
+    except Exception as err:
+        log.error("Reloading the index of {} failed: {}".format(key, err))
+        # don't retry until the database changes again
+        old.generation = spatialite.generation(old.pool.path)
+    finally:
+        with _lock:
+            _reloading.discard(key)
+
+
+def _prepare(pool):
+    """ spatialite.on_swap hook: build the indexes of a new snapshot before it
+        goes live so that the swap doesn't stall coverage lookups
+    """
+    for (snapshot, table), index in list(_indexes.items()):
+        if snapshot == _live and (pool.snapshot, table) not in _indexes:
+            _indexes[(pool.snapshot, table)] = _load(index.extent, pool)
+
+
+spatialite.on_swap(_prepare)
+
+
+def preload(extents):
+    """ Load the indexes of all extents e.g. at startup """
+    for extent in extents:
+        get(extent)
+
+
+class ExtentIndex(object):
+    """Uniform grid index of the valid bounding boxes of one extent table"""
+
+    def __init__(self, extent, pool, cell=1.0):
+        self.extent = extent
+        # rowids are only meaningful in the snapshot the index was built from
+        self.pool = pool
+        self.cell = cell
+        self.nx = int(math.ceil(360.0 / cell))
+        self.ny = int(math.ceil(180.0 / cell))
+
+    def load(self):
+        """ Read all valid bounding boxes from spatialite and build the grid """
+        import numpy as np
+
+        self.generation = spatialite.generation(self.pool.path)
+        # same validity checks as the SQL path so both return the same rows
+        sql = """
+            SELECT rowid, min_lon, min_lat, max_lon, max_lat
+            FROM {table}
+            WHERE {geometry} IS NOT NULL AND {valid}
+            ORDER BY epoch DESC, rowid DESC;
+            """.format(**self.extent)
+        chunks = [np.array(rows, dtype=np.float64)
+                  for rows in spatialite.fetchmany(sql, pool=self.pool)]
+        if chunks:
+            boxes = np.concatenate(chunks)
+        else:
+            boxes = np.empty((0, 5), dtype=np.float64)
+        self.rowids = boxes[:, 0].astype(np.int64)
+        # polygons are built from the min/max columns so a swapped pair still
+        # describes the same rectangle
+        self.x0 = np.minimum(boxes[:, 1], boxes[:, 3])
+        self.x1 = np.maximum(boxes[:, 1], boxes[:, 3])
+        self.y0 = np.minimum(boxes[:, 2], boxes[:, 4])
+        self.y1 = np.maximum(boxes[:, 2], boxes[:, 4])
+        del boxes, chunks
+
+        cx0, cy0 = self._cells(self.x0, self.y0)
+        cx1, cy1 = self._cells(self.x1, self.y1)
+        width = cx1 - cx0 + 1
+        counts = width * (cy1 - cy0 + 1)
+        # one entry for every (box, cell) pair the box overlaps
+        box = np.repeat(np.arange(len(counts), dtype=np.int64), counts)
+        offset = np.arange(counts.sum(), dtype=np.int64) - \
+            np.repeat(np.cumsum(counts) - counts, counts)
+        width = np.repeat(width, counts)
+        cells = (np.repeat(cy0, counts) + offset // width) * self.nx + \
+            np.repeat(cx0, counts) + offset % width
+        del offset, width
+        # sort by cell, keeping the epoch DESC order of boxes inside a cell
+        order = np.lexsort((box, cells))
+        self.members = box[order].astype(np.int32)
+        self.starts = np.searchsorted(cells[order],
+                                      np.arange(self.nx * self.ny + 1))
+        log.debug("Indexed {} extents of {} in {} cell entries".format(
+            len(self.rowids), self.extent['table'], len(self.members)))
+
+    def _cells(self, x, y):
+        """ Grid column/row of coordinates (clipped to the grid) """
+        import numpy as np
+        cx = np.clip(np.floor((x + 180.0) / self.cell), 0, self.nx - 1)
+        cy = np.clip(np.floor((y + 90.0) / self.cell), 0, self.ny - 1)
+        return cx.astype(np.int64), cy.astype(np.int64)
+
+    def query(self, lon, lat):
+        """ Rowids of all boxes that strictly contain lon, lat (like spatialite
+        `within`) in epoch DESC order
+        """
+        try:
+            lon = float(lon)
+            lat = float(lat)
+        except ValueError:
+            # GeomFromText() of a bogus point matches nothing either
+            return self.rowids[:0]
+        if math.isnan(lon) or math.isnan(lat):
+            return self.rowids[:0]
+        cx, cy = self._cells(lon, lat)
+        c = int(cy) * self.nx + int(cx)
+        cand = self.members[self.starts[c]:self.starts[c + 1]]
+        hit = (self.x0[cand] < lon) & (lon < self.x1[cand]) & \
+              (self.y0[cand] < lat) & (lat < self.y1[cand])
+        return self.rowids[cand[hit]]
+
+    def select(self, rowids, columns, where=(), args=(), limit=None, with_rowid=False):
+        """ Fetch `columns` of rowids from spatialite keeping the order of rowids.
+            Rowids that no longer exist (or fail where) are left out.
+            Args:
+                rowids: rowids as returned by query()
+                columns: SQL select list
+                where (optional): extra SQL conditions rows must satisfy
+                args (optional): arguments of the where conditions
+                limit (optional): stop after this many rows
+                with_rowid (optional): prepend the rowid to every row
+        """
+        conditions = ''.join(' AND ' + w for w in where)
+        rows = []
+        for i in range(0, len(rowids), SELECT_CHUNK):
+            chunk = rowids[i:i + SELECT_CHUNK]
+            # rowids are integers straight from the index so inlining is safe
+            ids = ','.join(str(int(r)) for r in chunk)
+            res = spatialite.execute(
+                "SELECT rowid, {} FROM {} WHERE rowid IN ({}){};".format(
+                    columns, self.extent['table'], ids, conditions), args, pool=self.pool)
+            position = {int(r): j for j, r in enumerate(chunk)}
+            res.sort(key=lambda row: position[row[0]])
+            rows.extend(res if with_rowid else (row[1:] for row in res))
+            if limit is not None and len(rows) >= limit:
+                return rows[:limit]
+        return rows
+
+    def find(self, lon, lat, columns):
+        """ Same as query() but return `columns` of the matched rows """
+        return self.select(self.query(lon, lat), columns)
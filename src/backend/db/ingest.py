@@ -0,0 +1,355 @@
+""" Streaming import of the Landsat/Sentinel scene lists into the extents database
+
+Usage:
+    backend-ingest landsat [--source URL|FILE] [--db FILE] [--replace]
+    backend-ingest sentinel --source URL|FILE [--db FILE] [--replace]
+    backend-ingest landsat --incremental [--lookback-days N] [--source ...]
+    backend-ingest landsat --snapshot [--keep N] [--source ...]
+
+The (optionally gzipped) CSV is read straight from the URL or file without
+a temporary copy. `epoch` and the extent polygon are computed while the
+rows are inserted in large batches inside a single transaction, and the
+indexes (see db.migrate) are only built at the end. The CSV header names
+the columns; the Sentinel list must provide productName, timestamp,
+cloudCover, utmZone, latitudeBand, gridsquare, path and the
+min/max_lat/lon bounds used by sentinel.EXTENT.
+
+With --incremental only the rows at or after the high-water mark (the
+newest epoch of the previous import, kept in the ingest_state table) are
+upserted into the existing table. The spatialite triggers installed by
+CreateSpatialIndex keep the R*Tree up to date, so nothing is rebuilt and
+readers are only blocked for the short final commit.
+
+With --snapshot a full import goes into a copy of the live database
+(extents-<timestamp>.db next to it) and geodb is then atomically re-pointed
+to the copy as a symlink. Running servers switch to it without a restart
+(see spatialite.swap).
+"""
+import argparse
+import calendar
+import csv
+import gzip
+import io
+import glob
+import os
+import sqlite3
+import time
+from urllib.request import urlopen
+
+from backend import logtool
+from backend.db import spatialite, landsat, sentinel, migrate
+
+log = logtool.getLogger("db", "ingest")
+
+# rows per executemany() call
+BATCH = 50000
+
+# columns stored as numbers, everything else is TEXT as with `sqlite3 .import'
+REAL_COLUMNS = ('cloudCover', 'min_lat', 'min_lon', 'max_lat', 'max_lon')
+
+SCENE_LISTS = {
+    'landsat': {
+        'extent': landsat.EXTENT,
+        'source': 'http://landsat-pds.s3.amazonaws.com/c1/L8/scene_list.gz',
+        'date': 'acquisitionDate',
+        'key': 'productId',
+    },
+    'sentinel': {
+        'extent': sentinel.EXTENT,
+        'source': None,
+        'date': 'timestamp',
+        'key': 'productName',
+    },
+}
+
+# bulk-load settings: a crash mid-import may leave a corrupt file, re-run the import
+BULK_PRAGMAS = [
+    "PRAGMA synchronous = OFF;",
+    "PRAGMA journal_mode = MEMORY;",
+    "PRAGMA temp_store = MEMORY;",
+    "PRAGMA cache_size = -262144;",
+]
+
+
+def open_source(source):
+    """ Open a scene list URL or file as a stream of CSV text, gunzipping on the fly """
+    if '://' in source:
+        raw = urlopen(source)
+    else:
+        raw = open(source, 'rb')
+    if source.endswith('.gz'):
+        raw = gzip.GzipFile(fileobj=raw)
+    return io.TextIOWrapper(raw, encoding='utf-8', newline='')
+
+
+def to_epoch(value):
+    """ Seconds since the Unix epoch of a scene list timestamp, the same as
+    sqlite's strftime('%s', datetime(value)) but without the SQL round trip
+
+    >>> to_epoch('2017-04-09 10:52:37.373289')
+    1491735157
+    >>> to_epoch('2018-06-01T11:21:41.024Z')
+    1527852101
+    >>> to_epoch('garbage') is None
+    True
+    """
+    v = value.strip()
+    if len(v) == 10:
+        v += ' 00:00:00'
+    try:
+        return calendar.timegm((int(v[0:4]), int(v[5:7]), int(v[8:10]),
+                                int(v[11:13]), int(v[14:16]), int(v[17:19])))
+    except ValueError:
+        return None
+
+
+def create_table(con, extent, header):
+    """ Create the extent table with the CSV header columns plus epoch and the
+    spatialite geometry column
+    """
+    columns = ', '.join('"{}" {}'.format(c, 'REAL' if c in REAL_COLUMNS else 'TEXT')
+                        for c in header)
+    con.execute('CREATE TABLE {} ({}, epoch INTEGER);'.format(extent['table'], columns))
+    con.execute("SELECT AddGeometryColumn(?, ?, 4326, 'POLYGON', 'XY');",
+                (extent['table'], extent['geometry']))
+
+
+def insert_rows(con, extent, header, rows, date, since=None, key=None):
+    """ Insert CSV rows in batches computing epoch and the extent polygon
+        Args:
+            con: spatialite connection inside a transaction
+            extent: extent table description
+            header: CSV column names
+            rows: iterator of CSV rows
+            date: name of the column epoch is computed from
+            since (optional): ignore rows with an older epoch
+            key (optional): unique column, existing rows with the same value
+                            are replaced
+        Returns:
+            (rows inserted, malformed rows skipped)
+    """
+    sql = 'INSERT INTO {} ({}, epoch, {}) VALUES ({}, ?, BuildMbr(?, ?, ?, ?, 4326));'.format(
+        extent['table'], ', '.join('"{}"'.format(c) for c in header), extent['geometry'],
+        ', '.join(['?'] * len(header)))
+    pos = {c: i for i, c in enumerate(header)}
+    d = pos[date]
+    bounds = [pos['min_lon'], pos['min_lat'], pos['max_lon'], pos['max_lat']]
+    width = len(header)
+    inserted = skipped = 0
+
+    def flush(batch):
+        if key:
+            k = pos[key]
+            # a key repeated within the batch keeps its last row only: the
+            # DELETE runs before the batch is inserted
+            batch = list({row[k]: row for row in batch}.values())
+            con.executemany('DELETE FROM {} WHERE "{}" = ?;'.format(extent['table'], key),
+                            [(row[k],) for row in batch])
+        con.executemany(sql, batch)
+        return len(batch)
+
+    batch = []
+    for row in rows:
+        if len(row) != width:
+            skipped += 1
+            continue
+        try:
+            # BuildMbr() returns NULL for TEXT arguments
+            mbr = [float(row[b]) for b in bounds]
+        except ValueError:
+            skipped += 1
+            continue
+        epoch = to_epoch(row[d])
+        if since is not None and (epoch is None or epoch < since):
+            continue
+        batch.append(row + [epoch] + mbr)
+        if len(batch) >= BATCH:
+            inserted += flush(batch)
+            batch = []
+            log.debug("{}: {} rows".format(extent['table'], inserted))
+    if batch:
+        inserted += flush(batch)
+    return inserted, skipped
+
+
+def high_water_mark(con, table):
+    """ Newest epoch imported into table (None if empty) """
+    if migrate.table_exists(con, 'ingest_state'):
+        res = con.execute("SELECT max_epoch FROM ingest_state WHERE table_name = ?;",
+                          (table,)).fetchone()
+        if res:
+            return res[0]
+    return con.execute("SELECT max(epoch) FROM {};".format(table)).fetchone()[0]
+
+
+def record_state(con, spec):
+    """ Remember the high-water mark of spec's table for the next incremental run """
+    table = spec['extent']['table']
+    con.execute("""CREATE TABLE IF NOT EXISTS ingest_state (
+                       table_name TEXT PRIMARY KEY, max_epoch INTEGER, updated INTEGER);""")
+    con.execute("""INSERT OR REPLACE INTO ingest_state
+                   VALUES (?, (SELECT max(epoch) FROM {}), strftime('%s', 'now'));""".format(table),
+                (table,))
+
+
+def create_key_index(con, spec):
+    """ Index the lookup of the rows replaced by incremental imports """
+    con.execute('CREATE INDEX IF NOT EXISTS {0}_key ON {0} ("{1}");'.format(
+        spec['extent']['table'], spec['key']))
+
+
+def ingest(con, name, source, replace=False):
+    """ Stream one scene list into its extent table and index it
+        Args:
+            con: spatialite connection (see spatialite.connect)
+            name: 'landsat' or 'sentinel'
+            source: URL or file of the (gzipped) CSV scene list
+            replace: drop the table first if it already exists
+        Returns:
+            Number of rows inserted
+    """
+    spec = SCENE_LISTS[name]
+    extent = spec['extent']
+    if migrate.table_exists(con, extent['table']):
+        if not replace:
+            raise RuntimeError("{} already exists, use --replace".format(extent['table']))
+        con.execute("SELECT DropGeoTable(?);", (extent['table'],))
+    start = time.time()
+    with open_source(source) as fp:
+        reader = csv.reader(fp)
+        header = next(reader)
+        con.execute("BEGIN;")
+        create_table(con, extent, header)
+        inserted, skipped = insert_rows(con, extent, header, reader, spec['date'])
+        con.execute("COMMIT;")
+    loaded = time.time()
+    migrate.create_spatial_index(con, extent)
+    migrate.create_search_index(con, extent)
+    create_key_index(con, spec)
+    record_state(con, spec)
+    log.info("{}: {} rows ({} skipped) loaded in {:.0f}s, indexed in {:.0f}s".format(
+        extent['table'], inserted, skipped, loaded - start, time.time() - loaded))
+    return inserted
+
+
+def ingest_delta(con, name, source, lookback=0):
+    """ Upsert the rows of a scene list that are newer than the last import
+        Args:
+            con: spatialite connection (see spatialite.connect)
+            name: 'landsat' or 'sentinel'
+            source: URL or file of the (gzipped) CSV scene list
+            lookback: also re-check rows up to this many seconds older than
+                      the high-water mark (late additions)
+        Returns:
+            Number of rows inserted or replaced
+    """
+    spec = SCENE_LISTS[name]
+    extent = spec['extent']
+    if not migrate.table_exists(con, extent['table']):
+        raise RuntimeError("{} does not exist, run a full import first".format(extent['table']))
+    since = high_water_mark(con, extent['table'])
+    if since is not None:
+        since -= lookback
+    log.info("{}: importing rows since epoch {}".format(extent['table'], since))
+    with open_source(source) as fp:
+        reader = csv.reader(fp)
+        header = next(reader)
+        con.execute("BEGIN;")
+        create_key_index(con, spec)
+        inserted, skipped = insert_rows(con, extent, header, reader, spec['date'],
+                                        since=since, key=spec['key'])
+        record_state(con, spec)
+        con.execute("COMMIT;")
+    log.info("{}: {} rows upserted ({} skipped)".format(extent['table'], inserted, skipped))
+    return inserted
+
+
+def new_snapshot(live):
+    """ Copy the live database (if any) to a new extents-<timestamp>.db next to it
+        Returns:
+            path of the copy
+    """
+    base, ext = os.path.splitext(os.path.abspath(live))
+    path = '{}-{}{}'.format(base, time.strftime('%Y%m%d%H%M%S'), ext)
+    if os.path.exists(live):
+        src = sqlite3.connect(live)
+        dst = sqlite3.connect(path)
+        # consistent copy even while the live file is being read/written
+        src.backup(dst)
+        dst.close()
+        src.close()
+    return path
+
+
+def publish(snapshot, live, keep=2):
+    """ Atomically point live (replaced by a symlink) to snapshot and delete
+        all but the `keep` newest snapshots
+    """
+    tmp = live + '.tmp'
+    if os.path.lexists(tmp):
+        os.remove(tmp)
+    os.symlink(os.path.basename(snapshot), tmp)
+    os.replace(tmp, live)
+    base, ext = os.path.splitext(os.path.abspath(live))
+    old = sorted(glob.glob('{}-*{}'.format(base, ext)), reverse=True)[keep:]
+    for path in old:
+        if os.path.samefile(path, live):
+            continue
+        for name in (path, path + '-wal', path + '-shm'):
+            if os.path.exists(name):
+                os.remove(name)
+        log.info("Removed snapshot {}".format(path))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Import a scene list into the extents database")
+    parser.add_argument('scene_list', choices=sorted(SCENE_LISTS))
+    parser.add_argument('--source', help="URL or file of the (gzipped) CSV scene list")
+    parser.add_argument('--db', default=spatialite.DB, help="database file (default: geodb)")
+    parser.add_argument('--replace', action='store_true', help="replace an existing table")
+    parser.add_argument('--incremental', action='store_true',
+                        help="only add rows newer than the previous import")
+    parser.add_argument('--lookback-days', type=float, default=0,
+                        help="with --incremental, also re-check this many days before it")
+    parser.add_argument('--snapshot', action='store_true',
+                        help="import into a copy of --db and then make it the live database")
+    parser.add_argument('--keep', type=int, default=2,
+                        help="with --snapshot, number of snapshots to keep")
+    args = parser.parse_args(argv)
+    if args.snapshot and args.incremental:
+        parser.error("--snapshot rebuilds a table, it can't be --incremental")
+
+    source = args.source or SCENE_LISTS[args.scene_list]['source']
+    if not source:
+        parser.error("--source is required for {}".format(args.scene_list))
+    target = new_snapshot(args.db) if args.snapshot else args.db
+    fresh = not os.path.exists(target)
+    con = spatialite.connect(target)
+    # explicit transactions only
+    con.isolation_level = None
+    start = time.time()
+    if args.incremental:
+        # the database is live: keep WAL and crash safety
+        con.execute("PRAGMA synchronous = NORMAL;")
+        inserted = ingest_delta(con, args.scene_list, source,
+                                lookback=int(args.lookback_days * 86400))
+    else:
+        for pragma in BULK_PRAGMAS:
+            con.execute(pragma)
+        if fresh:
+            # much faster than the default one-transaction-per-table initialisation
+            con.execute("SELECT InitSpatialMetadata(1);")
+        inserted = ingest(con, args.scene_list, source, args.replace or args.snapshot)
+        con.execute("PRAGMA journal_mode = WAL;")
+    con.close()
+    elapsed = time.time() - start
+    print("Imported {} rows into {} in {:.0f}s ({:.0f} rows/s)".format(
+        inserted, target, elapsed, inserted / max(elapsed, 1e-3)))
+    if args.snapshot:
+        publish(target, args.db, args.keep)
+        print("{} now points to {}".format(args.db, target))
+
+
+################### MAIN #######################
+if __name__ == "__main__":
+    main()
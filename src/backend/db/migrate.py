@@ -0,0 +1,84 @@
+""" Schema migrations for the extents database (geodb in backend.ini)
+
+Usage:
+    backend-migrate
+
+Builds the spatialite R*Tree and attribute indexes used by coverage lookups.
+Safe to run repeatedly: existing indexes are left alone.
+"""
+from backend import logtool
+from backend.db import spatialite, landsat, sentinel
+
+log = logtool.getLogger("db", "migrate")
+
+EXTENTS = [landsat.EXTENT, sentinel.EXTENT]
+
+
+def table_exists(con, table):
+    res = con.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = ?;",
+                      (table,))
+    return res.fetchone() is not None
+
+
+def create_spatial_index(con, extent):
+    """ Build the R*Tree index of extent['geometry'] unless it already exists
+        Args:
+            con: spatialite connection (see spatialite.connect)
+            extent: extent table description e.g. landsat.EXTENT
+        Returns:
+            True if the index exists afterwards
+    """
+    table, geometry = extent['table'], extent['geometry']
+    if not table_exists(con, table):
+        log.warning("Table {} does not exist, skipping".format(table))
+        return False
+    if table_exists(con, 'idx_{}_{}'.format(table, geometry)):
+        log.info("Spatial index on {}.{} already exists".format(table, geometry))
+        return True
+    log.info("Creating spatial index on {}.{}".format(table, geometry))
+    # returns 0 when the column was never registered with AddGeometryColumn
+    ok = con.execute("SELECT CreateSpatialIndex(?, ?);", (table, geometry)).fetchone()[0]
+    con.commit()
+    if not ok:
+        log.error("CreateSpatialIndex failed for {}.{}".format(table, geometry))
+    return bool(ok)
+
+
+def create_search_index(con, extent):
+    """ Build the (epoch, cloudCover) index behind the time/cloud filters and
+        the keyset pagination of coverage.search
+        Args:
+            con: spatialite connection (see spatialite.connect)
+            extent: extent table description e.g. landsat.EXTENT
+    """
+    table = extent['table']
+    if not table_exists(con, table):
+        return
+    log.info("Creating epoch/cloudCover index on {}".format(table))
+    # on the expression coverage.filters compares (cloudCover may be TEXT),
+    # it replaces the former index on the plain column
+    con.execute("DROP INDEX IF EXISTS {}_epoch_cloud;".format(table))
+    con.execute("CREATE INDEX IF NOT EXISTS {0}_epoch_cloud_real ON {0} "
+                "(epoch DESC, CAST(cloudCover AS REAL));".format(table))
+    con.commit()
+
+
+def migrate(con):
+    """ Run all migrations on con """
+    # let the read-only pool keep reading while the database is written
+    con.execute("PRAGMA journal_mode = WAL;")
+    for extent in EXTENTS:
+        create_spatial_index(con, extent)
+        create_search_index(con, extent)
+
+
+def main():
+    con = spatialite.connect()
+    migrate(con)
+    con.close()
+    print("Migrated {}".format(spatialite.DB))
+
+
+################### MAIN #######################
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,261 @@
+""" Precomputed NDVI of configured areas, read through memory-mapped arrays
+
+Usage:
+    backend-ndvi-store --time 2018-01-01/2018-12-31 [aoi ...]
+
+backend-ndvi-store loads every area of [ndvi_aois] from DATASET one time
+slice at a time and writes its cloud masked NDVI (datacube_processes.ndvi)
+under data_dir/ndvi/<aoi>/:
+    index.json:        grid (bbox, resolution, shape), dates, months, time
+                       range and dataset, written last
+    dates/<date>.npy:  float32 NDVI of one acquisition (NaN where invalid)
+    months/<YYYY-MM>.npy: mean of the valid acquisitions of a month
+A rebuilt area is written next to the old one and swapped in when complete.
+
+read() serves requests that fall entirely inside a stored area and time
+range from these files: each array is opened with mmap_mode='r' and only
+the window of the request is read. Everything else is loaded live.
+"""
+import argparse
+import json
+import math
+import os
+import shutil
+import time
+
+from backend import config, logtool
+from backend.db import datacubes, planner, reductions
+
+log = logtool.getLogger("db", "ndvi_store")
+
+STORE_DIR = os.path.join(config.get("path", "data_dir"), "ndvi")
+
+
+def aois():
+    """ Configured areas as {name: (xmin, ymin, xmax, ymax)} """
+    if not config.config.has_section("ndvi_aois"):
+        return {}
+    return {name: tuple(float(v) for v in value.split(','))
+            for name, value in config.config.items("ndvi_aois")}
+
+
+def aoi_path(name, *parts):
+    return os.path.join(STORE_DIR, name, *parts)
+
+
+def indexes():
+    """ (directory, index.json) of every stored area, without the ones build()
+        is writing or replacing
+    """
+    res = []
+    if not os.path.isdir(STORE_DIR):
+        return res
+    for name in sorted(os.listdir(STORE_DIR)):
+        if name.endswith(('.tmp', '.old')):
+            continue
+        try:
+            with open(aoi_path(name, 'index.json')) as f:
+                res.append((aoi_path(name), json.load(f)))
+        except (OSError, ValueError):
+            continue
+    return res
+
+
+def window(index, query):
+    """ (row slice, column slice) of the x/y ranges of query in the grid of
+        index, or None if they are not entirely inside it
+
+    >>> index = {'bbox': [0.0, 0.0, 1.0, 1.0], 'resolution': 0.1, 'shape': [10, 10]}
+    >>> window(index, {'x': (0.25, 0.5), 'y': (0.55, 0.8)})
+    (slice(2, 5, None), slice(2, 5, None))
+    >>> window(index, {'x': (0.5, 1.5), 'y': (0.5, 0.8)}) is None
+    True
+    """
+    xmin, ymin, xmax, ymax = planner.bounds(query)
+    left, bottom, right, top = index['bbox']
+    if xmin < left or xmax > right or ymin < bottom or ymax > top:
+        return None
+    res = index['resolution']
+    rows, cols = index['shape']
+    r0 = max(0, int(math.floor(round((top - ymax) / res, 6))))
+    r1 = min(rows, max(r0 + 1, int(math.ceil(round((top - ymin) / res, 6)))))
+    c0 = max(0, int(math.floor(round((xmin - left) / res, 6))))
+    c1 = min(cols, max(c0 + 1, int(math.ceil(round((xmax - left) / res, 6)))))
+    return slice(r0, r1), slice(c0, c1)
+
+
+def whole_months(begin, end):
+    """ True if begin..end (YYYY-MM-DD) starts on the first and ends on the
+        last day of a month
+
+    >>> whole_months('2018-01-01', '2018-02-28'), whole_months('2018-01-15', '2018-02-28')
+    (True, False)
+    """
+    import calendar
+
+    year, month, day = [int(p) for p in end.split('-')]
+    return begin.endswith('-01') and day == calendar.monthrange(year, month)[1]
+
+
+def read(query, dataset, monthly=False):
+    """ NDVI of query from the store
+        Args:
+            query: x, y (EPSG:4326) and time (begin, end) as for
+                   ndvi_time_series
+            dataset: DATASET the store must have been built from
+            monthly: monthly composites instead of the acquisitions, only
+                     for time ranges of whole months
+        Returns:
+            (DataArray (time, latitude, longitude) named ndvi, estimate as
+            planner.plan) or (None, None) if no stored area covers query.
+            Windows larger than the memory budget are read with a stride
+            (see planner.downscale).
+    """
+    import numpy as np
+    import xarray
+
+    if not config.getboolean("ndvi_store", "enabled", fallback=True) or 'time' not in query:
+        return None, None
+    begin, end = [str(t)[:10] for t in query['time']]
+    if monthly and not whole_months(begin, end):
+        # the stored composites would include acquisitions outside the range
+        return None, None
+    for path, index in indexes():
+        if index['dataset'] != dataset or not (index['time'][0] <= begin and end <= index['time'][1]):
+            continue
+        win = window(index, query)
+        if win is None:
+            continue
+        if monthly:
+            keys = [m for m in index['months'] if begin[:7] <= m <= end[:7]]
+            files = [os.path.join(path, 'months', m + '.npy') for m in keys]
+            times = [m + '-01' for m in keys]
+        else:
+            keys = [d for d in index['dates'] if begin <= d <= end]
+            files = [os.path.join(path, 'dates', d + '.npy') for d in keys]
+            times = keys
+        rows, cols = win
+        pixels = (rows.stop - rows.start) * (cols.stop - cols.start)
+        scale, err = planner.downscale(pixels * max(1, len(files)) * 8)
+        if err:
+            # too large even with a stride, the live path rejects it
+            return None, None
+        step = int(math.ceil(scale))
+        rows, cols = slice(rows.start, rows.stop, step), slice(cols.start, cols.stop, step)
+        res = index['resolution']
+        estimate = {"datasets": len(files), "time_steps": len(files), "scale": float(step),
+                    "resolution": res * step, "pixels": pixels // (step * step),
+                    "bytes": pixels // (step * step) * len(files) * 8, "store": index['name']}
+        left, _, _, top = index['bbox']
+        lat = top - (np.arange(index['shape'][0])[rows] + 0.5) * res
+        lon = left + (np.arange(index['shape'][1])[cols] + 0.5) * res
+        # only the pages of the window are read from each file
+        values = np.empty((len(files), len(lat), len(lon)), dtype=np.float32)
+        try:
+            for i, name in enumerate(files):
+                values[i] = np.load(name, mmap_mode='r')[rows, cols]
+        except (OSError, ValueError) as err:
+            # e.g. replaced by build() meanwhile
+            log.warning("Reading NDVI store {} failed, loading live: {}".format(path, err))
+            return None, None
+        log.debug("Read {} x {} from NDVI store {}".format(len(files), values.shape[1:], index['name']))
+        da = xarray.DataArray(values, dims=('time', 'latitude', 'longitude'), name='ndvi',
+                              coords={'time': np.array(times, dtype='datetime64[ns]'),
+                                      'latitude': lat, 'longitude': lon})
+        return da, estimate
+    return None, None
+
+
+def build(name, bbox, time_range):
+    """ (Re)build the store of one area, see module doc
+        Args:
+            name: area name
+            bbox: (xmin, ymin, xmax, ymax) in EPSG:4326
+            time_range: (begin, end) as YYYY-MM-DD
+        Returns:
+            the index of the new store, or None if there is no data
+    """
+    import numpy as np
+    from backend.db import datacube_processes
+
+    dataset = datacube_processes.DATASET
+    resolution = datacube_processes.GRANULE_RESOLUTION
+    xmin, ymin, xmax, ymax = bbox
+    nired = datacubes.load(dataset['env'], product=dataset['product'],
+                           measurements=datacube_processes.NDVI_MEASUREMENTS,
+                           x=(xmin, xmax), y=(ymin, ymax), time=tuple(time_range),
+                           output_crs='EPSG:4326', resolution=(-resolution, resolution),
+                           group_by='solar_day', dask_chunks={'time': 1})
+    if len(nired.data_vars) == 0:
+        log.warning("No data for NDVI store {}".format(name))
+        return None
+    tmp = aoi_path(name + '.tmp')
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(os.path.join(tmp, 'dates'))
+    os.makedirs(os.path.join(tmp, 'months'))
+    dates, months = [], {}
+    lat = lon = None
+    for i in range(nired.sizes['time']):
+        da = datacube_processes.ndvi(nired.isel(time=i)).transpose('latitude', 'longitude').compute()
+        date = str(da.time.values)[:10]
+        values = da.values.astype(np.float32)
+        np.save(os.path.join(tmp, 'dates', date + '.npy'), values)
+        dates.append(date)
+        months.setdefault(date[:7], reductions.Welford(values.shape)).add(values)
+        lat, lon = da.latitude.values, da.longitude.values
+        log.info("NDVI store {}: {} ({}/{})".format(name, date, i + 1, nired.sizes['time']))
+    for month, acc in months.items():
+        np.save(os.path.join(tmp, 'months', month + '.npy'),
+                acc.result()['mean'].astype(np.float32))
+    index = {
+        "name": name,
+        "dataset": dataset,
+        "time": list(time_range),
+        "resolution": resolution,
+        "shape": [len(lat), len(lon)],
+        # outer edges of the grid
+        "bbox": [float(lon[0]) - resolution / 2, float(lat[-1]) - resolution / 2,
+                 float(lon[-1]) + resolution / 2, float(lat[0]) + resolution / 2],
+        "dates": dates,
+        "months": sorted(months),
+        "created": time.time(),
+    }
+    with open(os.path.join(tmp, 'index.json'), 'w') as f:
+        json.dump(index, f)
+    # requests reading the old store keep their open files
+    old = aoi_path(name + '.old')
+    shutil.rmtree(old, ignore_errors=True)
+    if os.path.exists(aoi_path(name)):
+        os.rename(aoi_path(name), old)
+    os.rename(tmp, aoi_path(name))
+    shutil.rmtree(old, ignore_errors=True)
+    return index
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Precompute the NDVI of the [ndvi_aois] areas")
+    parser.add_argument('aoi', nargs='*', help="areas to build (default: all configured)")
+    parser.add_argument('--time', required=True, help="YYYY-MM-DD/YYYY-MM-DD")
+    args = parser.parse_args(argv)
+    configured = aois()
+    names = args.aoi or sorted(configured)
+    unknown = [n for n in names if n not in configured]
+    if unknown:
+        parser.error("not in [ndvi_aois]: {}".format(", ".join(unknown)))
+    if not names:
+        parser.error("no areas configured in [ndvi_aois]")
+    time_range = args.time.split('/')
+    if len(time_range) != 2:
+        parser.error("--time must be YYYY-MM-DD/YYYY-MM-DD")
+    for name in names:
+        start = time.time()
+        index = build(name, configured[name], time_range)
+        if index:
+            print("Built NDVI store {}: {} dates, {} months, {}x{} pixels in {:.0f}s".format(
+                name, len(index['dates']), len(index['months']), index['shape'][0],
+                index['shape'][1], time.time() - start))
+
+
+################### MAIN #######################
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+""" Cost estimate of a datacube load before it runs
+
+The size of a dc.load is pixels x bands x time steps. Pixels follow from the
+extent of the query and the resolution, time steps from the datasets the
+index holds for it (dc.find_datasets, no data is read). When the estimate
+exceeds the [planner] memory_budget the load is planned at a coarser
+resolution that fits, down to max_downscale times the native one; requests
+that don't fit even then are rejected.
+
+Only queries in EPSG:4326 with an explicit resolution (degrees) are planned.
+
+The datasets found are cached (see datasets()): the index is searched for
+the extent of a query snapped outwards to a [planner] dataset_tile grid, so
+that repeated and nearby selections of the same time window skip the search,
+and the datasets are then handed to dc.load so that it doesn't search again.
+"""
+import math
+
+from backend import config, logtool
+from backend.cache import TTLCache
+from backend.db import datacubes
+
+log = logtool.getLogger("db", "planner")
+
+# datasets found per (env, product, tile extent, time window), see datasets()
+DATASETS = TTLCache(maxsize=config.getint("planner", "dataset_cache_size", fallback=1000),
+                    ttl=config.getfloat("planner", "dataset_cache_ttl", fallback=600))
+
+# dc.load arguments that restrict the datasets found, see search_terms
+SEARCH_TERMS = ('time', 'x', 'y', 'longitude', 'latitude', 'geopolygon', 'crs')
+
+
+def search_terms(query):
+    """ The part of a dc.load query understood by dc.find_datasets
+
+    >>> search_terms({'x': (1, 2), 'measurements': ['B04_20m'], 'progress': None})
+    {'x': (1, 2)}
+    """
+    return {k: v for k, v in query.items() if k in SEARCH_TERMS}
+
+
+def bounds(query):
+    """ (xmin, ymin, xmax, ymax) of the x/y (or longitude/latitude) ranges or
+        the geopolygon of query
+
+    >>> bounds({'x': (2, 1), 'y': (3, 4)})
+    (1, 3, 2, 4)
+    """
+    if 'geopolygon' in query:
+        b = query['geopolygon'].boundingbox
+        return b.left, b.bottom, b.right, b.top
+    xs = query.get('x', query.get('longitude'))
+    ys = query.get('y', query.get('latitude'))
+    return min(xs), min(ys), max(xs), max(ys)
+
+
+def pixels(query, resolution):
+    """ Pixels of one band and time step of query at resolution
+
+    >>> pixels({'x': (0, 0.01), 'y': (0, 0.02)}, 0.001)
+    200
+    """
+    xmin, ymin, xmax, ymax = bounds(query)
+    return max(1, int(math.ceil(round((xmax - xmin) / resolution, 6)))) * \
+        max(1, int(math.ceil(round((ymax - ymin) / resolution, 6))))
+
+
+def snap(box, tile):
+    """ box (xmin, ymin, xmax, ymax) grown to the edges of the tile grid
+
+    >>> snap((0.12, -0.05, 0.31, 0.2), 0.1)
+    (0.1, -0.1, 0.4, 0.2)
+    """
+    return tuple(round(math.floor(round(v / tile, 6)) * tile, 6) for v in box[:2]) + \
+        tuple(round(math.ceil(round(v / tile, 6)) * tile, 6) for v in box[2:])
+
+
+def overlaps(dataset, box):
+    """ True if the lat/lon ranges of dataset (searched by the index) overlap
+    box, or if the dataset has none
+    """
+    try:
+        lon, lat = dataset.metadata.lon, dataset.metadata.lat
+        return lon.begin <= box[2] and lon.end >= box[0] and \
+            lat.begin <= box[3] and lat.end >= box[1]
+    except AttributeError:
+        return True
+
+
+def datasets(env, product, query):
+    """ Datasets of product the index holds for query (dc.find_datasets),
+        cached in DATASETS per tile extent and time window
+        Args:
+            env: datacube config environment
+            product: product name
+            query: dc.load query in EPSG:4326 (x/y or geopolygon, time)
+        Returns:
+            list of datacube.model.Dataset, empty if there is no data. Queries
+            in another crs or without a time window are searched uncached.
+    """
+    terms = search_terms(query)
+    tile = config.getfloat("planner", "dataset_tile", fallback=0.1)
+    if not tile or 'crs' in terms or len(terms.get('time') or ()) != 2:
+        return datacubes.find_datasets(env, product=product, **terms)
+    box = bounds(terms)
+    extent = snap(box, tile)
+    key = (env, product, extent, tuple(str(t) for t in terms['time']))
+    found = DATASETS.get(key)
+    if found is None:
+        found = datacubes.find_datasets(env, product=product, x=(extent[0], extent[2]),
+                                        y=(extent[1], extent[3]), time=terms['time'])
+        DATASETS.put(key, found)
+    return [d for d in found if overlaps(d, box)]
+
+
+def time_steps(datasets):
+    """ Time slices a load grouped by solar day will have (approximated by the
+    UTC date of the datasets)
+    """
+    return len(set(d.center_time.date() for d in datasets))
+
+
+def downscale(nbytes):
+    """ Factor to coarsen the resolution of a load of nbytes by to fit the
+        [planner] memory_budget (1.0 if it fits, pixels shrink with its square)
+        Returns:
+            (scale, error): error is a message if scale exceeds max_downscale
+    """
+    budget = config.getint("planner", "memory_budget", fallback=2147483648)
+    max_downscale = config.getfloat("planner", "max_downscale", fallback=8)
+    scale = 1.0
+    if budget and nbytes > budget:
+        scale = math.ceil(math.sqrt(nbytes / float(budget)) * 100) / 100.0
+    if scale > max_downscale:
+        return scale, ("Selection too large: about {} MB at native resolution and more than"
+                       " the {} MB allowed even at {} times coarser, please select a smaller"
+                       " area or time range".format(nbytes // 2**20, budget // 2**20,
+                                                    max_downscale))
+    return scale, None
+
+
+def plan(env, product, query, bands, resolution, per_slice=False, found=None):
+    """ Estimate the load of query and choose its resolution
+        Args:
+            env: datacube config environment
+            product: product name
+            query: dc.load query (x/y or geopolygon, time)
+            bands: number of measurements loaded
+            resolution: native resolution in degrees
+            per_slice: True if the data is processed one time slice at a time,
+                       so that only one slice counts towards the budget
+            found (optional): result of datasets(), searched if None
+        Returns:
+            (estimate, error): estimate is a dictionary with the number of
+            "datasets", "time_steps", "pixels" (per band and slice at the
+            chosen resolution), estimated "bytes", the chosen "resolution"
+            and its "scale" relative to the native one. error is None, or a
+            message if the request doesn't fit the budget.
+    """
+    per_value = config.getint("planner", "bytes_per_value", fallback=8)
+
+    if found is None:
+        found = datasets(env, product, query)
+    steps = time_steps(found)
+    slices = 1 if per_slice else max(1, steps)
+    scale, err = downscale(pixels(query, resolution) * bands * slices * per_value)
+    estimate = {"datasets": len(found), "time_steps": steps,
+                "resolution": resolution * scale, "scale": scale}
+    estimate["pixels"] = pixels(query, estimate["resolution"])
+    estimate["bytes"] = estimate["pixels"] * bands * slices * per_value
+    log.debug("Planned {} {}: {}".format(product, query.get('time'), estimate))
+    return estimate, err
@@ -0,0 +1,100 @@
+""" Single pass reductions over the time dimension of datacube results
+
+dc.load(..., dask_chunks={'time': 1}) returns a lazy Dataset; over_time()
+then computes it one time slice at a time and folds every slice into
+running per pixel statistics, so memory stays bounded by one slice (plus
+the five result arrays) however long the period is. Mean and variance use
+Welford's algorithm, which is numerically stable in a single pass.
+
+NOTE: depends on numpy and xarray, imported on first use
+"""
+from backend import logtool
+
+log = logtool.getLogger("db", "reductions")
+
+# statistics of Welford.result(), in this order
+STATISTICS = ('count', 'mean', 'std', 'min', 'max')
+
+
+class Welford(object):
+    """ Running per pixel count of valid (finite) values, mean, variance,
+    minimum and maximum of equally shaped arrays
+
+    >>> import numpy as np
+    >>> w = Welford((2,))
+    >>> for a in ([1.0, np.nan], [3.0, np.nan], [5.0, 2.0]):
+    ...     w.add(np.array(a))
+    >>> res = w.result()
+    >>> res['count'].tolist(), res['mean'].tolist(), res['min'].tolist()
+    ([3, 1], [3.0, 2.0], [1.0, 2.0])
+    >>> np.allclose(res['std'], [np.std([1.0, 3.0, 5.0]), 0.0])
+    True
+    """
+
+    def __init__(self, shape):
+        import numpy as np
+        self.count = np.zeros(shape, dtype=np.int32)
+        self.mean = np.zeros(shape, dtype=np.float64)
+        self.m2 = np.zeros(shape, dtype=np.float64)
+        self.min = np.full(shape, np.inf)
+        self.max = np.full(shape, -np.inf)
+
+    def add(self, values):
+        """ Fold one array into the statistics, ignoring NaN values """
+        import numpy as np
+        valid = np.isfinite(values)
+        self.count += valid
+        delta = np.where(valid, values - self.mean, 0.0)
+        self.mean += delta / np.maximum(self.count, 1)
+        self.m2 += delta * np.where(valid, values - self.mean, 0.0)
+        np.fmin(self.min, values, out=self.min)
+        np.fmax(self.max, values, out=self.max)
+
+    def result(self):
+        """ Dictionary of STATISTICS arrays. Population standard deviation
+        (ddof=0, as xarray's std), NaN where there was no valid value.
+        """
+        import numpy as np
+        empty = self.count == 0
+        n = np.maximum(self.count, 1)
+        res = {'count': self.count,
+               'mean': self.mean,
+               'std': np.sqrt(self.m2 / n),
+               'min': self.min,
+               'max': self.max}
+        for name in STATISTICS[1:]:
+            res[name] = np.where(empty, np.nan, res[name])
+        return res
+
+
+def over_time(data, fn, progress=None):
+    """ Per pixel statistics of fn(data) over time, computing data one time
+        slice at a time
+        Args:
+            data: Dataset with a time dimension, typically lazy (dask)
+            fn: function of one time slice of data returning a 2D DataArray
+                e.g. datacube_processes.ndvi
+            progress (optional): function(done, total) called after every slice
+        Returns:
+            Dataset of the STATISTICS on the coordinates of fn's result, with
+            the number of time slices as attribute "slices"
+    """
+    import xarray
+
+    total = data.sizes.get('time', 0)
+    acc = template = None
+    for i in range(total):
+        da = fn(data.isel(time=i)).compute()
+        if acc is None:
+            acc = Welford(da.shape)
+            template = da
+        acc.add(da.values)
+        if progress is not None:
+            progress(i + 1, total)
+    if acc is None:
+        return None
+    coords = {d: template[d] for d in template.dims}
+    res = acc.result()
+    log.debug("Reduced {} slices of {}".format(total, template.shape))
+    return xarray.Dataset({name: (template.dims, res[name]) for name in STATISTICS},
+                          coords=coords, attrs={'slices': total})
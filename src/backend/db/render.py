@@ -0,0 +1,270 @@
+""" Thread-safe rendering of datacube results
+
+Every plot is drawn on its own matplotlib Figure attached to an Agg canvas
+and never touches the global pyplot state (current figure, plt.savefig), so
+several requests can render in parallel threads of one process.
+
+The functions mirror the xarray plots used before (facet grids with a
+shared colorbar, a single map with a colorbar, a distance/time transect and
+a classified map) but draw with plain Axes.imshow/pcolormesh.
+RGB composites skip matplotlib altogether: mosaic() tiles the scaled arrays
+into one image and encodes it with Pillow.
+
+NOTE: depends on matplotlib, numpy and Pillow, imported on first use
+"""
+from backend import logtool
+
+log = logtool.getLogger("db", "render")
+
+# inches of a facet panel, as xarray's FacetGrid default
+PANEL_SIZE = 3
+
+
+def figure(width, height):
+    """ New Figure with an Agg canvas (not registered with pyplot) """
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    fig = Figure(figsize=(width, height))
+    FigureCanvasAgg(fig)
+    return fig
+
+
+def save(fig, fp, fmt='jpg', dpi=150):
+    """ Write fig to the file object fp
+        Returns:
+            number of bytes written
+    """
+    fig.savefig(fp, format=fmt, dpi=dpi)
+    return fp.tell()
+
+
+def limits(values, vmin=None, vmax=None):
+    """ Colour limits of values: centred on 0 for data on both sides of it
+    (as xarray does for diverging data)
+    """
+    import numpy as np
+    if vmin is None:
+        vmin = float(np.nanmin(values)) if np.isfinite(values).any() else 0.0
+    if vmax is None:
+        vmax = float(np.nanmax(values)) if np.isfinite(values).any() else 1.0
+    if vmin < 0 < vmax:
+        vmax = max(-vmin, vmax)
+        vmin = -vmax
+    return vmin, vmax
+
+
+def extent(da, x, y):
+    """ imshow extent (left, right, bottom, top) of da with row 0 at the top """
+    xs, ys = da[x].values, da[y].values
+    return (float(xs[0]), float(xs[-1]), float(ys[-1]), float(ys[0]))
+
+
+def title(da, col):
+    """ Facet title: the date of a time slice, or the coordinate value """
+    value = da[col].values
+    if col == 'time':
+        return str(value)[:10]
+    return '{} = {}'.format(col, value)
+
+
+def to_rgba(values):
+    """ (y, x, 3) floats in [0, 1] to RGBA with NaN pixels transparent """
+    import numpy as np
+    valid = np.isfinite(values).all(axis=-1)
+    rgba = np.zeros(values.shape[:-1] + (4,), dtype=np.float32)
+    rgba[..., :3] = np.clip(np.nan_to_num(values), 0, 1)
+    rgba[..., 3] = valid
+    return rgba
+
+
+def facets(da, x, y, col='time', col_wrap=3, cmap=None, norm=None, rgb=None):
+    """ One panel per `col` slice of da, like da.plot(col=col, col_wrap=col_wrap)
+        Args:
+            da: 3D DataArray, or 4D with an `rgb` dimension of size 3
+            x, y: names of the horizontal and vertical dimensions
+            col: dimension to facet along
+            col_wrap: panels per row
+            cmap (optional): colormap of scalar data
+            norm (optional): matplotlib Normalize of scalar data, instead of
+                             limits()
+            rgb (optional): name of the colour dimension of RGB data in [0, 1]
+        Returns:
+            Figure
+    """
+    import math
+
+    n = da.sizes[col]
+    ncols = max(1, min(col_wrap, n))
+    nrows = max(1, int(math.ceil(n / float(ncols))))
+    aspect = da.sizes[x] / float(max(da.sizes[y], 1))
+    fig = figure(PANEL_SIZE * aspect * ncols + (0 if rgb else 1), PANEL_SIZE * nrows)
+    axes = fig.subplots(nrows, ncols, squeeze=False, sharex=True, sharey=True)
+    vmin = vmax = None
+    if rgb is None and norm is None:
+        vmin, vmax = limits(da.values)
+    image = None
+    for i, ax in enumerate(axes.flat):
+        if i >= n:
+            ax.set_visible(False)
+            continue
+        panel = da.isel({col: i})
+        if rgb is not None:
+            values = to_rgba(panel.transpose(y, x, rgb).values)
+            ax.imshow(values, extent=extent(panel, x, y), aspect='auto')
+        else:
+            image = ax.imshow(panel.transpose(y, x).values, extent=extent(panel, x, y),
+                              cmap=cmap, norm=norm, vmin=vmin, vmax=vmax, aspect='auto')
+        ax.set_title(title(panel, col), fontsize='small')
+    if image is not None:
+        fig.colorbar(image, ax=axes.ravel().tolist(), label=da.name)
+    return fig
+
+
+def single(da, x, y, cmap=None):
+    """ One map with a colorbar, like da.plot() of 2D data """
+    aspect = da.sizes[x] / float(max(da.sizes[y], 1))
+    fig = figure(4.5 * aspect + 1.5, 4.5)
+    ax = fig.subplots()
+    vmin, vmax = limits(da.values)
+    image = ax.imshow(da.transpose(y, x).values, extent=extent(da, x, y), cmap=cmap,
+                      vmin=vmin, vmax=vmax, aspect='auto')
+    ax.set_xlabel(x)
+    ax.set_ylabel(y)
+    fig.colorbar(image, ax=ax, label=da.name)
+    return fig
+
+
+def transect(da, x='distance', y='time', cmap=None):
+    """ Values along a line over time, like da.plot(x=x, y=y) """
+    fig = figure(8, 5)
+    ax = fig.subplots()
+    vmin, vmax = limits(da.values)
+    mesh = ax.pcolormesh(da[x].values, da[y].values, da.transpose(y, x).values,
+                         cmap=cmap, vmin=vmin, vmax=vmax, shading='auto')
+    ax.set_xlabel(x)
+    ax.set_ylabel(y)
+    fig.colorbar(mesh, ax=ax, label=da.name)
+    return fig
+
+
+def classes(da, x, y, levels, colors, col='time', col_wrap=3):
+    """ Facets of classified data (e.g. a scene classification band) drawn with
+    one colour per interval of levels
+    """
+    from matplotlib.colors import BoundaryNorm, ListedColormap
+
+    cmap = ListedColormap(colors)
+    return facets(da, x, y, col=col, col_wrap=col_wrap, cmap=cmap,
+                  norm=BoundaryNorm(levels, cmap.N))
+
+
+# image format -> (Pillow format, mimetype) of the mosaic encoder
+IMAGE_FORMATS = {
+    'jpg': ('JPEG', 'image/jpeg'),
+    'png': ('PNG', 'image/png'),
+    'webp': ('WEBP', 'image/webp'),
+}
+
+# pixels of the date label band above each mosaic panel and between panels
+LABEL_HEIGHT = 14
+PADDING = 4
+
+
+def scale_rgb(bands, saturation):
+    """ Three 2D band arrays to an (y, x, 3) uint8 image: values are scaled
+    from [0, saturation] to [0, 255], pixels that are NaN or above saturation
+    in any band are white
+    """
+    import numpy as np
+    values = np.stack(bands, axis=-1)
+    valid = (np.isfinite(values) & (values <= saturation)).all(axis=-1)
+    out = np.clip(np.nan_to_num(values) * (255.0 / saturation), 0, 255).astype(np.uint8)
+    out[~valid] = 255
+    return out
+
+
+def mosaic(panels, count, fp, col_wrap=5, width=None, quality=85, fmt='jpg'):
+    """ Tile RGB images into one labelled mosaic and encode it with Pillow,
+        without matplotlib
+        Args:
+            panels: iterable of (label, (y, x, 3) uint8 array), all the same shape
+            count: number of panels
+            fp: binary file object to write to
+            col_wrap: panels per row
+            width (optional): width of the mosaic in pixels, panels are
+                              resampled to fit. Native resolution if None.
+            quality: JPEG/WebP quality (1-100)
+            fmt: one of IMAGE_FORMATS
+        Returns:
+            (number of bytes written, mimetype)
+    """
+    import math
+    from PIL import Image, ImageDraw
+
+    pil_format, mimetype = IMAGE_FORMATS[fmt]
+    ncols = max(1, min(col_wrap, count))
+    nrows = max(1, int(math.ceil(count / float(ncols))))
+    image = draw = None
+    for i, (label, pixels) in enumerate(panels):
+        panel = Image.fromarray(pixels, 'RGB')
+        if image is None:
+            w, h = panel.size
+            if width:
+                pw = max(16, (width - PADDING * (ncols + 1)) // ncols)
+                w, h = pw, max(1, int(round(h * pw / float(w))))
+            cell_w, cell_h = w + PADDING, h + LABEL_HEIGHT + PADDING
+            image = Image.new('RGB', (ncols * cell_w + PADDING, nrows * cell_h + PADDING),
+                              (255, 255, 255))
+            draw = ImageDraw.Draw(image)
+        if panel.size != (w, h):
+            panel = panel.resize((w, h), Image.BILINEAR)
+        left = PADDING + (i % ncols) * cell_w
+        top = PADDING + (i // ncols) * cell_h
+        draw.text((left, top), label, fill=(0, 0, 0))
+        image.paste(panel, (left, top + LABEL_HEIGHT))
+    if image is None:
+        image = Image.new('RGB', (width or 64, LABEL_HEIGHT + 2 * PADDING), (255, 255, 255))
+    start = fp.tell()
+    image.save(fp, format=pil_format, quality=quality)
+    return fp.tell() - start, mimetype
+
+
+def colormap(values, cmap, vmin, vmax):
+    """ 2D scalar array to (y, x, 4) uint8 RGBA through the named matplotlib
+    colormap over the fixed range [vmin, vmax], NaN pixels transparent
+    """
+    import numpy as np
+    from matplotlib.colors import Normalize
+    try:
+        from matplotlib import colormaps
+        cmap = colormaps[cmap]
+    except ImportError:
+        # matplotlib < 3.5
+        from matplotlib import cm
+        cmap = cm.get_cmap(cmap)
+    rgba = cmap(Normalize(vmin, vmax, clip=True)(values), bytes=True)
+    rgba[~np.isfinite(values)] = 0
+    return rgba
+
+
+def rgba(bands, saturation):
+    """ (y, x, 3) band values to (y, x, 4) uint8 RGBA scaled from
+    [0, saturation], NaN pixels transparent (values above saturation are
+    clipped, unlike scale_rgb)
+    """
+    import numpy as np
+    out = np.zeros(bands.shape[:-1] + (4,), dtype=np.uint8)
+    out[..., :3] = np.clip(np.nan_to_num(bands) * (255.0 / saturation), 0, 255)
+    out[..., 3] = np.where(np.isfinite(bands).all(axis=-1), 255, 0)
+    return out
+
+
+def png(pixels, fp):
+    """ Write a (y, x, 4) uint8 array to fp as an RGBA PNG
+        Returns:
+            number of bytes written
+    """
+    from PIL import Image
+    start = fp.tell()
+    Image.fromarray(pixels, 'RGBA').save(fp, format='PNG', optimize=True)
+    return fp.tell() - start
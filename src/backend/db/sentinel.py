@@ -25,11 +25,25 @@
 
 """ Sentinel specific functions
 """
-from backend.db import spatialite
+from backend.db import coverage
 from backend import logtool
 
 log = logtool.getLogger("db", "sentinel")
 
+EXTENT = {
+    'table': 's2_l1c_extent',
+    'geometry': 'geometry',
+    'columns': """productName AS productId, productName AS entityId,
+                   timestamp AS acquisitionDate, epoch, cloudCover, 'L1C' AS processingLevel,
+                   utmZone || latitudeBand || gridsquare AS grid, min_lat, min_lon, max_lat, max_lon,
+                   'https://sentinel-s2-l1c.s3.amazonaws.com/' ||path || '/preview.jpg' AS download_url""",
+    'fields': ["productId", "entityId", "acquisitionDate", "epoch", "cloudCover",
+               "processingLevel", "grid", "min_lat", "min_lon", "max_lat", "max_lon",
+               "download_url"],
+    # check cloudCover!=-1 and big differences in lat / lon as mercator border data
+    'valid': "(cloudCover != -1)  AND (max_lat-min_lat)<50 AND (max_lon-min_lon)<50",
+}
+
 
 def get_coverage(lon, lat):
     """ Find all indexed Landsat dataset entries that contain lon, lat
@@ -39,36 +53,44 @@ def get_coverage(lon, lat):
         Returns:
             All return rows as an array of dictionaries
     """
-    point = 'POINT({} {})'.format(lon, lat)
-    # check cloudCover!=-1 and big differences in lat / lon as mercator border data
-    res = spatialite.execute("""
-            SELECT productName, timestamp, epoch, cloudCover,
-                   utmZone || latitudeBand || gridsquare as grid , min_lat, min_lon, max_lat, max_lon,
-                   'https://sentinel-s2-l1c.s3.amazonaws.com/' ||path || '/preview.jpg' as download_url
-            FROM s2_l1c_extent
-            WHERE within(GeomFromText(?,4326),geometry) AND
-                  (cloudCover != -1)  AND (max_lat-min_lat)<50 AND (max_lon-min_lon)<50
-            ORDER BY epoch DESC;
-            """, (point,))
-    # convert 2d array to an array of dictionaries. This will be returned
+    # rows are converted to an array of dictionaries. This will be returned
     # as JSON to make life easier for the web developer.
-    resdict = []
-    for row in res:
-        d = {}
-        d["productId"] = row[0]
-        d["entityId"] = row[0]
-        d["acquisitionDate"] = row[1]
-        d["epoch"] = row[2]
-        d["cloudCover"] = row[3]
-        d["processingLevel"] = "L1C"
-        d["grid"] = row[4]
-        d["min_lat"] = row[5]
-        d["min_lon"] = row[6]
-        d["max_lat"] = row[7]
-        d["max_lon"] = row[8]
-        d["download_url"] = row[9]
-        resdict.append(d)
-    return resdict
+    return search(lon=lon, lat=lat)[0]
+
+
+def search(**filters):
+    """ Find Sentinel dataset entries by location, time and cloud cover a page at a time
+        Args:
+            filters: keyword arguments of coverage.search e.g. lon, lat, area,
+                     time_begin, time_end, max_cloud, limit, cursor
+        Returns:
+            (array of dictionaries, cursor of the next page or None)
+    """
+    return coverage.cached_search(EXTENT, to_dict, **filters)
+
+
+def stream(**filters):
+    """ Same as search but without the cache, reading the rows lazily
+        Returns:
+            coverage.Rows of EXTENT['columns'] (see EXTENT['fields'])
+    """
+    return coverage.iter_search(EXTENT, **filters)
+
+
+def get_coverage_batch(points):
+    """ Same as get_coverage for many points with a single query
+        Args:
+            points: list of (lon, lat) pairs
+        Returns:
+            Dictionary of input index -> array of dictionaries
+    """
+    res = coverage.find_many(EXTENT, points)
+    return {i: [to_dict(row) for row in rows] for i, rows in res.items()}
+
+
+def to_dict(row):
+    """ Convert a row of EXTENT['columns'] to the dictionary returned as JSON """
+    return dict(zip(EXTENT['fields'], row))
 
 
 ################### MAIN #######################
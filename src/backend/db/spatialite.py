@@ -7,35 +7,259 @@
 ##                                  ('POINT(788703.57 4645636.3)',))
 ## The output is a a tuple of lists. To get the 2nd field from 3rd row just use output[2][1] (0-based index)
 
+import os
+import queue
+import threading
+import time
 import sqlite3.dbapi2 as db
+from contextlib import contextmanager
+from urllib.request import pathname2url
 
-from backend import config
+from backend import config, logtool
+
+log = logtool.getLogger("db", "spatialite")
 
 ### Constants ###
 
-# full path of sqlite3 database
+# full path of sqlite3 database. May be a symlink to the live snapshot (see swap)
 DB = config.get("path", "geodb")
 
 # full path of libspatialite.so.7
 SPATIALPLUGIN = config.get("path", "libspatialite")
-# creating/connecting the test_db
-con = db.connect(DB, check_same_thread=False)
-con.enable_load_extension(True)
-con.load_extension(SPATIALPLUGIN)
-con.enable_load_extension(False)
 
+# read-only connection pool tuning (see [db] in backend.ini)
+POOL_SIZE = config.getint("db", "pool_size", fallback=8)
+CACHE_SIZE = config.getint("db", "cache_size", fallback=-65536)
+MMAP_SIZE = config.getint("db", "mmap_size", fallback=268435456)
+
+def connect(path=DB, readonly=False):
+    """
+        Open a new connection to path with the spatialite extension loaded
+
+        Args:
+            path (optional) : database file
+            readonly (optional) : open with mode=ro and refuse any writes
+    """
+    if readonly:
+        con = db.connect('file:{}?mode=ro'.format(pathname2url(path)), uri=True,
+                         check_same_thread=False)
+    else:
+        con = db.connect(path, check_same_thread=False)
+    con.enable_load_extension(True)
+    con.load_extension(SPATIALPLUGIN)
+    con.enable_load_extension(False)
+    if readonly:
+        con.execute("PRAGMA query_only = 1;")
+        con.execute("PRAGMA cache_size = {:d};".format(CACHE_SIZE))
+        con.execute("PRAGMA mmap_size = {:d};".format(MMAP_SIZE))
+    return con
+
+
+def snapshot(path=None):
+    """
+        (real path, inode) of the database file path (default: DB) resolves
+        to. DB may be a symlink to the snapshot currently in use.
+    """
+    path = os.path.realpath(path or DB)
+    try:
+        return path, os.stat(path).st_ino
+    except OSError:
+        return path, None
+
+
+class Pool(object):
+    """At most `size` connections to one database snapshot, handed out one
+    query at a time. Idle connections are kept open and reused most-recent
+    first."""
+
+    def __init__(self, path, size, readonly=True):
+        self.snapshot = snapshot(path)
+        self.path = self.snapshot[0]
+        self.readonly = readonly
+        self.retired = False
+        # (table, geometry) pairs known to have a spatialite R*Tree index
+        self.spatial_indexes = set()
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+
+    @contextmanager
+    def connection(self):
+        """ Check out a connection for the duration of the with block """
+        with self._slots:
+            try:
+                con = self._idle.get_nowait()
+            except queue.Empty:
+                con = connect(self.path, self.readonly)
+            try:
+                yield con
+            finally:
+                if self.retired:
+                    con.close()
+                else:
+                    self._idle.put(con)
+
+    def retire(self):
+        """ Close idle connections now and busy ones once they are returned """
+        self.retired = True
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+_pool = None
+_writer = None
+_lock = threading.Lock()
+_swap_lock = threading.Lock()
+_swap_hooks = []
+
+
+def current_pool():
+    """
+        The read-only connection pool of the live snapshot (created on first use)
+    """
+    global _pool
+    if _pool is None:
+        with _lock:
+            if _pool is None:
+                _pool = Pool(DB, POOL_SIZE)
+    return _pool
+
+
+def on_swap(hook):
+    """
+        Register hook(pool). It is called with the pool of a new snapshot
+        before that goes live, e.g. to build anything derived from it.
+    """
+    _swap_hooks.append(hook)
+
+
+def swap():
+    """
+        Serve the database file DB resolves to now if that is not the live
+        snapshot, e.g. after DB (a symlink) was re-pointed to a freshly built
+        file. New queries switch atomically; running ones finish on the old
+        snapshot.
+
+        Returns:
+            True if a new snapshot went live
+    """
+    global _pool, _writer
+    with _swap_lock:
+        old = current_pool()
+        if old.snapshot == snapshot():
+            return False
+        new = Pool(DB, POOL_SIZE)
+        # fails (and keeps the old snapshot live) if e.g. the new file is broken
+        with new.connection() as con:
+            con.execute("SELECT count(*) FROM sqlite_master;")
+        for hook in _swap_hooks:
+            hook(new)
+        with _lock:
+            _pool = new
+            if _writer is not None:
+                _writer.close()
+                _writer = None
+        old.retire()
+        log.info("Serving {}".format(new.path))
+        return True
+
+
+def watch(interval):
+    """
+        Check every interval seconds in a background thread whether DB points
+        to a new snapshot and swap() to it
+    """
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                swap()
+            except Exception as err:
+                log.error("Swapping to {} failed: {}".format(os.path.realpath(DB), err))
+    threading.Thread(target=run, name="geodb-watch", daemon=True).start()
 
-def execute(sql, args=()):
+
+def execute(sql, args=(), readonly=True, pool=None):
     """
         Execute sql using args for sql substitution
 
         Args:
             sql:  SQL statement
             args (optional) : list of susbtitution values
+            readonly (optional) : False for statements that modify the
+                database. These run on a single shared connection and commit.
+            pool (optional) : run on this snapshot instead of the live one
+    """
+    global _writer
+    if readonly:
+        with (pool or current_pool()).connection() as con:
+            return con.execute(sql, args).fetchall()
+    with _lock:
+        if _writer is None:
+            _writer = connect(current_pool().path)
+        res = _writer.execute(sql, args).fetchall()
+        _writer.commit()
+        return res
+
+
+def fetchmany(sql, args=(), size=100000, pool=None):
     """
-    res = con.execute(sql, args)
-    con.commit()
-    return res.fetchall()
+        Like execute() but yield the result in lists of up to `size` rows
+        instead of materialising all of it at once. The pooled connection is
+        held until the generator is exhausted or closed.
+
+        Args:
+            sql:  SQL statement
+            args (optional) : list of susbtitution values
+            size (optional) : maximum rows per yielded list
+            pool (optional) : run on this snapshot instead of the live one
+    """
+    with (pool or current_pool()).connection() as con:
+        res = con.execute(sql, args)
+        while True:
+            rows = res.fetchmany(size)
+            if not rows:
+                break
+            yield rows
+
+
+def generation(path=None):
+    """
+        Identifies the current contents of the database file path (default:
+        DB) resolves to. It changes whenever the file or its write-ahead log
+        is modified or replaced, so it can be used to invalidate anything
+        derived from it.
+    """
+    path = os.path.realpath(path or DB)
+    gen = [path]
+    for name in (path, path + '-wal'):
+        try:
+            st = os.stat(name)
+            gen += [st.st_ino, st.st_mtime_ns, st.st_size]
+        except OSError:
+            gen.append(None)
+    return tuple(gen)
+
+
+def has_spatial_index(table, geometry, pool=None):
+    """
+        True if CreateSpatialIndex() has been run for table.geometry i.e. the
+        idx_<table>_<geometry> R*Tree exists. Positive answers are remembered.
+
+        Args:
+            pool (optional) : check this snapshot instead of the live one
+    """
+    pool = pool or current_pool()
+    if (table, geometry) in pool.spatial_indexes:
+        return True
+    res = execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = ?;",
+                  ('idx_{}_{}'.format(table, geometry),), pool=pool)
+    if res:
+        pool.spatial_indexes.add((table, geometry))
+    return bool(res)
+
 
 
 def get_tables():
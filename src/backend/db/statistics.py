@@ -0,0 +1,142 @@
+""" Numeric results of the NDVI analyses, returned instead of their plots
+
+Rows are computed with NumPy reductions over whole arrays (one call per
+statistic for all acquisitions at once) and written as
+    json: {"error": 0, "columns": [...], "rows": [[...], ...]} like the
+          compact coverage format (see backend.streaming), NaN as null
+    csv:  a header line with the columns, then one line per row
+
+NOTE: depends on numpy, imported on first use
+"""
+import csv
+import io
+import json
+import math
+import numbers
+
+from backend import logtool
+
+log = logtool.getLogger("db", "statistics")
+
+# format -> mimetype
+FORMATS = {
+    'json': 'application/json',
+    'csv': 'text/csv',
+}
+
+PERCENTILES = (10, 25, 75, 90)
+
+# statistics of summary(), in this order
+SUMMARY = ('mean', 'median') + tuple('p{}'.format(p) for p in PERCENTILES) + ('valid_fraction',)
+
+
+def summary(values):
+    """ Statistics of every row of a 2D array over its finite values
+        Args:
+            values: (rows, samples) array
+        Returns:
+            dictionary of SUMMARY arrays with one value per row, NaN for rows
+            without valid values (valid_fraction is then 0)
+
+    >>> import numpy as np
+    >>> s = summary(np.array([[1.0, 2.0, 3.0, np.nan], [np.nan] * 4]))
+    >>> s['mean'].tolist()[0], s['median'].tolist()[0], s['valid_fraction'].tolist()
+    (2.0, 2.0, [0.75, 0.0])
+    """
+    import warnings
+    import numpy as np
+
+    res = {}
+    with warnings.catch_warnings():
+        # rows without any valid value are expected (e.g. fully cloudy dates)
+        warnings.simplefilter("ignore", RuntimeWarning)
+        res['mean'] = np.nanmean(values, axis=1)
+        res['median'] = np.nanmedian(values, axis=1)
+        for p, row in zip(PERCENTILES, np.nanpercentile(values, PERCENTILES, axis=1)):
+            res['p{}'.format(p)] = row
+    res['valid_fraction'] = np.isfinite(values).sum(axis=1) / float(max(values.shape[1], 1))
+    return res
+
+
+def per_time(da):
+    """ SUMMARY of every acquisition of a (time, y, x) DataArray
+        Returns:
+            (columns, rows) with columns date + SUMMARY
+    """
+    values = da.values.reshape(da.sizes['time'], -1)
+    stats = summary(values)
+    dates = [str(t)[:10] for t in da.time.values]
+    rows = [[date] + [stats[name][i] for name in SUMMARY] for i, date in enumerate(dates)]
+    return ['date'] + list(SUMMARY), rows
+
+
+def over_period(stats):
+    """ SUMMARY over all pixels of each per pixel statistic of the period (the
+        Dataset of reductions.over_time)
+        Returns:
+            (columns, rows) with columns statistic + SUMMARY
+    """
+    import numpy as np
+
+    names = [name for name in stats.data_vars]
+    values = np.stack([stats[name].values.astype(float).ravel() for name in names])
+    res = summary(values)
+    rows = [[name] + [res[s][i] for s in SUMMARY] for i, name in enumerate(names)]
+    return ['statistic'] + list(SUMMARY), rows
+
+
+def profile(da, x, y):
+    """ Values of a (time, distance) transect, one row per date and sample
+        Args:
+            da: DataArray with a `distance` dimension and x, y coordinates
+                along it (the pixel the sample was taken from)
+            x, y: names of those coordinates
+        Returns:
+            (columns, rows) with columns date, distance, x, y, value
+    """
+    da = da.transpose('time', 'distance')
+    dist, xs, ys = da.distance.values, da[x].values, da[y].values
+    rows = []
+    for i, t in enumerate(da.time.values):
+        date = str(t)[:10]
+        rows.extend([date, d, px, py, v] for d, px, py, v in zip(dist, xs, ys, da.values[i]))
+    return ['date', 'distance', x, y, da.name or 'value'], rows
+
+
+def value(v):
+    """ JSON/CSV friendly scalar: floats rounded to 6 decimals, NaN as None
+
+    >>> value(float('nan')), value(0.12345678), value('2018-01-01'), value(3)
+    (None, 0.123457, '2018-01-01', 3)
+    """
+    if v is None or isinstance(v, str):
+        return v
+    if isinstance(v, numbers.Integral):
+        return int(v)
+    v = float(v)
+    if math.isnan(v) or math.isinf(v):
+        return None
+    return round(v, 6)
+
+
+def write(columns, rows, fp, fmt='json'):
+    """ Write rows to the binary file object fp
+        Args:
+            columns: column names
+            rows: lists of values, see value()
+            fmt: one of FORMATS
+        Returns:
+            (number of bytes written, mimetype)
+    """
+    rows = [[value(v) for v in row] for row in rows]
+    if fmt == 'csv':
+        text = io.StringIO()
+        writer = csv.writer(text, lineterminator='\n')
+        writer.writerow(columns)
+        writer.writerows(rows)
+        data = text.getvalue().encode('utf-8')
+    else:
+        data = json.dumps({"error": 0, "columns": columns, "rows": rows}).encode('utf-8')
+    fp.write(data)
+    log.debug("Wrote {} rows as {}".format(len(rows), fmt))
+    return len(data), FORMATS[fmt]
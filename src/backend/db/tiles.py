@@ -0,0 +1,255 @@
+""" XYZ map tiles of datacube products
+
+Usage:
+    backend-seed-tiles ndvi --bbox=xmin,ymin,xmax,ymax --zoom 10-13 --time 2018-05-01/2018-06-01
+
+Tiles are 256x256 PNGs in Web Mercator (EPSG:3857), addressed like any
+slippy map as /ws/tiles/<product>/<z>/<x>/<y>.png. Only the extent of the
+tile is loaded from DATASET, straight at the resolution of its zoom level.
+Products are `ndvi` (masked as in datacube_processes.ndvi, colour scale
+fixed to -1..1 so that neighbouring tiles match) and the RGB band sets of
+datacube_processes.RGB_MEASUREMENTS. When a time range holds several
+observations every pixel shows the most recent valid one; pixels without
+any are transparent.
+
+Rendered tiles are kept in TILES (LRU on disk, see backend.diskcache).
+backend-seed-tiles renders every tile of an area over a range of zoom
+levels into it ahead of time.
+"""
+import argparse
+import math
+
+from backend import config, logtool, workers
+from backend.db import datacubes, datacube_processes, render
+from backend.diskcache import DiskCache
+from backend.helper import isdate
+
+log = logtool.getLogger("db", "tiles")
+
+TILE_SIZE = 256
+# half the width of the Web Mercator world in metres
+ORIGIN_SHIFT = 20037508.342789244
+
+PRODUCTS = ['ndvi'] + sorted(datacube_processes.RGB_MEASUREMENTS)
+
+TILES = DiskCache(config.get("path", "data_dir") + "/tiles",
+                  maxbytes=config.getint("tiles", "cache_bytes", fallback=1073741824))
+
+
+def tile_bounds(z, x, y):
+    """ (xmin, ymin, xmax, ymax) of tile z/x/y in EPSG:3857 metres
+
+    >>> [round(v) for v in tile_bounds(0, 0, 0)]
+    [-20037508, -20037508, 20037508, 20037508]
+    >>> [round(v) for v in tile_bounds(1, 1, 0)]
+    [0, 0, 20037508, 20037508]
+    """
+    size = 2 * ORIGIN_SHIFT / 2 ** z
+    xmin = -ORIGIN_SHIFT + x * size
+    ymax = ORIGIN_SHIFT - y * size
+    return xmin, ymax - size, xmin + size, ymax
+
+
+def lonlat_to_tile(lon, lat, z):
+    """ x, y of the tile containing lon, lat at zoom z
+
+    >>> lonlat_to_tile(-3.19, 55.95, 10)
+    (502, 319)
+    """
+    n = 2 ** z
+    lat = max(min(lat, 85.0511), -85.0511)
+    x = int((lon + 180.0) / 360.0 * n)
+    y = int((1.0 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2.0 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def parse_time(value):
+    """ time parameter (YYYY-MM-DD or YYYY-MM-DD/YYYY-MM-DD) as a (begin, end)
+        pair, or None if invalid
+
+    >>> parse_time('2018-05-01')
+    ('2018-05-01', '2018-05-01')
+    >>> parse_time('2018-05-01/2018-06-01')
+    ('2018-05-01', '2018-06-01')
+    """
+    parts = value.split('/')
+    if len(parts) == 1:
+        parts = parts * 2
+    if len(parts) != 2 or not all(isdate(p) for p in parts):
+        return None
+    return tuple(parts)
+
+
+def check(product, z, time):
+    """ Validate a tile request
+        Returns:
+            An error message, or None if the request is valid
+    """
+    if product not in PRODUCTS:
+        return "product must be one of {}".format(", ".join(PRODUCTS))
+    min_zoom = config.getint("tiles", "min_zoom", fallback=8)
+    max_zoom = config.getint("tiles", "max_zoom", fallback=18)
+    if not min_zoom <= z <= max_zoom:
+        return "zoom must be between {} and {}".format(min_zoom, max_zoom)
+    if time is None or parse_time(time) is None:
+        return "time must be YYYY-MM-DD or YYYY-MM-DD/YYYY-MM-DD"
+    return None
+
+
+def cache_key(product, z, x, y, time):
+    return DiskCache.key('tile', product, z, x, y, parse_time(time), datacube_processes.DATASET)
+
+
+def get(product, z, x, y, time):
+    """ Metadata of the cached tile (see DiskCache.get_or_create), rendering
+        it in a worker process if it is missing
+        Raises:
+            workers.Busy: when all workers are busy and the queue is full
+    """
+    def create(fp):
+        pool = workers.get_pool(initializer=datacube_processes.warm)
+        if pool is None:
+            return render_file(product, z, x, y, time, fp.name)
+        try:
+            return pool.submit(render_file, product, z, x, y, time, fp.name)
+        except workers.JobTimeout:
+            return {"error": 1, "msg": "Rendering the tile took too long"}
+        except workers.JobFailed as err:
+            return {"error": 1, "msg": "Rendering the tile failed: {}".format(err)}
+    return TILES.get_or_create(cache_key(product, z, x, y, time), create)
+
+
+def render_file(product, z, x, y, time, path):
+    """ render_tile() into the file at path (job function of get) """
+    with open(path, 'wb') as fp:
+        return render_tile(product, z, x, y, time, fp)
+
+
+def render_tile(product, z, x, y, time, fp):
+    """ Load the extent of tile z/x/y and write it to fp as a PNG
+        Returns:
+            {"error": 0, "mimetype": "image/png", "size": ...}
+    """
+    import numpy as np
+
+    xmin, ymin, xmax, ymax = tile_bounds(z, x, y)
+    resolution = (xmax - xmin) / TILE_SIZE
+    query = {
+        'x': (xmin + resolution / 2, xmax - resolution / 2),
+        'y': (ymin + resolution / 2, ymax - resolution / 2),
+        'crs': 'EPSG:3857',
+        'output_crs': 'EPSG:3857',
+        'resolution': (-resolution, resolution),
+        'time': parse_time(time),
+        'group_by': 'solar_day',
+    }
+    dataset = datacube_processes.DATASET
+    if product == 'ndvi':
+        data = datacubes.load(dataset['env'], product=dataset['product'],
+                              measurements=datacube_processes.NDVI_MEASUREMENTS, **query)
+        if len(data.data_vars) == 0:
+            return empty(fp)
+        values = latest(datacube_processes.ndvi(data).values)
+        rgba = render.colormap(values, 'RdYlGn', -1.0, 1.0)
+    else:
+        measurements = datacube_processes.RGB_MEASUREMENTS[product]
+        data = datacubes.load(dataset['env'], product=dataset['product'],
+                              measurements=measurements, **query)
+        if len(data.data_vars) == 0:
+            return empty(fp)
+        from datacube.storage.masking import mask_invalid_data
+        data = mask_invalid_data(data)
+        bands = np.stack([data[m].values for m in measurements], axis=-1)
+        # a pixel is only valid if all its bands are
+        bands[~np.isfinite(bands).all(axis=-1)] = np.nan
+        rgba = render.rgba(latest(bands), saturation=4000)
+    size = render.png(to_tile(rgba), fp)
+    return {"error": 0, "mimetype": "image/png", "size": size}
+
+
+def latest(values):
+    """ Most recent finite value of every pixel of a (time, ...) array
+
+    >>> import numpy as np
+    >>> latest(np.array([[1.0, 2.0], [np.nan, 3.0]])).tolist()
+    [1.0, 3.0]
+    """
+    import numpy as np
+    if values.shape[0] == 0:
+        return np.full(values.shape[1:], np.nan)
+    out = values[-1].copy()
+    for t in range(values.shape[0] - 2, -1, -1):
+        missing = ~np.isfinite(out)
+        if not missing.any():
+            break
+        out[missing] = values[t][missing]
+    return out
+
+
+def to_tile(rgba):
+    """ Pad or crop a (y, x, 4) array to TILE_SIZE x TILE_SIZE (the load can
+    be off by a pixel at the edges)
+    """
+    import numpy as np
+    tile = np.zeros((TILE_SIZE, TILE_SIZE, 4), dtype=np.uint8)
+    h, w = min(rgba.shape[0], TILE_SIZE), min(rgba.shape[1], TILE_SIZE)
+    tile[:h, :w] = rgba[:h, :w]
+    return tile
+
+
+def empty(fp):
+    """ Write a transparent tile """
+    import numpy as np
+    size = render.png(np.zeros((TILE_SIZE, TILE_SIZE, 4), dtype=np.uint8), fp)
+    return {"error": 0, "mimetype": "image/png", "size": size}
+
+
+def seed(product, bbox, zooms, time):
+    """ Render all tiles of bbox (xmin, ymin, xmax, ymax in EPSG:4326) at the
+        zoom levels zooms into TILES
+        Returns:
+            number of tiles rendered or already cached
+    """
+    count = 0
+    xmin, ymin, xmax, ymax = bbox
+    for z in zooms:
+        x0, y0 = lonlat_to_tile(xmin, ymax, z)
+        x1, y1 = lonlat_to_tile(xmax, ymin, z)
+        for x in range(x0, x1 + 1):
+            for y in range(y0, y1 + 1):
+                res = TILES.get_or_create(
+                    cache_key(product, z, x, y, time),
+                    lambda fp: render_tile(product, z, x, y, time, fp))
+                if res.get("error", 0) != 0:
+                    log.error("Tile {}/{}/{}: {}".format(z, x, y, res.get("msg")))
+                count += 1
+        log.info("Seeded zoom {} ({} tiles so far)".format(z, count))
+    return count
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Render the tiles of an area into the tile cache")
+    parser.add_argument('product', choices=PRODUCTS)
+    parser.add_argument('--bbox', required=True, help="xmin,ymin,xmax,ymax in EPSG:4326 (--bbox=... if xmin is negative)")
+    parser.add_argument('--zoom', required=True, help="zoom level or range e.g. 10-13")
+    parser.add_argument('--time', required=True, help="YYYY-MM-DD or YYYY-MM-DD/YYYY-MM-DD")
+    args = parser.parse_args(argv)
+    try:
+        bbox = [float(v) for v in args.bbox.split(',')]
+        zooms = [int(v) for v in args.zoom.split('-')]
+        if len(bbox) != 4 or len(zooms) not in (1, 2):
+            raise ValueError()
+    except ValueError:
+        parser.error("--bbox must be xmin,ymin,xmax,ymax and --zoom Z or Z1-Z2")
+    zooms = range(zooms[0], zooms[-1] + 1)
+    for z in zooms:
+        err = check(args.product, z, args.time)
+        if err:
+            parser.error(err)
+    count = seed(args.product, bbox, zooms, args.time)
+    print("Seeded {} tiles of {} into {}".format(count, args.product, TILES.root))
+
+
+################### MAIN #######################
+if __name__ == "__main__":
+    main()
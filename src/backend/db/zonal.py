@@ -0,0 +1,180 @@
+""" Zonal statistics: per zone and date statistics of many polygons from one load
+
+The polygons of a GeoJSON FeatureCollection are burnt into one label raster
+on the grid of the loaded data (0 outside all zones; where zones overlap the
+later feature wins). The pixels are then ordered by label once, and every
+statistic is a single grouped reduction (np.add.reduceat etc.) over all
+zones and dates at once, so the cost grows with the number of pixels and not
+with the number of polygons.
+
+NOTE: depends on numpy and rasterio (a datacube dependency), imported on
+first use
+"""
+import json
+
+from backend import config, logtool
+
+log = logtool.getLogger("db", "zonal")
+
+# statistics of stats(), in this order
+STATISTICS = ('pixels', 'valid_fraction', 'mean', 'std', 'min', 'max')
+
+
+def parse(text):
+    """ Zones of a GeoJSON FeatureCollection (or a single Feature) in EPSG:4326
+        Args:
+            text: GeoJSON string
+        Returns:
+            list of (zone id, geometry dict): the id is the feature "id", its
+            "id" property or else its position (from 1)
+        Raises:
+            ValueError: if text is not a collection of (Multi)Polygon features
+                        with numeric coordinates, or has more than [zonal]
+                        max_zones of them
+
+    >>> parse('{"type": "Feature", "properties": {"id": "f1"},'
+    ...       ' "geometry": {"type": "Polygon", "coordinates": [[[0, 0], [1, 0], [1, 1], [0, 0]]]}}')[0][0]
+    'f1'
+    """
+    doc = json.loads(text)
+    if doc.get('type') == 'Feature':
+        doc = {'type': 'FeatureCollection', 'features': [doc]}
+    if doc.get('type') != 'FeatureCollection' or not doc.get('features'):
+        raise ValueError("expected a FeatureCollection with at least one feature")
+    max_zones = config.getint("zonal", "max_zones", fallback=1000)
+    if len(doc['features']) > max_zones:
+        raise ValueError("at most {} features are allowed".format(max_zones))
+    zones = []
+    for i, feature in enumerate(doc['features'], 1):
+        geom = feature.get('geometry') or {}
+        if geom.get('type') not in ('Polygon', 'MultiPolygon') or \
+                not valid_coordinates(geom.get('coordinates'), 3 if geom['type'] == 'Polygon' else 4):
+            raise ValueError("feature {} is not a valid Polygon or MultiPolygon".format(i))
+        zone_id = feature.get('id', (feature.get('properties') or {}).get('id', i))
+        zones.append((zone_id, geom))
+    return zones
+
+
+def valid_coordinates(coords, depth):
+    """ True if coords are non-empty lists nested depth deep down to positions
+        of at least two numbers (depth 1), e.g. 3 for a Polygon
+
+    >>> valid_coordinates([[[0, 0], [1, 0], [1, 1], [0, 0]]], 3)
+    True
+    >>> valid_coordinates([[]], 3), valid_coordinates([[["0", "0"]]], 3)
+    (False, False)
+    """
+    if not isinstance(coords, list) or not coords:
+        return False
+    if depth == 1:
+        return len(coords) >= 2 and all(isinstance(v, (int, float)) and not isinstance(v, bool)
+                                        for v in coords)
+    return all(valid_coordinates(c, depth - 1) for c in coords)
+
+
+def bounds(zones):
+    """ (xmin, ymin, xmax, ymax) of all zones
+
+    >>> bounds([(1, {'type': 'Polygon', 'coordinates': [[[0, 0], [2, 1], [1, 3], [0, 0]]]})])
+    (0.0, 0.0, 2.0, 3.0)
+    """
+    xs, ys = [], []
+
+    def walk(coords):
+        if isinstance(coords[0], (int, float)):
+            xs.append(float(coords[0]))
+            ys.append(float(coords[1]))
+        else:
+            for c in coords:
+                walk(c)
+    for _, geom in zones:
+        walk(geom['coordinates'])
+    return min(xs), min(ys), max(xs), max(ys)
+
+
+def labels(zones, shape, transform, crs=None):
+    """ Label raster of zones: pixel value i is the i-th zone (from 1), 0 is
+        outside all zones
+        Args:
+            zones: result of parse()
+            shape: (rows, columns) of the grid
+            transform: affine transform of the grid
+            crs (optional): datacube CRS of the grid, if not EPSG:4326
+    """
+    import numpy as np
+    from rasterio import features
+
+    shapes = []
+    for i, (_, geom) in enumerate(zones, 1):
+        if crs is not None:
+            from datacube.utils import geometry
+            geom = geometry.Geometry(geom, geometry.CRS('EPSG:4326')).to_crs(crs).__geo_interface__
+        shapes.append((geom, i))
+    return features.rasterize(shapes, out_shape=shape, transform=transform, fill=0,
+                              dtype=np.int32)
+
+
+def stats(values, label, nzones):
+    """ STATISTICS of every zone in every slice of values
+        Args:
+            values: (time, rows, columns) array, NaN where invalid
+            label: (rows, columns) label raster of labels()
+            nzones: number of zones
+        Returns:
+            dictionary of (time, nzones) arrays, NaN for zones without valid
+            pixels (pixels is (nzones,))
+
+    >>> import numpy as np
+    >>> label = np.array([[1, 1, 0], [2, 2, 2]])
+    >>> values = np.array([[[1.0, 3.0, 9.0], [np.nan, 4.0, 6.0]]])
+    >>> s = stats(values, label, 3)
+    >>> s['pixels'].tolist(), s['mean'].tolist(), s['valid_fraction'].tolist()
+    ([2, 3, 0], [[2.0, 5.0, nan]], [[1.0, 0.6666666666666666, nan]])
+    >>> s['min'].tolist(), s['max'].tolist()
+    ([[1.0, 4.0, nan]], [[3.0, 6.0, nan]])
+    """
+    import warnings
+    import numpy as np
+
+    label = label.ravel()
+    pixels = np.bincount(label, minlength=nzones + 1)[1:nzones + 1]
+    # pixels grouped by zone: zone z occupies [starts[z], starts[z] + pixels[z])
+    order = np.argsort(label, kind='stable')[np.count_nonzero(label == 0):]
+    starts = np.concatenate([[0], np.cumsum(pixels)[:-1]])
+    grouped = values.reshape(values.shape[0], -1)[:, order]
+    valid = np.isfinite(grouped)
+    filled = np.where(valid, grouped, 0.0)
+
+    res = {'pixels': pixels}
+    shape = (values.shape[0], nzones)
+    for name in STATISTICS[1:]:
+        res[name] = np.full(shape, np.nan)
+    # reduceat can't express empty groups, they keep NaN
+    some = pixels > 0
+    at = starts[some]
+    if at.size:
+        count = np.add.reduceat(valid.astype(np.int64), at, axis=1)
+        total = np.add.reduceat(filled, at, axis=1)
+        squares = np.add.reduceat(filled * filled, at, axis=1)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)
+            mean = total / count
+            res['mean'][:, some] = mean
+            res['std'][:, some] = np.sqrt(np.maximum(squares / count - mean * mean, 0))
+        res['valid_fraction'][:, some] = count / pixels[some].astype(float)
+        lo = np.fmin.reduceat(np.where(valid, grouped, np.inf), at, axis=1)
+        hi = np.fmax.reduceat(np.where(valid, grouped, -np.inf), at, axis=1)
+        res['min'][:, some] = np.where(count > 0, lo, np.nan)
+        res['max'][:, some] = np.where(count > 0, hi, np.nan)
+    return res
+
+
+def rows(zones, dates, res):
+    """ (columns, rows) of stats() for statistics.write, one row per zone and date """
+    columns = ['zone', 'date'] + list(STATISTICS)
+    out = []
+    for z, (zone_id, _) in enumerate(zones):
+        for t, date in enumerate(dates):
+            out.append([zone_id, date, res['pixels'][z]] +
+                       [res[name][t, z] for name in STATISTICS[1:]])
+    return columns, out
@@ -0,0 +1,222 @@
+"""Content-addressed on-disk cache for rendered files e.g. datacube plots"""
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+from backend import logtool
+
+log = logtool.getLogger("diskcache", "backend")
+
+
+class DiskCache(object):
+    """Files stored under `root` by key, evicting the least recently used ones
+    once they take more than `maxbytes`. Entries older than `maxage` seconds
+    are treated as missing and created again.
+
+    Every entry is a data file plus a small JSON metadata file written after
+    it, so an entry only becomes visible once it is complete. Both are written
+    to a temporary file first and renamed into place, which keeps concurrent
+    writers (threads or processes) from ever exposing a partial file.
+    Within a process only one thread creates a given key at a time, the others
+    wait for its result (see get_or_create).
+
+    >>> DiskCache.key({'b': 1, 'a': 2}) == DiskCache.key({'a': 2, 'b': 1})
+    True
+    """
+
+    def __init__(self, root, maxbytes=0, maxage=0):
+        """
+        :param str root: cache directory, created if missing
+        :param int maxbytes: size budget of the data files (0: unbounded)
+        :param float maxage: seconds an entry stays valid after it was
+                             created (0: forever)
+        """
+        self.root = root
+        self.maxbytes = maxbytes
+        self.maxage = maxage
+        self.hits = 0
+        self.misses = 0
+        # total size of the entries, counted on the first eviction check
+        self._bytes = None
+        # key -> dict(event, result) of the creations in progress
+        self._creating = {}
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    @staticmethod
+    def key(*parts):
+        """ Hash of JSON serialisable parts, independent of the order of
+        dictionary keys
+        """
+        text = json.dumps(parts, sort_keys=True, default=str)
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+    def relpath(self, key):
+        """ Path of the data file of key relative to root e.g. for static_file """
+        return os.path.join(key[:2], key)
+
+    def path(self, key):
+        return os.path.join(self.root, self.relpath(key))
+
+    def lookup(self, key):
+        """ Return the metadata of key (and mark it as recently used) or None
+        if it is missing or expired
+        """
+        meta = self._meta(key)
+        if meta is None:
+            return None
+        try:
+            os.utime(self.path(key) + '.json')
+        except OSError:
+            return None
+        if not os.path.exists(self.path(key)):
+            return None
+        return meta
+
+    def contains(self, key):
+        return self._meta(key) is not None
+
+    def _meta(self, key):
+        """ Metadata of key, None if it is missing or older than maxage """
+        try:
+            with open(self.path(key) + '.json') as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if self.maxage and time.time() - meta.get("created", 0) > self.maxage:
+            return None
+        return meta
+
+    def get_or_create(self, key, create):
+        """ Return the metadata of key, calling create() to produce the entry
+            if it is missing
+            Args:
+                key: cache key e.g. from key()
+                create: function of a writable binary file object (with a
+                        name) that writes the data and returns a dictionary
+                        with "error" (0 on success) and, on success, "mimetype"
+            Returns:
+                The metadata of the entry: the dictionary returned by create()
+                plus "path", or create()'s dictionary if "error" is not 0
+                (failures are not cached)
+        """
+        meta = self.lookup(key)
+        if meta is not None:
+            self.hits += 1
+            return meta
+        with self._lock:
+            pending = self._creating.get(key)
+            owner = pending is None
+            if owner:
+                pending = {"event": threading.Event(), "result": None}
+                self._creating[key] = pending
+        if not owner:
+            pending["event"].wait()
+            if pending["result"] is not None:
+                return pending["result"]
+            # the creating thread failed with an exception, try ourselves
+            return self.get_or_create(key, create)
+        self.misses += 1
+        try:
+            pending["result"] = self._create(key, create)
+            return pending["result"]
+        finally:
+            with self._lock:
+                del self._creating[key]
+            pending["event"].set()
+
+    def _create(self, key, create):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp_')
+        os.close(fd)
+        try:
+            # a named file: create() may hand fp.name to another process
+            with open(tmp, 'w+b') as fp:
+                meta = create(fp)
+                if meta.get("error", 0) != 0:
+                    return meta
+            size = os.path.getsize(tmp)
+            os.replace(tmp, path)
+            meta = dict(meta, size=size, path=path, created=time.time())
+            self._write_meta(path, meta)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        self._added(size)
+        return meta
+
+    def _write_meta(self, path, meta):
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp_')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp, path + '.json')
+
+    def _added(self, size):
+        if not self.maxbytes:
+            return
+        with self._lock:
+            if self._bytes is not None:
+                self._bytes += size
+                if self._bytes <= self.maxbytes:
+                    return
+        self.evict()
+
+    def _entries(self):
+        """ (last use, size, path) of every entry """
+        entries = []
+        for sub in os.scandir(self.root):
+            if not sub.is_dir():
+                continue
+            for f in os.scandir(sub.path):
+                if not f.name.endswith('.json'):
+                    continue
+                path = f.path[:-len('.json')]
+                try:
+                    entries.append((f.stat().st_mtime, os.path.getsize(path), path))
+                except OSError:
+                    pass
+        return entries
+
+    def evict(self):
+        """ Delete least recently used entries until the cache fits in 90% of
+        maxbytes (so that evictions don't run on every insert)
+        """
+        entries = sorted(self._entries())
+        total = sum(e[1] for e in entries)
+        removed = 0
+        if total > self.maxbytes:
+            for _, size, path in entries:
+                if total <= self.maxbytes * 0.9:
+                    break
+                try:
+                    # metadata first: the entry disappears as a whole
+                    os.remove(path + '.json')
+                    os.remove(path)
+                except OSError:
+                    pass
+                total -= size
+                removed += 1
+            log.debug("Evicted {} entries from {}".format(removed, self.root))
+        with self._lock:
+            self._bytes = total
+
+    def clear(self):
+        for _, _, path in self._entries():
+            for name in (path + '.json', path):
+                try:
+                    os.remove(name)
+                except OSError:
+                    pass
+        with self._lock:
+            self._bytes = 0
+
+    def stats(self):
+        """ Counters as a dictionary (e.g. to return as JSON) """
+        entries = self._entries()
+        return {"entries": len(entries), "bytes": sum(e[1] for e in entries),
+                "hits": self.hits, "misses": self.misses}
@@ -46,3 +46,62 @@ def isdate(date):
         res = False
     return res
 
+
+def date2epoch(date):
+    """ Convert a YYYY-MM-DD date to seconds since the Unix epoch (at 00:00 UTC)
+    :param date string: a date accepted by isdate
+    :return int: Unix timestamp
+    :raises ValueError: if date is not valid
+
+    >>> date2epoch('2018-01-01')
+    1514764800
+    >>> date2epoch('2018-1-2')
+    1514851200
+    """
+    import calendar
+    import datetime
+    return calendar.timegm(datetime.datetime.strptime(date, "%Y-%m-%d").timetuple())
+
+
+def linestring(text):
+    """ Parse a line given as WKT or GeoJSON (a LineString geometry or a Feature
+    of one) into its vertices
+    :param text string: e.g. 'LINESTRING (1 2, 3 4)' or
+                        '{"type": "LineString", "coordinates": [[1, 2], [3, 4]]}'
+    :return list: [(x, y), ...] of at least two vertices
+    :raises ValueError: if text is not a valid line
+
+    >>> linestring('LINESTRING(-3.2 55.9, -3.1 55.95,-3.0 55.9)')
+    [(-3.2, 55.9), (-3.1, 55.95), (-3.0, 55.9)]
+    >>> linestring('{"type": "LineString", "coordinates": [[1, 2], [3, 4]]}')
+    [(1.0, 2.0), (3.0, 4.0)]
+    >>> linestring('POINT (1 2)')
+    Traceback (most recent call last):
+    ...
+    ValueError: not a LINESTRING
+    """
+    import json
+    text = text.strip()
+    if text.startswith('{'):
+        geom = json.loads(text)
+        if geom.get('type') == 'Feature':
+            geom = geom.get('geometry') or {}
+        if geom.get('type') != 'LineString':
+            raise ValueError("not a LineString")
+        try:
+            coords = [(float(p[0]), float(p[1])) for p in geom.get('coordinates', [])]
+        except (IndexError, TypeError):
+            raise ValueError("invalid coordinates")
+    else:
+        head, _, body = text.partition('(')
+        if head.strip().upper() != 'LINESTRING' or not body.rstrip().endswith(')'):
+            raise ValueError("not a LINESTRING")
+        coords = []
+        for vertex in body.rstrip()[:-1].split(','):
+            xy = vertex.split()
+            if len(xy) < 2:
+                raise ValueError("invalid vertex '{}'".format(vertex.strip()))
+            coords.append((float(xy[0]), float(xy[1])))
+    if len(coords) < 2:
+        raise ValueError("a line needs at least two vertices")
+    return coords
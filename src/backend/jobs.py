@@ -0,0 +1,133 @@
+""" Asynchronous datacube jobs
+
+A job runs datacube_processes.execute (through the worker pool, see
+datacube_processes.run) in a background thread and keeps its state on disk
+under data_dir/jobs/<id>/ so that any server process can answer for it:
+    status.json:   state (queued, running, done or failed), timestamps, the
+                   load estimate (see db.planner) and, once done, the
+                   mimetype and size of the result
+    progress.json: datasets loaded so far / total, updated while loading
+    result:        the finished image or JSON
+
+Finished jobs are deleted `retention` seconds after they finish.
+"""
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+
+from backend import config, logtool, workers
+from backend.db import datacube_processes
+
+log = logtool.getLogger("jobs", "backend")
+
+JOB_DIR = os.path.join(config.get("path", "data_dir"), "jobs")
+
+_active = set()
+_lock = threading.Lock()
+
+
+class TooManyJobs(Exception):
+    """max_pending jobs are already queued or running in this process"""
+
+
+def submit(params):
+    """ Start a job computing execute(params)
+        Args:
+            params: request parameters as for /ws/datacube
+        Returns:
+            id of the job
+        Raises:
+            TooManyJobs: if max_pending jobs are already waiting or running
+    """
+    with _lock:
+        if len(_active) >= config.getint("jobs", "max_pending", fallback=100):
+            raise TooManyJobs()
+        job_id = uuid.uuid4().hex
+        _active.add(job_id)
+    purge()
+    os.makedirs(job_path(job_id))
+    _write_status(job_id, {"id": job_id, "state": "queued", "params": params,
+                           "created": time.time()})
+    threading.Thread(target=_run, args=(job_id, params), daemon=True).start()
+    return job_id
+
+
+def _run(job_id, params):
+    status = {"id": job_id, "state": "running", "params": params,
+              "created": status_of(job_id)["created"], "started": time.time()}
+    try:
+        _write_status(job_id, status)
+        with open(job_path(job_id, 'result'), 'wb') as fp:
+            while True:
+                try:
+                    res = datacube_processes.run(params, fp, job_path(job_id, 'progress.json'))
+                    break
+                except workers.Busy:
+                    # unlike synchronous requests jobs wait for a free worker
+                    time.sleep(1)
+    except Exception as err:
+        log.exception("Job {} failed".format(job_id))
+        res = {"error": 1, "msg": "{}: {}".format(type(err).__name__, err)}
+    finally:
+        with _lock:
+            _active.discard(job_id)
+    status["finished"] = time.time()
+    status["plan"] = res.get("plan")
+    if res.get("error") == 0:
+        status.update(state="done", mimetype=res["mimetype"],
+                      size=os.path.getsize(job_path(job_id, 'result')))
+    else:
+        status.update(state="failed", msg=res.get("msg"))
+    _write_status(job_id, status)
+
+
+def job_path(job_id, name=''):
+    return os.path.join(JOB_DIR, job_id, name)
+
+
+def status_of(job_id):
+    """ Status of a job as a dictionary (see module doc) including its
+        "progress" while running, or None if there is no such job
+    """
+    try:
+        with open(job_path(job_id, 'status.json')) as f:
+            status = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if status["state"] == "running":
+        try:
+            with open(job_path(job_id, 'progress.json')) as f:
+                status["progress"] = json.load(f)
+        except (OSError, ValueError):
+            status["progress"] = None
+    return status
+
+
+def _write_status(job_id, status):
+    tmp = job_path(job_id, 'status.json.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(status, f)
+    os.replace(tmp, job_path(job_id, 'status.json'))
+
+
+def purge():
+    """ Delete the jobs that finished (or were created, if they never
+    finished) more than `retention` seconds ago
+    """
+    retention = config.getfloat("jobs", "retention", fallback=86400)
+    if not os.path.isdir(JOB_DIR):
+        return
+    for job_id in os.listdir(JOB_DIR):
+        if job_id in _active:
+            continue
+        status = status_of(job_id)
+        if status is not None:
+            # jobs left unfinished by a server that went away expire as well
+            since = status.get("finished", status["created"])
+        else:
+            since = os.path.getmtime(job_path(job_id))
+        if since + retention < time.time():
+            shutil.rmtree(job_path(job_id), ignore_errors=True)
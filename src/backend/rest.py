@@ -23,12 +23,13 @@
 # OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH
 # DAMAGE.
           
-from tempfile import NamedTemporaryFile
-from os.path import basename
-from bottle import static_file
+import hmac
+import json
+import os
+from bottle import static_file, HTTPError
 
-from backend import helper, logtool
-from backend.db import landsat, sentinel, datacube_processes
+from backend import config, helper, jobs, logtool, streaming, workers
+from backend.db import coverage, landsat, sentinel, spatialite, datacube_processes, tiles
 log = logtool.getLogger("GeoRest", "backend")
 
 
@@ -40,71 +41,406 @@ class GeoRest(object):
         self.response = response
 
     def landsat_coverage(self):
-        """ Execure landsat.get_coverage for all dataset that contain lon, lat
-            Mandatory GET Args:
-                lon: Longitude
-                lat: Latitude
+        """ Execute landsat.search for all datasets that contain lon, lat or
+            intersect an area
+            Mandatory GET Args (one of):
+                lon, lat: Longitude, Latitude
+                bbox: xmin,ymin,xmax,ymax
+                intersects: WKT geometry in EPSG:4326
+            Optional GET Args:
+                time_begin, time_end: YYYY-MM-DD acquisition date range
+                max_cloud: maximum cloudCover
+                limit: page size
+                cursor: value of "next" in the previous page
+                format: json (default), compact or ndjson (see backend.streaming)
+                stream: "true" to stream the json format as well
             Returns:
                 Relevant Landsat datasets entries as an array of JSON objects
+                and, if there are more, the cursor of the next page as "next"
         """
         log.debug('CALL: {}'.format(self.request.url))
-        params = helper.httprequest2dict(self.request)
-        if not ('lat' in params) or not ('lon' in params):
-            return self.error("Both lat and lon need to be defined")
-        coverage = landsat.get_coverage(params["lon"], params["lat"])
-        return self.success(coverage)
+        return self.coverage_response(landsat)
 
     def sentinel_coverage(self):
-        """ Execure sentinel.get_coverage for all dataset that contain lon, lat
-            Mandatory GET Args:
-                lon: Longitude
-                lat: Latitude
+        """ Execute sentinel.search for all datasets that contain lon, lat or
+            intersect an area
+            Mandatory GET Args (one of):
+                lon, lat: Longitude, Latitude
+                bbox: xmin,ymin,xmax,ymax
+                intersects: WKT geometry in EPSG:4326
+            Optional GET Args:
+                time_begin, time_end: YYYY-MM-DD acquisition date range
+                max_cloud: maximum cloudCover
+                limit: page size
+                cursor: value of "next" in the previous page
+                format: json (default), compact or ndjson (see backend.streaming)
+                stream: "true" to stream the json format as well
             Returns:
                 Relevant Sentinel datasets entries as an array of JSON objects
+                and, if there are more, the cursor of the next page as "next"
+        """
+        log.debug('CALL: {}'.format(self.request.url))
+        return self.coverage_response(sentinel)
+
+    def landsat_coverage_batch(self):
+        """ Execute landsat.get_coverage for many points with a single query
+            Mandatory POST Args:
+                points: JSON array of [lon, lat] pairs. Either a form parameter
+                        or a JSON body of the form {"points": [...]}
+            Returns:
+                JSON object mapping each input index to its Landsat entries
+        """
+        log.debug('CALL: {}'.format(self.request.url))
+        points, err = self.batch_points()
+        if err:
+            return self.error(err)
+        return self.success(landsat.get_coverage_batch(points))
+
+    def sentinel_coverage_batch(self):
+        """ Execute sentinel.get_coverage for many points with a single query
+            Mandatory POST Args:
+                points: JSON array of [lon, lat] pairs. Either a form parameter
+                        or a JSON body of the form {"points": [...]}
+            Returns:
+                JSON object mapping each input index to its Sentinel entries
         """
         log.debug('CALL: {}'.format(self.request.url))
+        points, err = self.batch_points()
+        if err:
+            return self.error(err)
+        return self.success(sentinel.get_coverage_batch(points))
+
+    def coverage_response(self, extent):
+        """ Search the coverage of an extent module (landsat or sentinel) and
+            encode the result in the requested format. compact, ndjson and
+            stream=true responses are streamed straight from the database
+            cursor and bypass the coverage cache.
+        """
+        query, err = self.coverage_query()
+        if err:
+            return self.error(err)
         params = helper.httprequest2dict(self.request)
-        if not ('lat' in params) or not ('lon' in params):
-            return self.error("Both lat and lon need to be defined")
-        coverage = sentinel.get_coverage(params["lon"], params["lat"])
-        return self.success(coverage)
+        fmt = params.get("format", "json")
+        if fmt not in streaming.FORMATS:
+            return self.error("format must be one of {}".format(", ".join(sorted(streaming.FORMATS))))
+        try:
+            if fmt == "json" and params.get("stream", "false").lower() not in ("1", "true"):
+                coverage, cursor = extent.search(**query)
+                return self.paged(coverage, cursor)
+            rows = extent.stream(**query)
+        except ValueError:
+            return self.error("Invalid cursor")
+        self.response.content_type = streaming.FORMATS[fmt]
+        return streaming.encode(rows, extent.EXTENT['fields'], fmt)
 
+    def coverage_query(self):
+        """ Parse the location and filters of a coverage request
+            Returns:
+                (keyword arguments for search, None) or (None, error message)
+        """
+        params = helper.httprequest2dict(self.request)
+        query = {}
+        if 'bbox' in params:
+            try:
+                xmin, ymin, xmax, ymax = [float(v) for v in params["bbox"].split(',')]
+            except ValueError:
+                return None, "bbox must be xmin,ymin,xmax,ymax"
+            query["area"] = 'POLYGON(({0} {1},{2} {1},{2} {3},{0} {3},{0} {1}))'.format(
+                xmin, ymin, xmax, ymax)
+        elif 'intersects' in params:
+            if not coverage.valid_area(params["intersects"]):
+                return None, "Invalid intersects"
+            query["area"] = params["intersects"]
+        elif ('lat' in params) and ('lon' in params):
+            query["lon"] = params["lon"]
+            query["lat"] = params["lat"]
+        else:
+            return None, "Either lat and lon, bbox or intersects need to be defined"
+        for key in ('time_begin', 'time_end'):
+            if key in params:
+                if not helper.isdate(params[key]):
+                    return None, "Invalid time specified"
+                query[key] = params[key]
+        try:
+            if 'max_cloud' in params:
+                query["max_cloud"] = float(params["max_cloud"])
+            if 'limit' in params:
+                query["limit"] = int(params["limit"])
+                if query["limit"] < 1:
+                    raise ValueError()
+        except ValueError:
+            return None, "max_cloud must be a number and limit a positive integer"
+        if 'cursor' in params:
+            query["cursor"] = params["cursor"]
+        return query, None
+
+    def batch_points(self):
+        """ Parse and validate the `points` of a batch request
+            Returns:
+                (list of (lon, lat) float tuples, None) or (None, error message)
+        """
+        try:
+            body = self.request.json
+        except (ValueError, HTTPError):
+            return None, "Request body is not valid JSON"
+        if body is not None:
+            points = body.get("points") if isinstance(body, dict) else body
+        else:
+            params = helper.httprequest2dict(self.request)
+            if 'points' not in params:
+                return None, "points need to be defined"
+            try:
+                points = json.loads(params["points"])
+            except ValueError:
+                return None, "points is not valid JSON"
+        if not isinstance(points, list):
+            return None, "points must be an array of [lon, lat] pairs"
+        max_points = config.getint("coverage", "batch_max_points", fallback=250)
+        if len(points) > max_points:
+            return None, "At most {} points per request".format(max_points)
+        try:
+            points = [(float(lon), float(lat)) for lon, lat in points]
+        except (TypeError, ValueError):
+            return None, "points must be an array of [lon, lat] pairs"
+        return points, None
 
     def datacube_selection(self):
-        """ Execute a datacube action on selection
+        """ Execute a datacube action on selection. Results are kept in
+            datacube_processes.PLOTS: a repeated request is served from disk
+            and a client that already has it (If-None-Match) gets a 304,
+            until the plot is older than [datacube] plot_cache_age.
             Mandatory GET Args:
-                selection: "rectangle" or "line"
+                selection: "rectangle", "line" or "zones"
                 type: type of processing e.g. "ndvi_transect", "digest". Check
                       implementation at db.datacube
+            Zones GET/POST Args (ndvi_zonal):
+                zones: GeoJSON FeatureCollection of polygons in EPSG:4326,
+                       statistics per zone and date as format json or csv.
+                       At most [zonal] max_zones polygons, POST bodies are
+                       limited to [zonal] max_body_bytes
+            Line GET Args (ndvi_transect):
+                line: WKT or GeoJSON LINESTRING in EPSG:4326, or the segment
+                      xmin,ymin,xmax,ymax
+            Optional GET Args (time_series, colour_infrared, colour_urban):
+                size: width of the image in pixels
+                quality: JPEG/WebP quality 1-100
+                format: jpg (default), png or webp
+            Optional GET Args (ndvi_time_series, ndvi_std_dev, ndvi_transect):
+                format: jpg (default) for the plot, json or csv for the
+                        statistics per date, of the period or along the line
+                composite: "monthly" for monthly mean NDVI (ndvi_time_series)
+            Rectangle types may be combined (e.g. type=time_series,ndvi_time_series):
+                their bands are loaded once and the results returned as a
+                ZIP archive with a manifest.json (see datacube_processes.bundle)
             Returns:
-                Varies -- image/jpeg, image/png or JSON
+                Varies -- image/jpeg, image/png, JSON, CSV or ZIP. The size estimate and
+                resolution the data was loaded at are in X-Datacube-* headers.
         """
         log.debug('CALL: {}'.format(self.request.url))
         params = helper.httprequest2dict(self.request)
-        # the `delete` flag will delete file when it is closed. Disable to debug
-        with NamedTemporaryFile(delete=True, prefix='tmp_plot_') as temp_fp:
-            plot = datacube_processes.execute(params, temp_fp)
-            if plot["error"] == 1:
-                return plot
-            if plot["error"] == 0:
-                log.debug("Got {} plot named {} size {}".format(plot["mimetype"],
-                                                                temp_fp.name,
-                                                                plot["size"]))
-                temp_fp.flush()
-                # there are strong effiency reasons we are not returning the
-                # contents of the fp directly but create a temp file instead.
-                # s.a. static_file documentation (chunked downloading,
-                # content-type, content-length, debugging)
-                return static_file(basename(temp_fp.name), root='/tmp',
-                                   mimetype=plot["mimetype"], download=False)
-        return self.error("Temporary file creation for plotting failed")
+        plots = datacube_processes.PLOTS
+        key = datacube_processes.cache_key(params)
+        cache_control = 'public, max-age={}'.format(
+            config.getint("datacube", "plot_max_age", fallback=3600))
+        # plots are rendered again once they expire, with a new ETag
+        cached = plots.lookup(key)
+        if cached is not None:
+            etag = '"{}-{}"'.format(key, int(cached.get("created", 0)))
+            if etag in self.request.headers.get('If-None-Match', ''):
+                self.response.status = 304
+                self.response.set_header('ETag', etag)
+                self.response.set_header('Cache-Control', cache_control)
+                return ''
+        try:
+            plot = plots.get_or_create(key, lambda fp: datacube_processes.run(params, fp))
+        except workers.Busy:
+            self.response.status = 503
+            self.response.set_header('Retry-After', config.get("workers", "retry_after",
+                                                               fallback="30"))
+            return self.error("Server busy, please retry later")
+        if plot["error"] != 0:
+            self.plan_headers(self.response, plot.get("plan"))
+            return plot
+        log.debug("Got {} plot named {} size {}".format(plot["mimetype"], plot["path"],
+                                                        plot["size"]))
+        # there are strong effiency reasons we are not returning the
+        # contents of the file directly but serve it with static_file
+        # (chunked downloading, content-type, content-length, debugging)
+        res = static_file(plots.relpath(key), root=plots.root,
+                          mimetype=plot["mimetype"], download=False)
+        res.set_header('ETag', '"{}-{}"'.format(key, int(plot.get("created", 0))))
+        res.set_header('Cache-Control', cache_control)
+        self.plan_headers(res, plot.get("plan"))
+        return res
+
+    def plan_headers(self, res, plan):
+        """ Report the load estimate of a datacube request (see db.planner) in
+            X-Datacube-* headers of res
+        """
+        if not plan:
+            return
+        res.set_header('X-Datacube-Datasets', str(plan["datasets"]))
+        res.set_header('X-Datacube-Time-Steps', str(plan["time_steps"]))
+        res.set_header('X-Datacube-Estimated-Bytes', str(plan["bytes"]))
+        res.set_header('X-Datacube-Resolution', repr(plan["resolution"]))
+        res.set_header('X-Datacube-Scale', repr(plan["scale"]))
+
+    def tile(self, product, z, x, y):
+        """ XYZ map tile of a datacube product, see db.tiles. Tiles are kept in
+            tiles.TILES and revalidated with ETag/If-None-Match like plots.
+            Mandatory GET Args:
+                time: YYYY-MM-DD or YYYY-MM-DD/YYYY-MM-DD (latest valid
+                      observation of the range)
+            Returns:
+                image/png, or JSON on error
+        """
+        log.debug('CALL: {}'.format(self.request.url))
+        time = self.request.query.get('time')
+        err = tiles.check(product, z, time)
+        if err:
+            self.response.status = 400
+            return self.error(err)
+        n = 2 ** z
+        if not (0 <= x < n and 0 <= y < n):
+            self.response.status = 404
+            return self.error("No tile {}/{}/{}".format(z, x, y))
+        key = tiles.cache_key(product, z, x, y, time)
+        etag = '"{}"'.format(key)
+        cache_control = 'public, max-age={}'.format(
+            config.getint("tiles", "max_age", fallback=86400))
+        if etag in self.request.headers.get('If-None-Match', '') and tiles.TILES.contains(key):
+            self.response.status = 304
+            self.response.set_header('ETag', etag)
+            self.response.set_header('Cache-Control', cache_control)
+            return ''
+        try:
+            tile = tiles.get(product, z, x, y, time)
+        except workers.Busy:
+            self.response.status = 503
+            self.response.set_header('Retry-After', config.get("workers", "retry_after",
+                                                               fallback="30"))
+            return self.error("Server busy, please retry later")
+        if tile["error"] != 0:
+            return tile
+        res = static_file(tiles.TILES.relpath(key), root=tiles.TILES.root,
+                          mimetype=tile["mimetype"], download=False)
+        res.set_header('ETag', etag)
+        res.set_header('Cache-Control', cache_control)
+        return res
+
+    def datacube_job_submit(self):
+        """ Start an asynchronous datacube_selection
+            POST Args:
+                as datacube_selection
+            Returns:
+                The job id as "id" and the URL of its status as "status"
+        """
+        log.debug('CALL: {}'.format(self.request.url))
+        params = helper.httprequest2dict(self.request)
+        if not ('selection' in params) or not ('type' in params):
+            return self.error("Both selection [line|rectangle] and type need to be defined.")
+        try:
+            job_id = jobs.submit(params)
+        except jobs.TooManyJobs:
+            self.response.status = 503
+            self.response.set_header('Retry-After', config.get("workers", "retry_after",
+                                                               fallback="30"))
+            return self.error("Too many pending jobs, please retry later")
+        self.response.status = 202
+        status = '{}/{}'.format(self.request.url.split('?')[0].rstrip('/'), job_id)
+        self.response.set_header('Location', status)
+        return self.success({"id": job_id, "status": status, "result": status + '/result'})
+
+    def datacube_job_status(self, job_id):
+        """ State of a job started with datacube_job_submit
+            Returns:
+                The job status: "state" (queued, running, done or failed),
+                "progress" ({"loaded", "total"} datasets) while running and
+                "msg" if it failed
+        """
+        log.debug('CALL: {}'.format(self.request.url))
+        status = jobs.status_of(job_id)
+        if status is None:
+            self.response.status = 404
+            return self.error("No job {} (finished jobs expire)".format(job_id))
+        return self.success(status)
+
+    def datacube_job_result(self, job_id):
+        """ Result of a finished job, as datacube_selection would have returned it
+        """
+        log.debug('CALL: {}'.format(self.request.url))
+        status = jobs.status_of(job_id)
+        if status is None:
+            self.response.status = 404
+            return self.error("No job {} (finished jobs expire)".format(job_id))
+        if status["state"] == "failed":
+            self.response.status = 500
+            return self.error(status.get("msg"))
+        if status["state"] != "done":
+            self.response.status = 409
+            return self.error("Job {} is {}".format(job_id, status["state"]))
+        return static_file(os.path.join(job_id, 'result'), root=jobs.JOB_DIR,
+                           mimetype=status["mimetype"], download=False)
+
+    def stats(self):
+        """ Cache and worker counters e.g. to tune the [coverage] cache settings """
+        log.debug('CALL: {}'.format(self.request.url))
+        pool = workers.running_pool()
+        return self.success({"coverage_cache": coverage.CACHE.stats(),
+                             "plot_cache": datacube_processes.PLOTS.stats(),
+                             "tile_cache": tiles.TILES.stats(),
+                             "workers": pool.stats() if pool else None})
+
+    def reload(self):
+        """ Serve the snapshot geodb points to now (see spatialite.swap).
+            Only accepted with the [db] reload_token in an X-Reload-Token
+            header, the endpoint is disabled if no token is configured.
+            Returns:
+                Whether a new snapshot went live and its path
+        """
+        log.debug('CALL: {}'.format(self.request.url))
+        token = config.get("db", "reload_token", fallback="")
+        # client addresses can't be trusted (X-Forwarded-For, reverse proxies)
+        if not token or not hmac.compare_digest(
+                self.request.headers.get('X-Reload-Token', '').encode('utf-8'),
+                token.encode('utf-8')):
+            self.response.status = 403
+            return self.error("A valid X-Reload-Token is required")
+        try:
+            swapped = spatialite.swap()
+        except Exception as err:
+            return self.error("Swapping geodb failed: {}".format(err))
+        return self.success({"swapped": swapped, "snapshot": spatialite.current_pool().path})
 
     def help(self):
         log.debug('CALL: {}'.format(self.request.url))
-        return {"landsat": ["GET", "lat(float): latitude", "lon(float):longitude"]}
+        coverage = ["GET", "lat(float): latitude", "lon(float):longitude",
+                    "bbox(str): xmin,ymin,xmax,ymax instead of lat/lon",
+                    "intersects(str): WKT geometry instead of lat/lon",
+                    "time_begin(str): YYYY-MM-DD", "time_end(str): YYYY-MM-DD",
+                    "max_cloud(float): maximum cloud cover",
+                    "limit(int): page size", "cursor(str): 'next' of previous page",
+                    "format(str): json, compact or ndjson",
+                    "stream(bool): stream the json format"]
+        return {"landsat": coverage,
+                "landsat/batch": ["POST", "points(json): [[lon, lat], ...]"],
+                "sentinel": coverage,
+                "sentinel/batch": ["POST", "points(json): [[lon, lat], ...]"],
+                "datacube/jobs": ["POST", "parameters of datacube, returns a job id"],
+                "datacube/jobs/<id>": ["GET", "job status and progress"],
+                "datacube/jobs/<id>/result": ["GET", "result of a finished job"],
+                "tiles/<product>/<z>/<x>/<y>.png": [
+                    "GET", "product(str): {}".format(", ".join(tiles.PRODUCTS)),
+                    "time(str): YYYY-MM-DD or YYYY-MM-DD/YYYY-MM-DD"]}
 
     def error(self, message):
         return {"error": 1, "msg": message}
 
     def success(self, message):
         return {"error": 0, "msg": message}
+
+    def paged(self, message, cursor):
+        res = self.success(message)
+        if cursor:
+            res["next"] = cursor
+        return res
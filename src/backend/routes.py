@@ -42,6 +42,10 @@ from backend.rest import GeoRest
 
 log = logtool.getLogger("backend")
 
+# largest request body bottle parses (its default is 100 KB), large enough for
+# zonal requests of [zonal] max_zones polygons
+bottle.BaseRequest.MEMFILE_MAX = config.getint("zonal", "max_body_bytes", fallback=16777216)
+
 
 ###  /ws/landsat/... landsat index support ###
 @route('/ws/landsat', method=["GET", ])
@@ -49,18 +53,60 @@ def landsat():
     return GeoRest(request, response).landsat_coverage()
 
 
+@route('/ws/landsat/batch', method=["POST", ])
+def landsat_batch():
+    return GeoRest(request, response).landsat_coverage_batch()
+
+
 ###  /ws/sentinel/... sentinel index support ###
 @route('/ws/sentinel', method=["GET", ])
 def sentinel():
     return GeoRest(request, response).sentinel_coverage()
 
 
+@route('/ws/sentinel/batch', method=["POST", ])
+def sentinel_batch():
+    return GeoRest(request, response).sentinel_coverage_batch()
+
+
 ###  /ws/datacube/... datacube access support ###
-@route('/ws/datacube', method=["GET", ])
+@route('/ws/datacube', method=["GET", "POST"])
 def datacube():
     return GeoRest(request, response).datacube_selection()
 
 
+@route('/ws/tiles/<product>/<z:int>/<x:int>/<y:int>.png', method=["GET", ])
+def tile(product, z, x, y):
+    return GeoRest(request, response).tile(product, z, x, y)
+
+
+@route('/ws/datacube/jobs', method=["POST", ])
+def datacube_job_submit():
+    return GeoRest(request, response).datacube_job_submit()
+
+
+@route('/ws/datacube/jobs/<job_id:re:[0-9a-f]{32}>', method=["GET", ])
+def datacube_job_status(job_id):
+    return GeoRest(request, response).datacube_job_status(job_id)
+
+
+@route('/ws/datacube/jobs/<job_id:re:[0-9a-f]{32}>/result', method=["GET", ])
+def datacube_job_result(job_id):
+    return GeoRest(request, response).datacube_job_result(job_id)
+
+
+###  /ws/stats cache counters ###
+@route('/ws/stats', method=["GET", ])
+def stats():
+    return GeoRest(request, response).stats()
+
+
+###  /ws/admin/reload swap to a new geodb snapshot ###
+@route('/ws/admin/reload', method=["POST", ])
+def reload():
+    return GeoRest(request, response).reload()
+
+
 ### Optional: STATIC FILES (html/css/js etc.). Reserved for future deployments
 def init_static_routes():
     """Call this function to setup static routes using the documentroot defined
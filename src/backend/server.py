@@ -1,13 +1,52 @@
+import signal
+import threading
+
 import bottle
-from backend import config, routes
+from backend import config, logtool, routes
+from backend.db import datacube_processes, extent_index, landsat, sentinel, spatialite
 
 assert routes  # Silence unused import
 
+log = logtool.getLogger("server", "backend")
+
 application = bottle.default_app()
 
+# build the in-memory coverage indexes once, before serving any request
+if extent_index.enabled():
+    extent_index.preload([landsat.EXTENT, sentinel.EXTENT])
 
-def runserver():
+# follow geodb when it is re-pointed to a new snapshot
+if config.getfloat("db", "watch_interval", fallback=0) > 0:
+    spatialite.watch(config.getfloat("db", "watch_interval"))
+
+
+
+def warm_datacube():
+    """ Connect to the datacube and load its metadata so that the first
+    datacube request is not slower than the others
+    """
+    try:
+        datacube_processes.warm()
+    except Exception as err:
+        log.warning("Warming up the datacube failed: {}".format(err))
 
+
+if config.getboolean("datacube", "warm", fallback=True):
+    threading.Thread(target=warm_datacube, daemon=True).start()
+
+
+def swap_snapshot(signum=None, frame=None):
+    """ SIGHUP handler: swap to a new geodb snapshot without blocking requests """
+    def run():
+        try:
+            spatialite.swap()
+        except Exception as err:
+            log.error("Swapping geodb failed: {}".format(err))
+    threading.Thread(target=run).start()
+
+
+def runserver():
+    signal.signal(signal.SIGHUP, swap_snapshot)
     bottle.run(host=config.get("server", "host"),
                port=config.get("server", "port"),
                debug=config.getboolean("server", "debug"))
@@ -0,0 +1,55 @@
+""" Incremental JSON encoding of coverage results (see coverage.Rows)
+
+Rows are encoded a chunk at a time while they are read from the database so
+a response never holds more than one chunk, instead of a list of dicts plus
+its complete JSON string. Formats:
+    json:    {"error": 0, "msg": [{...}, ...], "next": "..."} as the
+             non-streamed response
+    compact: {"error": 0, "columns": [...], "rows": [[...], ...], "next": "..."}
+             i.e. without repeating the keys in every row
+    ndjson:  one JSON object per line, followed by a {"next": "..."} line if
+             there is a next page
+"""
+import json
+
+# format -> Content-Type
+FORMATS = {
+    'json': 'application/json',
+    'compact': 'application/json',
+    'ndjson': 'application/x-ndjson',
+}
+
+
+def encode(rows, fields, fmt='json'):
+    """ Yield the encoded response a chunk at a time
+        Args:
+            rows: coverage.Rows
+            fields: names of the row columns e.g. landsat.EXTENT['fields']
+            fmt: one of FORMATS
+        Returns:
+            Generator of bytes, suitable as a bottle response body
+    """
+    if fmt == 'ndjson':
+        for chunk in rows:
+            yield ''.join(json.dumps(dict(zip(fields, row))) + '\n' for row in chunk).encode()
+        if rows.cursor:
+            yield (json.dumps({"next": rows.cursor}) + '\n').encode()
+        return
+
+    if fmt == 'compact':
+        yield '{{"error": 0, "columns": {}, "rows": ['.format(json.dumps(fields)).encode()
+    else:
+        yield b'{"error": 0, "msg": ['
+    separator = ''
+    for chunk in rows:
+        if fmt == 'compact':
+            # one dumps() call per chunk, minus its enclosing brackets
+            encoded = json.dumps(chunk)[1:-1]
+        else:
+            encoded = json.dumps([dict(zip(fields, row)) for row in chunk])[1:-1]
+        yield (separator + encoded).encode()
+        separator = ', '
+    if rows.cursor:
+        yield ']{}}}'.format(', "next": ' + json.dumps(rows.cursor)).encode()
+    else:
+        yield b']}'
@@ -0,0 +1,201 @@
+""" Worker processes for CPU and memory heavy jobs (datacube loads, plotting)
+
+Jobs run in a fixed number of child processes so that a large request can't
+stall the request threads of the server. Admission is bounded: at most
+`processes` jobs run and `queue_size` more wait for a worker, any further
+submission fails right away with Busy (answered as 503 + Retry-After).
+
+Each job has a timeout after which its worker is killed and replaced. Workers
+run with an address space limit (`max_memory`) and are recycled after
+`max_jobs` jobs, which contains the memory growth of matplotlib/GDAL.
+Job functions and their arguments must be picklable i.e. module level
+functions.
+"""
+import atexit
+import multiprocessing
+import queue
+import threading
+
+from backend import config, logtool
+
+log = logtool.getLogger("workers", "backend")
+
+
+class Busy(Exception):
+    """All workers are busy and the queue is full"""
+
+
+class JobTimeout(Exception):
+    """A job ran longer than the pool timeout"""
+
+
+class JobFailed(Exception):
+    """A job raised an exception in its worker"""
+
+
+def _worker_main(conn, max_jobs, max_memory, initializer):
+    """ Loop of a worker process: run (function, args) received on conn and
+    send back ("ok", result) or ("error", message)
+    """
+    if max_memory:
+        import resource
+        resource.setrlimit(resource.RLIMIT_AS, (max_memory, max_memory))
+    if initializer is not None:
+        try:
+            initializer()
+        except Exception as err:
+            log.warning("Worker initializer failed: {}".format(err))
+    jobs = 0
+    while not max_jobs or jobs < max_jobs:
+        jobs += 1
+        try:
+            fn, args, kwargs = conn.recv()
+        except EOFError:
+            return
+        try:
+            conn.send(("ok", fn(*args, **kwargs)))
+        except MemoryError:
+            conn.send(("error", "Out of memory"))
+        except Exception as err:
+            conn.send(("error", "{}: {}".format(type(err).__name__, err)))
+
+
+class Worker(object):
+    """A worker process and the parent end of its pipe"""
+
+    def __init__(self, context, max_jobs, max_memory, initializer):
+        self.conn, child = context.Pipe()
+        self.process = context.Process(target=_worker_main,
+                                       args=(child, max_jobs, max_memory, initializer),
+                                       daemon=True)
+        self.process.start()
+        child.close()
+        self.jobs = 0
+        self.max_jobs = max_jobs
+
+    def run(self, fn, args, kwargs, timeout):
+        self.jobs += 1
+        self.conn.send((fn, args, kwargs))
+        if not self.conn.poll(timeout or None):
+            raise JobTimeout()
+        return self.conn.recv()
+
+    def spent(self):
+        """ True if the process exited or will exit after its current job """
+        return (self.max_jobs and self.jobs >= self.max_jobs) or not self.process.is_alive()
+
+    def stop(self):
+        self.conn.close()
+        self.process.join(1)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+
+
+class WorkerPool(object):
+    """Fixed size pool of worker processes with a bounded queue"""
+
+    def __init__(self, processes=2, queue_size=8, timeout=300, max_jobs=50,
+                 max_memory=0, initializer=None, start_method='spawn'):
+        """
+        :param int processes: number of worker processes
+        :param int queue_size: jobs that may wait for a free worker
+        :param float timeout: seconds a job may run (0: no limit)
+        :param int max_jobs: jobs after which a worker is replaced (0: never)
+        :param int max_memory: address space limit of a worker in bytes (0: none)
+        :param initializer: picklable function run once by every new worker
+        :param str start_method: multiprocessing start method
+        """
+        self.size = processes
+        self.timeout = timeout
+        self.running = 0
+        self._context = multiprocessing.get_context(start_method)
+        self._args = (max_jobs, max_memory, initializer)
+        self._slots = threading.BoundedSemaphore(processes + queue_size)
+        self._idle = queue.Queue()
+        self._lock = threading.Lock()
+        for _ in range(processes):
+            self._idle.put(None)  # started on first use
+
+    def submit(self, fn, *args, **kwargs):
+        """ Run fn(*args, **kwargs) in a worker and return its result
+            Raises:
+                Busy: the queue is full
+                JobTimeout: the job took longer than timeout
+                JobFailed: the job raised an exception
+        """
+        if not self._slots.acquire(blocking=False):
+            raise Busy()
+        try:
+            worker = self._idle.get()
+            with self._lock:
+                self.running += 1
+            try:
+                if worker is None or worker.spent():
+                    if worker is not None:
+                        worker.stop()
+                    worker = Worker(self._context, *self._args)
+                status, result = worker.run(fn, args, kwargs, self.timeout)
+            except JobTimeout:
+                log.error("Job {} timed out after {}s".format(fn.__name__, self.timeout))
+                worker.process.kill()
+                worker.stop()
+                worker = None
+                raise
+            except (EOFError, OSError) as err:
+                # the worker died e.g. killed by the OOM killer
+                worker.stop()
+                worker = None
+                raise JobFailed("Worker exited: {}".format(err))
+            finally:
+                with self._lock:
+                    self.running -= 1
+                self._idle.put(worker)
+            if status != "ok":
+                raise JobFailed(result)
+            return result
+        finally:
+            self._slots.release()
+
+    def close(self):
+        while not self._idle.empty():
+            worker = self._idle.get()
+            if worker is not None:
+                worker.stop()
+
+    def stats(self):
+        """ Counters as a dictionary (e.g. to return as JSON) """
+        return {"processes": self.size, "running": self.running}
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool(initializer=None):
+    """ The process-wide pool configured under [workers] in backend.ini, or
+        None if processes = 0 (jobs then run in the calling thread)
+    """
+    global _pool
+    processes = config.getint("workers", "processes", fallback=2)
+    if processes <= 0:
+        return None
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = WorkerPool(
+                    processes=processes,
+                    queue_size=config.getint("workers", "queue_size", fallback=8),
+                    timeout=config.getfloat("workers", "timeout", fallback=300),
+                    max_jobs=config.getint("workers", "max_jobs", fallback=50),
+                    max_memory=config.getint("workers", "max_memory", fallback=0),
+                    initializer=initializer)
+                atexit.register(_pool.close)
+    return _pool
+
+
+def running_pool():
+    """ The pool get_pool() created, or None if there is none yet. Doesn't
+        start one (which would miss the initializer of the datacube jobs).
+    """
+    return _pool
@@ -0,0 +1,80 @@
+""" backend-ingest of a small scene list, searched through db.coverage
+
+NOTE: needs the spatialite extension ([path] libspatialite), skipped without it
+"""
+import csv
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from backend.db import coverage, ingest, landsat, spatialite
+
+HEADER = ['productId', 'entityId', 'acquisitionDate', 'cloudCover', 'processingLevel',
+          'path', 'row', 'min_lat', 'min_lon', 'max_lat', 'max_lon', 'download_url']
+
+SCENES = [
+    ['LC08_A', 'E1', '2018-05-01 10:00:00.0', '12.5', 'L1TP', '204', '21',
+     '55.0', '-4.0', '56.5', '-2.0', 'http://example.org/a'],
+    ['LC08_B', 'E2', '2018-06-01 10:00:00.0', '40.0', 'L1TP', '204', '21',
+     '55.5', '-3.5', '57.0', '-1.5', 'http://example.org/b'],
+    # elsewhere
+    ['LC08_C', 'E3', '2018-06-02 10:00:00.0', '1.0', 'L1TP', '10', '10',
+     '10.0', '10.0', '11.0', '11.0', 'http://example.org/c'],
+    # malformed bounds are skipped
+    ['LC08_D', 'E4', '2018-06-03 10:00:00.0', '1.0', 'L1TP', '10', '10',
+     'n/a', '10.0', '11.0', '11.0', 'http://example.org/d'],
+]
+
+
+def has_spatialite():
+    try:
+        spatialite.connect(':memory:').close()
+        return True
+    except Exception:
+        return False
+
+
+@unittest.skipUnless(has_spatialite(), "spatialite extension not available")
+class IngestTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.source = os.path.join(self.dir, 'scene_list.csv')
+        with open(self.source, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(HEADER)
+            writer.writerows(SCENES)
+        self.db = os.path.join(self.dir, 'extents.db')
+        ingest.main(['landsat', '--source', self.source, '--db', self.db])
+        # serve it instead of the configured geodb
+        for name, value in (('DB', self.db), ('_pool', None)):
+            patch = mock.patch.object(spatialite, name, value)
+            patch.start()
+            self.addCleanup(patch.stop)
+        coverage.CACHE.clear()
+
+    def tearDown(self):
+        spatialite.current_pool().retire()
+        shutil.rmtree(self.dir)
+
+    def test_rows_have_geometry(self):
+        con = spatialite.connect(self.db)
+        res = con.execute("SELECT count(*), count(geom) FROM landsat_extent;").fetchone()
+        con.close()
+        self.assertEqual(res, (3, 3))
+
+    def test_find(self):
+        rows = coverage.find(landsat.EXTENT, -3.0, 56.0)
+        # newest first
+        self.assertEqual([row[0] for row in rows], ['LC08_B', 'LC08_A'])
+        self.assertEqual(coverage.find(landsat.EXTENT, 0.0, 0.0), [])
+
+    def test_max_cloud(self):
+        rows, _ = coverage.search(landsat.EXTENT, lon=-3.0, lat=56.0, max_cloud=20)
+        self.assertEqual([row[0] for row in rows], ['LC08_A'])
+
+
+if __name__ == '__main__':
+    unittest.main()